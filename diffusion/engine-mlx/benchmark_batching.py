@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga del scheduler de smart_diffusion_server.py (batching continuo
+a nivel de bloque) contra un servidor en marcha.
+
+Lanza llegadas abiertas (Poisson) de una mezcla de peticiones cortas y largas
+a /chat y mide throughput (peticiones/s y caracteres generados/s) y latencia
+p50/p95 por tipo. Para comparar con la cola serie de antes se arranca el
+servidor con una sola secuencia activa:
+
+  DIFFUSION_MAX_ACTIVE=1 python smart_diffusion_server.py   # baseline
+  DIFFUSION_MAX_ACTIVE=4 python smart_diffusion_server.py   # scheduler
+
+Con DIFFUSION_STUB_BLOCK_S el servidor usa un modelo simulado (prefill
+proporcional al prompt y un sleep por bloque del canvas, sin GPU ni pesos):
+mide solo el scheduler, p. ej. en una máquina sin el modelo:
+
+  DIFFUSION_STUB_BLOCK_S=0.2 DIFFUSION_MAX_ACTIVE=1 python smart_diffusion_server.py
+
+Uso:
+  python benchmark_batching.py --url http://127.0.0.1:8011 --requests 24 --rate 0.5
+  python benchmark_batching.py --long-ratio 0.5 --long-tokens 3000 --short-tokens 256
+"""
+
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+SHORT_PROMPT = "Responde en una frase: ¿qué es la difusión discreta en modelos de lenguaje?"
+LONG_PROMPT = "Escribe un ensayo detallado, con secciones, sobre la historia de los modelos de difusión y su aplicación al texto."
+
+
+def post(url: str, payload: dict) -> dict:
+    req = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=1800) as r:
+        return json.loads(r.read())
+
+
+def get(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=60) as r:
+        return json.loads(r.read())
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_one(url: str, kind: str, max_tokens: int, results: list, lock: threading.Lock):
+    prompt = LONG_PROMPT if kind == "long" else SHORT_PROMPT
+    t0 = time.perf_counter()
+    try:
+        res = post(f"{url}/chat", {"prompt": prompt, "max_tokens": max_tokens, "temperature": 0.5})
+        ok = res.get("status") == "success"
+        chars = len(res.get("response", {}).get("text", "")) if ok else 0
+    except (urllib.error.URLError, OSError):
+        ok, chars = False, 0
+    with lock:
+        results.append({"kind": kind, "ok": ok, "latency_s": time.perf_counter() - t0, "chars": chars})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8011")
+    parser.add_argument("--requests", type=int, default=24)
+    parser.add_argument("--rate", type=float, default=0.5, help="Llegadas por segundo (media)")
+    parser.add_argument("--long-ratio", type=float, default=0.25, help="Fracción de peticiones largas")
+    parser.add_argument("--short-tokens", type=int, default=256)
+    parser.add_argument("--long-tokens", type=int, default=2048)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    rng = random.Random(args.seed)
+    health = get(f"{url}/health")
+    if not health.get("ready"):
+        print("Calentando (carga del modelo)...")
+        post(f"{url}/chat", {"prompt": "Hola", "max_tokens": 64})
+        health = get(f"{url}/health")
+    sched = health.get("scheduler", {})
+    print(f"Servidor: {sched.get('max_active', 1)} secuencias activas, presupuesto {sched.get('budget_gb', '?')}GB")
+
+    results, lock, threads = [], threading.Lock(), []
+    t0 = time.perf_counter()
+    for _ in range(args.requests):
+        kind = "long" if rng.random() < args.long_ratio else "short"
+        max_tokens = args.long_tokens if kind == "long" else args.short_tokens
+        t = threading.Thread(target=run_one, args=(url, kind, max_tokens, results, lock))
+        t.start()
+        threads.append(t)
+        time.sleep(rng.expovariate(args.rate))
+    for t in threads:
+        t.join()
+    wall_s = time.perf_counter() - t0
+
+    done = [r for r in results if r["ok"]]
+    print(f"{len(done)}/{len(results)} completadas en {wall_s:.1f}s  "
+          f"throughput {len(done) / wall_s:.3f} req/s  {sum(r['chars'] for r in done) / wall_s:.0f} chars/s")
+    for kind in ("short", "long", "all"):
+        lat = [r["latency_s"] for r in done if kind == "all" or r["kind"] == kind]
+        if lat:
+            print(f"  {kind:5s} n={len(lat):3d}  p50 {statistics.median(lat):7.2f}s  p95 {percentile(lat, 0.95):7.2f}s  max {max(lat):7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,12 @@ import json
 import logging
 import asyncio
 import uuid
+import hashlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from types import SimpleNamespace
 from typing import Optional, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, CancelledError as FutureCancelledError, TimeoutError as FutureTimeoutError
 
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
@@ -25,12 +29,57 @@ os.makedirs(os.path.dirname(DIFFUSION_LOG), exist_ok=True)
 # Ruta local del modelo (ya descargado via LM Studio)
 MODEL_PATH = "/Users/crotalo/.lmstudio/models/mlx-community/diffusiongemma-26B-A4B-it-4bit"
 
+# Streaming SSE (/v1/chat/completions con stream=true)
+STREAM_QUEUE_MAX = 8 # Bloques pendientes de enviar antes de frenar la generación (backpressure)
+STREAM_CLIENT_TIMEOUT = 60.0 # s que el hilo de inferencia espera a un cliente que no lee antes de abortar
+
+# Caché de prefijo por sesión (KV del prompt reutilizado entre turnos)
+PREFIX_CACHE_MAX_SESSIONS = int(os.environ.get("DIFFUSION_PREFIX_SESSIONS", "8"))
+PREFIX_CACHE_MAX_GB = float(os.environ.get("DIFFUSION_PREFIX_CACHE_GB", "6")) # Tope de memoria de los snapshots KV
+PREFIX_CACHE_IDLE_S = 900 # Sesión sin turnos nuevos durante este tiempo -> se libera su KV
+SESSION_KEY_CHARS = 2000 # Sin session_id (y con varios turnos): la sesión se identifica por el inicio del prompt
+
+# Planificador de contexto (prompt + max_tokens redondeado a buckets)
+CONTEXT_BUCKETS = (4096, 8192, 16384, 32768, 65536, 131072, 262144)
+MAX_CONTEXT_TOKENS = CONTEXT_BUCKETS[-1] # max_position_embeddings de DiffusionGemma
+KV_BYTES_PER_ELEMENT = 2 # K/V en bf16
+# Geometría de DiffusionGemma-26B: estimación de KV antes de cargar el modelo (admisión en frío, modo simulado)
+STATIC_MODEL_CONFIG = SimpleNamespace(
+    model_type="diffusion_gemma",
+    eos_token_id=1,
+    canvas_length=256,
+    text_config=SimpleNamespace(
+        num_hidden_layers=30,
+        num_key_value_heads=8,
+        head_dim=256,
+        num_global_key_value_heads=2,
+        global_head_dim=512,
+        sliding_window=1024,
+        layer_types=(["sliding_attention"] * 5 + ["full_attention"]) * 5,
+    ),
+)
+
+# Scheduler (batching continuo a nivel de bloque)
+MAX_ACTIVE_SEQUENCES = int(os.environ.get("DIFFUSION_MAX_ACTIVE", "4")) # Secuencias intercaladas a la vez
+MEMORY_BUDGET_GB = float(os.environ.get("DIFFUSION_MEMORY_BUDGET_GB", "8")) # KV + trabajo de las secuencias activas
+SEQUENCE_OVERHEAD_GB = 0.5 # Canvas, logits y activaciones por secuencia, además del KV
+CHARS_PER_TOKEN_ESTIMATE = 3.5 # Para estimar el prompt antes de tokenizar (admisión)
+QUEUE_MAX_PENDING = 32
+
+# Modo simulado (DIFFUSION_STUB_BLOCK_S > 0): sin modelo ni GPU, bloques temporizados para medir el scheduler
+STUB_BLOCK_S = float(os.environ.get("DIFFUSION_STUB_BLOCK_S", "0")) # s de "GPU" por bloque del canvas
+STUB_PREFILL_TOKENS_PER_S = 2000.0
+
+# Métricas
+METRICS_WINDOW = 200 # Peticiones recientes para percentiles en /metrics
+
 class DiffusionRequest(BaseModel):
     prompt: Optional[str] = None
     system_prompt: Optional[str] = "Eres un asistente experto, conciso y creativo."
     messages: Optional[List[Any]] = None
     temperature: float = 0.5
     max_tokens: int = 3000
+    session_id: Optional[str] = None
 
 # =======================
 # Model Manager (Lazy Loading)
@@ -44,6 +93,9 @@ class DiffusionModelManager:
 
     def load(self):
         with self.lock:
+            if self.model is None and STUB_BLOCK_S > 0:
+                logger.info(f"🧪 Modo simulado: {STUB_BLOCK_S}s por bloque, sin modelo")
+                self.model, self.processor = SimpleNamespace(config=STATIC_MODEL_CONFIG), StubProcessor()
             if self.model is None:
                 import subprocess
                 subprocess.run(["afplay", "/System/Library/Sounds/Ping.aiff"],
@@ -63,19 +115,493 @@ class DiffusionModelManager:
     def is_loaded(self):
         return self.model is not None
 
+# =======================
+# Session Prefix Cache
+# =======================
+
+class SessionPromptCache:
+    """
+    Caché de prefijo por sesión sobre el APC de mlx-vlm. La caché de
+    DiffusionGemma mezcla capas rotativas y globales, así que solo se
+    reutilizan snapshots exactos del KV de un prompt completo: cada sesión
+    guarda el de su último prompt y el turno siguiente (mismo historial +
+    respuesta + mensaje nuevo) prefilea solo el sufijo. Cada sesión tiene su
+    propio espacio (extra_hash) y un único snapshot; las sesiones se desalojan
+    por LRU (PREFIX_CACHE_MAX_SESSIONS), por memoria (PREFIX_CACHE_MAX_GB, lo
+    aplica el APC) y por inactividad (PREFIX_CACHE_IDLE_S).
+    """
+    def __init__(self):
+        self.apc = None
+        self.sessions = OrderedDict() # session_id -> estado, el más reciente al final
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+
+    def _manager(self):
+        if self.apc is None:
+            from mlx_vlm.apc import APCManager
+            self.apc = APCManager(overrides={
+                "checkpoint_entries": PREFIX_CACHE_MAX_SESSIONS,
+                "checkpoint_interval_tokens": 0, # Solo el snapshot final del prompt: uno por sesión
+                "memory_max_gb": PREFIX_CACHE_MAX_GB,
+            })
+        return self.apc
+
+    @staticmethod
+    def session_key(request: DiffusionRequest, messages: list, prompt_text: str) -> Optional[str]:
+        """
+        Sesión de caché de la petición, o None si no se cachea. Sin session_id
+        solo se cachean conversaciones (más de un turno de usuario): las
+        peticiones sueltas no tienen turno siguiente y solo desalojarían
+        sesiones reales del LRU y del presupuesto de memoria.
+        """
+        if request.session_id:
+            return request.session_id
+        if sum(1 for m in messages if m.get("role") == "user") < 2:
+            return None
+        return "auto-" + hashlib.blake2b(prompt_text[:SESSION_KEY_CHARS].encode("utf-8"), digest_size=8).hexdigest()
+
+    def _drop_snapshots(self, extra_hash: int, keep_tokens: Optional[list] = None):
+        # El APC no expone borrado por hash: se recorre su caché exacta con su propio lock.
+        # mlx-vlm guarda el prompt menos exact_cache_guard_tokens, así que el snapshot del
+        # turno es el más largo que sea prefijo de keep_tokens; se borran todos los demás
+        if self.apc is None:
+            return
+        with self.apc.lock:
+            entries = [(k, e) for k, e in self.apc._exact_cache.items() if e.extra_hash == extra_hash]
+            keep_key = None
+            if keep_tokens is not None:
+                prefixes = [(len(e.token_ids), k) for k, e in entries
+                            if len(e.token_ids) <= len(keep_tokens) and tuple(keep_tokens[:len(e.token_ids)]) == tuple(e.token_ids)]
+                keep_key = max(prefixes, key=lambda p: p[0])[1] if prefixes else None
+            for k, _ in entries:
+                if k != keep_key:
+                    del self.apc._exact_cache[k]
+
+    def _evict(self, session_id: str, reason: str):
+        state = self.sessions.pop(session_id)
+        self._drop_snapshots(state["hash"])
+        self.evictions += 1
+        logger.info(f"🧹 Sesión {session_id} liberada ({reason}, {state['turns']} turnos)")
+
+    def acquire(self, session_id: str, token_ids: list) -> tuple:
+        """kwargs de APC para la generación y prefijo común (en tokens) con el turno anterior."""
+        manager = self._manager()
+        now = time.time()
+        with self.lock:
+            for sid in [sid for sid, st in self.sessions.items() if now - st["last_used"] > PREFIX_CACHE_IDLE_S]:
+                self._evict(sid, "inactiva")
+            state = self.sessions.pop(session_id, None)
+            if state is None:
+                digest = hashlib.blake2b(session_id.encode("utf-8"), digest_size=8).digest()
+                state = {"hash": int.from_bytes(digest, "little") >> 1, "tokens": [], "turns": 0, "last_used": now}
+            self.sessions[session_id] = state
+            while len(self.sessions) > PREFIX_CACHE_MAX_SESSIONS:
+                self._evict(next(iter(self.sessions)), "LRU")
+            prev = state["tokens"]
+            common = 0
+            limit = min(len(prev), len(token_ids))
+            while common < limit and prev[common] == token_ids[common]:
+                common += 1
+        return {"_apc_manager": manager, "_apc_semantic_hash": state["hash"]}, common
+
+    def release(self, session_id: str, token_ids: list, cached_tokens: int):
+        with self.lock:
+            state = self.sessions.get(session_id)
+            if state is None:
+                return
+            state["tokens"] = token_ids
+            state["turns"] += 1
+            state["last_used"] = time.time()
+            if cached_tokens:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.reused_tokens += cached_tokens
+            self.prompt_tokens += len(token_ids)
+            # Solo se conserva el snapshot del prompt de este turno (el más nuevo): si dos clientes
+            # comparten sesión implícita, el siguiente turno de cada uno parte del último prompt visto
+            self._drop_snapshots(state["hash"], keep_tokens=token_ids)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "max_sessions": PREFIX_CACHE_MAX_SESSIONS,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+                "reuse_ratio": round(self.reused_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+                "resident_mb": round(self.apc.resident_bytes() / 1e6, 1) if self.apc is not None else 0.0,
+                "max_mb": round(PREFIX_CACHE_MAX_GB * 1024, 1),
+            }
+
+# =======================
+# Context Planner (KV a medida)
+# =======================
+
+class ContextPlanner:
+    """
+    Dimensiona el contexto de cada petición en lugar de suponer 256K: tokens
+    del prompt + max_tokens (en canvas completos, que es como crece la caché
+    de difusión) subido al bucket siguiente. El plan acota max_tokens a lo que
+    cabe en el modelo, estima el KV (las capas globales crecen con el
+    contexto, las sliding se quedan en su ventana) y acumula por bucket el
+    pico de memoria medido con MLX, para saber qué longitudes caben sin swap.
+    El pico de MLX es del proceso: solo cuenta para el bucket si la secuencia
+    corrió sola de principio a fin; el pico global se lleva aparte.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.running = {} # id de ejecución -> {"solo": bool}
+        self.next_run = 0
+        self.process_peak_gb = 0.0
+
+    @staticmethod
+    def kv_bytes(config, tokens: int) -> int:
+        text = getattr(config, "text_config", config)
+        window = getattr(text, "sliding_window", None) or tokens
+        layer_types = getattr(text, "layer_types", None) or ["full_attention"] * text.num_hidden_layers
+        total = 0
+        for layer_type in layer_types:
+            if layer_type == "full_attention":
+                heads = getattr(text, "num_global_key_value_heads", None) or text.num_key_value_heads
+                dim = getattr(text, "global_head_dim", None) or text.head_dim
+                total += 2 * heads * dim * tokens
+            else:
+                total += 2 * text.num_key_value_heads * text.head_dim * min(tokens, window)
+        return total * KV_BYTES_PER_ELEMENT
+
+    def plan(self, config, prompt_tokens: int, max_tokens: int) -> dict:
+        if prompt_tokens >= MAX_CONTEXT_TOKENS:
+            raise ValueError(f"Prompt de {prompt_tokens} tokens: excede el contexto del modelo ({MAX_CONTEXT_TOKENS})")
+        canvas = getattr(config, "canvas_length", None) or 1
+        max_tokens = min(max_tokens, MAX_CONTEXT_TOKENS - prompt_tokens)
+        needed = min(prompt_tokens + -(-max_tokens // canvas) * canvas, MAX_CONTEXT_TOKENS)
+        bucket = next(b for b in CONTEXT_BUCKETS if b >= needed)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "max_tokens": max_tokens,
+            "context_tokens": needed,
+            "bucket": bucket,
+            "kv_estimate_gb": round(self.kv_bytes(config, bucket) / 1e9, 3),
+        }
+
+    def estimate_gb(self, config, prompt_tokens: int, max_tokens: int) -> float:
+        """Memoria de una secuencia para la admisión: KV del bucket + trabajo fijo."""
+        plan = self.plan(config, min(prompt_tokens, MAX_CONTEXT_TOKENS - 1), max_tokens)
+        return plan["kv_estimate_gb"] + SEQUENCE_OVERHEAD_GB
+
+    def begin(self, mx) -> dict:
+        """Registra una generación; el pico de MLX solo se reinicia si no hay otra en curso."""
+        with self.lock:
+            run = {"id": self.next_run, "solo": not self.running}
+            self.next_run += 1
+            for other in self.running.values():
+                other["solo"] = False
+            if run["solo"]:
+                self.process_peak_gb = max(self.process_peak_gb, mx.get_peak_memory() / 1e9)
+                mx.reset_peak_memory()
+            self.running[run["id"]] = run
+        return run
+
+    def observe(self, run: dict, plan: dict, peak_gb: float):
+        with self.lock:
+            self.running.pop(run["id"], None)
+            self.process_peak_gb = max(self.process_peak_gb, peak_gb)
+            b = self.buckets.setdefault(plan["bucket"], {"requests": 0, "shared": 0, "peak_gb_max": 0.0, "peak_gb_sum": 0.0,
+                                                         "kv_estimate_gb": plan["kv_estimate_gb"]})
+            if not run["solo"]: # Intercalada con otras: su pico incluye memoria ajena
+                b["shared"] += 1
+                return
+            b["requests"] += 1
+            b["peak_gb_max"] = max(b["peak_gb_max"], peak_gb)
+            b["peak_gb_sum"] += peak_gb
+
+    def peak_gb(self) -> float:
+        with self.lock:
+            return round(self.process_peak_gb, 2)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                str(bucket): {
+                    "requests": b["requests"],
+                    "shared": b["shared"],
+                    "peak_gb_max": round(b["peak_gb_max"], 2),
+                    "peak_gb_avg": round(b["peak_gb_sum"] / b["requests"], 2) if b["requests"] else 0.0,
+                    "kv_estimate_gb": b["kv_estimate_gb"],
+                }
+                for bucket, b in sorted(self.buckets.items())
+            }
+
+# =======================
+# Streaming (hilo de inferencia -> SSE)
+# =======================
+
+class TokenStream:
+    """
+    Puente entre el hilo de inferencia y la respuesta SSE: cola asyncio acotada.
+    El hilo se bloquea en put() mientras la cola está llena, así la generación
+    avanza al ritmo del cliente; si el cliente se va (o deja de leer durante
+    STREAM_CLIENT_TIMEOUT) se marca como cancelado y la inferencia se corta.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=STREAM_QUEUE_MAX)
+        self.cancelled = threading.Event()
+        self.pending_put = None # put() en curso, para que cancel() lo despierte
+
+    def put(self, delta: str) -> bool:
+        """Desde el hilo de inferencia. False si hay que dejar de generar."""
+        if self.cancelled.is_set():
+            return False
+        fut = asyncio.run_coroutine_threadsafe(self.queue.put(delta), self.loop)
+        self.pending_put = fut
+        if self.cancelled.is_set(): # cancel() pudo llegar entre la comprobación y el registro
+            fut.cancel()
+        try:
+            fut.result(timeout=STREAM_CLIENT_TIMEOUT)
+            return True
+        except (FutureTimeoutError, FutureCancelledError):
+            fut.cancel()
+            self.cancel()
+            return False
+        finally:
+            self.pending_put = None
+
+    def cancel(self):
+        self.cancelled.set()
+        fut = self.pending_put
+        if fut is not None:
+            fut.cancel()
+
+    async def deltas(self, fut: asyncio.Future):
+        """Bloques de texto según llegan, hasta que la tarea termina."""
+        while True:
+            get = asyncio.ensure_future(self.queue.get())
+            try:
+                await asyncio.wait({get, fut}, return_when=asyncio.FIRST_COMPLETED)
+            except BaseException: # Respuesta SSE cerrada a mitad de espera
+                get.cancel()
+                raise
+            if get.done():
+                yield get.result()
+                continue
+            get.cancel()
+            # La tarea terminó: todo put() ya se completó, solo queda vaciar la cola
+            while not self.queue.empty():
+                yield self.queue.get_nowait()
+            return
+
+def hand_off_block(stream: Optional[TokenStream], turn, delta: str) -> bool:
+    """
+    Frontera de bloque: entrega `delta` al stream y cede la GPU. La entrega
+    se hace con el turno suelto, así un cliente lento (backpressure) no
+    frena al resto de secuencias activas. False si el cliente se fue.
+    """
+    delivered = True
+
+    def flush():
+        nonlocal delivered
+        if stream is not None and delta:
+            delivered = stream.put(delta)
+
+    if turn is not None:
+        turn(flush)
+    else:
+        flush()
+    return delivered
+
+# =======================
+# Modelo simulado (benchmark del scheduler sin GPU)
+# =======================
+
+class StubProcessor:
+    """Plantilla de chat mínima y tokenizer aproximado (CHARS_PER_TOKEN_ESTIMATE caracteres por token)."""
+    def __init__(self):
+        self.tokenizer = self
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        text = "".join(f"<start_of_turn>{m['role']}\n{m['content']}<end_of_turn>\n" for m in messages)
+        return text + ("<start_of_turn>model\n" if add_generation_prompt else "")
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> list:
+        return [0] * int(len(text) / CHARS_PER_TOKEN_ESTIMATE)
+
+@dataclass
+class StubResult:
+    text: str
+    prompt_tokens: int
+    generation_tokens: int
+    cached_tokens: int = 0
+    finish_reason: Optional[str] = None
+
+def stub_generation(model, processor, prompt_text: str, request: DiffusionRequest, stream: Optional[TokenStream] = None,
+                    session_id: Optional[str] = None, turn=None):
+    """Misma interfaz que run_generation: prefill proporcional al prompt y un sleep por bloque con el turno tomado."""
+    prompt_tokens = len(processor.tokenizer.encode(prompt_text))
+    plan = context_planner.plan(model.config, prompt_tokens, request.max_tokens)
+    start = time.perf_counter()
+    time.sleep(prompt_tokens / STUB_PREFILL_TOKENS_PER_S)
+    prefill_s = time.perf_counter() - start
+    canvas = model.config.canvas_length
+    text, generated, turn_wait, finish_reason = "", 0, 0.0, "length"
+    while generated < plan["max_tokens"]:
+        time.sleep(STUB_BLOCK_S)
+        n = min(canvas, plan["max_tokens"] - generated)
+        generated += n
+        block = "bloque " * max(1, int(n * CHARS_PER_TOKEN_ESTIMATE / 7))
+        text += block
+        t_turn = time.perf_counter()
+        delivered = hand_off_block(stream, turn, block)
+        turn_wait += time.perf_counter() - t_turn
+        if not delivered:
+            finish_reason = "cancelled"
+            break
+    plan["peak_memory_gb"] = 0.0
+    plan["peak_memory_exclusive"] = None
+    timing = {
+        "prefill_s": round(prefill_s, 3),
+        "generation_s": round(max(time.perf_counter() - start - prefill_s - turn_wait, 0.0), 3),
+        "turn_wait_s": round(turn_wait, 3),
+    }
+    return StubResult(text=text, prompt_tokens=prompt_tokens, generation_tokens=generated, finish_reason=finish_reason), plan, timing
+
+def run_generation(model, processor, prompt_text: str, request: DiffusionRequest, stream: Optional[TokenStream] = None,
+                   session_id: Optional[str] = None, turn=None):
+    """
+    Equivalente a mlx_vlm.generate sobre la ruta de difusión, pero con callback
+    on_result: sin él mlx-vlm acumula los resultados y no entrega nada hasta el
+    final. Con `stream`, cada bloque del canvas ya desenmascarado (texto
+    definitivo) se envía en cuanto termina su denoising; los borradores
+    intermedios no se emiten. Devolver False desde el callback corta la generación.
+    Con `session_id`, el prefijo ya visto en la sesión sale de la caché de prefijo.
+    `turn(work)` se llama en cada frontera de bloque para ceder la GPU a otra
+    secuencia (ejecutando `work`, la entrega al stream, sin el turno).
+    Devuelve (resultado, plan de contexto con el pico de memoria medido, tiempos):
+    prefill y generación en segundos de GPU (la espera de turno y de cliente va aparte).
+    """
+    import mlx.core as mx
+    from mlx_vlm.generate.common import GenerationResult
+    from mlx_vlm.generate.diffusion import stream_diffusion_generate_from_kwargs
+    from mlx_vlm.utils import prepare_inputs, should_add_special_tokens
+
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    tokenizer.stopping_criteria.reset(model.config.eos_token_id)
+    inputs = prepare_inputs(
+        processor,
+        prompts=prompt_text,
+        add_special_tokens=should_add_special_tokens(model.config.model_type, processor),
+    )
+    token_ids = [int(t) for t in inputs["input_ids"][0].tolist()]
+    plan = context_planner.plan(model.config, len(token_ids), request.max_tokens)
+    if plan["max_tokens"] < request.max_tokens:
+        logger.warning(f"⚠️ max_tokens {request.max_tokens} -> {plan['max_tokens']} (contexto del modelo: {MAX_CONTEXT_TOKENS})")
+    gen_kwargs = {"max_tokens": plan["max_tokens"], "temperature": request.temperature}
+    if session_id is not None:
+        apc_kwargs, common = prefix_cache.acquire(session_id, token_ids)
+        gen_kwargs.update(apc_kwargs)
+
+    text, pending, last = "", "", None
+    turn_wait = 0.0
+
+    def on_result(response) -> bool:
+        nonlocal text, pending, last, turn_wait
+        if response.is_draft:
+            return True
+        text += response.text
+        pending += response.text
+        last = response
+        if not (response.diffusion_block_complete or response.finish_reason):
+            return True
+        # Primero se entrega el bloque y después se recupera el turno (espera de cliente y de GPU aparte)
+        t_turn = time.perf_counter()
+        delivered = hand_off_block(stream, turn, pending)
+        turn_wait += time.perf_counter() - t_turn
+        pending = ""
+        if not delivered:
+            logger.warning("🔌 Cliente de streaming desconectado. Generación abortada.")
+            return False
+        return True
+
+    run = context_planner.begin(mx)
+    gen_start = time.perf_counter()
+    try:
+        results = stream_diffusion_generate_from_kwargs(
+            model,
+            processor,
+            tokenizer,
+            inputs["input_ids"],
+            None,
+            inputs.get("attention_mask"),
+            [],
+            gen_kwargs,
+            on_result=on_result,
+        )
+        try:
+            for _ in results:
+                pass
+        finally:
+            results.close()
+    finally:
+        # Con varias secuencias intercaladas el pico es del proceso (incluye el KV de las demás)
+        plan["peak_memory_gb"] = round(mx.get_peak_memory() / 1e9, 2)
+        plan["peak_memory_exclusive"] = run["solo"]
+        context_planner.observe(run, plan, plan["peak_memory_gb"])
+    wall_s = time.perf_counter() - gen_start
+    # mlx-vlm mide el prefill (antes del primer bloque, sin cesiones de turno); el resto es generación
+    prefill_s = last.prompt_tokens / last.prompt_tps if last is not None and last.prompt_tps else 0.0
+    timing = {
+        "prefill_s": round(prefill_s, 3),
+        "generation_s": round(max(wall_s - prefill_s - turn_wait, 0.0), 3),
+        "turn_wait_s": round(turn_wait, 3),
+    }
+
+    logger.info(f"📐 Contexto {plan['context_tokens']} tokens -> bucket {plan['bucket']} | "
+                f"KV est. {plan['kv_estimate_gb']}GB | pico {plan['peak_memory_gb']}GB"
+                f"{'' if run['solo'] else ' (compartido con otras secuencias)'}")
+    cached_tokens = last.cached_tokens if last is not None else 0
+    if session_id is not None:
+        prefix_cache.release(session_id, token_ids, cached_tokens)
+        logger.info(f"♻️ Sesión {session_id}: {cached_tokens}/{len(token_ids)} tokens de prompt desde caché "
+                    f"(prefijo común con el turno anterior: {common})")
+
+    clean_output = getattr(processor, "clean_output", None)
+    if callable(clean_output):
+        text = clean_output(text)
+    if last is None:
+        return GenerationResult(text=text), plan, timing
+    finish_reason = "cancelled" if stream is not None and stream.cancelled.is_set() else last.finish_reason
+    return GenerationResult(
+        text=text,
+        prompt_tokens=last.prompt_tokens,
+        generation_tokens=last.generation_tokens,
+        total_tokens=last.total_tokens,
+        prompt_tps=last.prompt_tps,
+        generation_tps=last.generation_tps,
+        peak_memory=last.peak_memory,
+        cached_tokens=cached_tokens,
+        finish_reason=finish_reason,
+    ), plan, timing
+
 # =======================
 # Inference Engine (Diffusion Text)
 # =======================
 
-def perform_diffusion_inference(request: DiffusionRequest, task_id: str):
+def perform_diffusion_inference(request: DiffusionRequest, task_id: str, stream: Optional[TokenStream] = None, turn=None,
+                                queue_wait: float = 0.0):
     start_t = time.perf_counter()
     logger.info(f"🧬 [DIFFUSION] Task: {task_id} | Tokens: {request.max_tokens}")
 
     try:
         model, processor = model_manager.get_model()
 
-        from mlx_vlm import generate
-
         if request.messages:
             # Si nos pasan mensajes estructurados (como de OpenAI)
             messages = []
@@ -98,19 +624,30 @@ def perform_diffusion_inference(request: DiffusionRequest, task_id: str):
             add_generation_prompt=True
         )
 
-        # Generar respuesta con ventana de contexto de 256K tokens (262144)
-        output = generate(
-            model,
-            processor,
-            prompt=prompt_text,
-            max_tokens=request.max_tokens,
-            temp=request.temperature,
-            verbose=False,
-            max_kv_size=262144,
-        )
+        # Generar respuesta (bloque a bloque si hay streaming), reutilizando el prefijo de la sesión
+        session_id = SessionPromptCache.session_key(request, messages, prompt_text)
+        generate = stub_generation if STUB_BLOCK_S > 0 else run_generation
+        output, plan, timing = generate(model, processor, prompt_text, request, stream, session_id, turn)
 
         dt = time.perf_counter() - start_t
 
+        # Conteo real con el tokenizer del procesador: el prompt ya viene tokenizado (input_ids);
+        # la salida se re-tokeniza porque mlx-vlm cuenta posiciones del canvas, no tokens emitidos
+        tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+        prompt_tokens = output.prompt_tokens or len(tokenizer.encode(prompt_text, add_special_tokens=False))
+        completion_tokens = len(tokenizer.encode(output.text, add_special_tokens=False)) if output.text else 0
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cached_tokens": output.cached_tokens,
+        }
+        timing["queue_wait_s"] = round(queue_wait, 3)
+        timing["tokens_per_s"] = round(completion_tokens / timing["generation_s"], 2) if timing["generation_s"] else 0.0
+        prefilled = max(prompt_tokens - output.cached_tokens, 0)
+        timing["prefill_tokens_per_s"] = round(prefilled / timing["prefill_s"], 2) if timing["prefill_s"] else 0.0
+        metrics.record(usage, timing, dt)
+
         # Log accounting
         with open(DIFFUSION_LOG, "a") as f:
             log_entry = {
@@ -119,11 +656,21 @@ def perform_diffusion_inference(request: DiffusionRequest, task_id: str):
                 "model": "diffusiongemma-26B-A4B-it-4bit",
                 "mode": "DIFFUSION",
                 "duration": round(dt, 2),
-                "max_tokens": request.max_tokens
+                "max_tokens": request.max_tokens,
+                "stream": stream is not None,
+                "session_id": session_id,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cached_tokens": output.cached_tokens,
+                "finish_reason": output.finish_reason,
+                **timing,
+                "context_bucket": plan["bucket"],
+                "peak_memory_gb": plan["peak_memory_gb"]
             }
             f.write(json.dumps(log_entry) + "\n")
 
-        logger.info(f"✅ Success [{task_id}] in {round(dt, 2)}s")
+        logger.info(f"✅ Success [{task_id}] in {round(dt, 2)}s | {prompt_tokens}+{completion_tokens} tokens | "
+                    f"cola {timing['queue_wait_s']}s, prefill {timing['prefill_s']}s, {timing['tokens_per_s']} tok/s")
         return {
             "status": "success",
             "task_id": task_id,
@@ -131,22 +678,140 @@ def perform_diffusion_inference(request: DiffusionRequest, task_id: str):
             "meta": {
                 "duration": round(dt, 2),
                 "model": "diffusiongemma-26B-A4B-it-4bit",
-                "engine": "mlx-vlm"
+                "engine": "mlx-vlm",
+                "usage": usage,
+                "timing": timing,
+                "context": plan
             }
         }
 
     except Exception as e:
         logger.error(f"💥 Diffusion error [{task_id}]: {e}")
+        metrics.record_error()
         return {"status": "error", "task_id": task_id, "message": str(e)}
 
 # =======================
 # API & Queue Manager
 # =======================
 
+class ServerMetrics:
+    """
+    Contadores acumulados desde el arranque y ventana de las últimas
+    peticiones (percentiles) para planificar capacidad con el throughput real.
+    """
+    def __init__(self, window=METRICS_WINDOW):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.totals = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                       "queue_wait_s": 0.0, "prefill_s": 0.0, "generation_s": 0.0, "duration_s": 0.0}
+        self.recent = deque(maxlen=window)
+
+    def record(self, usage: dict, timing: dict, duration: float):
+        with self.lock:
+            self.requests += 1
+            for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                self.totals[key] += usage[key]
+            for key in ("queue_wait_s", "prefill_s", "generation_s"):
+                self.totals[key] += timing[key]
+            self.totals["duration_s"] += duration
+            self.recent.append({"tokens_per_s": timing["tokens_per_s"], "queue_wait_s": timing["queue_wait_s"],
+                                "prefill_s": timing["prefill_s"], "duration_s": duration})
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    @staticmethod
+    def _percentiles(values: list) -> dict:
+        if not values:
+            return {"p50": 0.0, "p95": 0.0}
+        values = sorted(values)
+        pick = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+        return {"p50": round(pick(0.5), 3), "p95": round(pick(0.95), 3)}
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            totals = {k: round(v, 3) for k, v in self.totals.items()}
+            recent = list(self.recent)
+        gen_s = totals["generation_s"]
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "errors": self.errors,
+            "totals": totals,
+            "tokens_per_s": round(totals["completion_tokens"] / gen_s, 2) if gen_s else 0.0,
+            "recent": {
+                "n": len(recent),
+                **{key: self._percentiles([r[key] for r in recent])
+                   for key in ("tokens_per_s", "queue_wait_s", "prefill_s", "duration_s")},
+            },
+        }
+
+class BlockTurns:
+    """
+    Turno de GPU entre las secuencias activas: solo una ejecuta MLX a la vez
+    (se mantiene la protección térmica del worker único) y cede el turno en
+    cada frontera de bloque, en orden de llegada (round-robin).
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiting = deque()
+        self.holder = None
+
+    def acquire(self, seq_id: str):
+        with self.cond:
+            self.waiting.append(seq_id)
+            while self.holder is not None or self.waiting[0] != seq_id:
+                self.cond.wait()
+            self.waiting.popleft()
+            self.holder = seq_id
+
+    def release(self, seq_id: str):
+        with self.cond:
+            if self.holder == seq_id:
+                self.holder = None
+                self.cond.notify_all()
+
+    def yield_turn(self, seq_id: str, work=None):
+        """Cede el turno si alguien espera; `work` (E/S sin GPU) se ejecuta siempre con el turno suelto."""
+        with self.cond:
+            if not self.waiting and work is None: # Nadie esperando: se sigue sin soltar la GPU
+                return
+        self.release(seq_id)
+        try:
+            if work is not None:
+                work()
+        finally:
+            self.acquire(seq_id)
+
+def estimate_prompt_tokens(req: DiffusionRequest) -> int:
+    chars = len(req.prompt or "") + len(req.system_prompt or "")
+    for msg in req.messages or []:
+        content = msg.get("content") if isinstance(msg, dict) else getattr(msg, "content", "")
+        chars += len(content or "")
+    return int(chars / CHARS_PER_TOKEN_ESTIMATE)
+
 class DiffusionQueueManager:
-    def __init__(self, idle_timeout=1200):
-        self.queue = asyncio.Queue(maxsize=5)
-        self.executor = ThreadPoolExecutor(max_workers=1)  # Serializado para protección térmica
+    """
+    Batching continuo a nivel de bloque. mlx-vlm genera DiffusionGemma con
+    batch 1, así que en lugar de un forward por lotes se intercalan varias
+    secuencias activas: cada una mantiene su KV residente, entra y sale en
+    fronteras de bloque y la GPU pasa de una a otra por turnos. Una petición
+    corta ya no espera a que termine una larga. La admisión la decide el
+    presupuesto de memoria (estimación del planificador de contexto) y el
+    tope de secuencias activas; el resto espera en cola.
+    """
+    def __init__(self, idle_timeout=1200, max_active=MAX_ACTIVE_SEQUENCES, budget_gb=MEMORY_BUDGET_GB):
+        self.queue = asyncio.Queue(maxsize=QUEUE_MAX_PENDING)
+        self.executor = ThreadPoolExecutor(max_workers=max_active) # Un hilo por secuencia activa; la GPU la reparte BlockTurns
+        self.turns = BlockTurns()
+        self.max_active = max_active
+        self.budget_gb = budget_gb
+        self.active = {} # task_id -> GB reservados
+        self.capacity = asyncio.Condition()
+        self.admitting = None # Cabeza de la cola esperando hueco
         self.is_processing = False
         self.last_activity = time.time()
         self.idle_timeout = idle_timeout
@@ -157,34 +822,84 @@ class DiffusionQueueManager:
         while True:
             await asyncio.sleep(10)
             elapsed = time.time() - self.last_activity
-            if elapsed > self.idle_timeout:
+            if elapsed > self.idle_timeout and not self.active:
                 logger.warning(f"😴 Inactividad detectada ({round(elapsed, 1)}s). Apagando servidor...")
                 os._exit(0)
 
+    async def submit(self, req: DiffusionRequest, task_id: str, stream: Optional[TokenStream] = None) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self.queue.put((req, task_id, fut, stream, time.perf_counter())), timeout=5.0)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Cola llena. Intente más tarde.")
+        return fut
+
+    def _fits(self, need_gb: float) -> bool:
+        if not self.active: # Siempre cabe una (aunque supere el presupuesto)
+            return True
+        return len(self.active) < self.max_active and sum(self.active.values()) + need_gb <= self.budget_gb
+
     async def worker(self):
         while True:
-            try:
-                task = await asyncio.wait_for(self.queue.get(), timeout=1.0)
-                self.is_processing = True
-                req, task_id, fut = task
-                try:
-                    res = await asyncio.get_running_loop().run_in_executor(
-                        self.executor, perform_diffusion_inference, req, task_id
-                    )
-                    if not fut.done():
-                        fut.set_result(res)
-                except Exception as e:
-                    if not fut.done():
-                        fut.set_exception(e)
-                finally:
-                    self.queue.task_done()
-                    self.is_processing = False
-                    self.last_activity = time.time()
-            except asyncio.TimeoutError:
-                pass
+            req, task_id, fut, stream, enqueued = await self.queue.get()
+            # Con el modelo aún sin cargar se estima con la geometría estática (no se admite a ciegas)
+            config = model_manager.model.config if model_manager.is_loaded() else STATIC_MODEL_CONFIG
+            need_gb = context_planner.estimate_gb(config, estimate_prompt_tokens(req), req.max_tokens)
+            self.admitting = task_id
+            async with self.capacity:
+                await self.capacity.wait_for(lambda: self._fits(need_gb)) # FIFO: la cabeza espera hueco
+                self.active[task_id] = need_gb
+            self.admitting = None
+            self.is_processing = True
+            logger.info(f"📥 Admitida [{task_id}] ({need_gb:.2f}GB) | activas: {len(self.active)} | "
+                        f"reservado: {sum(self.active.values()):.2f}/{self.budget_gb}GB | en cola: {self.queue.qsize()}")
+            asyncio.create_task(self._run(req, task_id, fut, stream, enqueued))
+
+    def _run_sequence(self, req: DiffusionRequest, task_id: str, stream: Optional[TokenStream], enqueued: float):
+        self.turns.acquire(task_id)
+        queue_wait = time.perf_counter() - enqueued # Cola + admisión + primer turno de GPU
+        try:
+            turn = lambda work=None: self.turns.yield_turn(task_id, work)
+            return perform_diffusion_inference(req, task_id, stream, turn, queue_wait)
+        finally:
+            self.turns.release(task_id)
+
+    async def _run(self, req: DiffusionRequest, task_id: str, fut: asyncio.Future, stream: Optional[TokenStream], enqueued: float):
+        try:
+            if stream is not None and stream.cancelled.is_set():
+                # El cliente de streaming se fue mientras esperaba en cola
+                res = {"status": "error", "task_id": task_id, "message": "Cliente desconectado"}
+            else:
+                res = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._run_sequence, req, task_id, stream, enqueued
+                )
+            if not fut.done():
+                fut.set_result(res)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        finally:
+            async with self.capacity:
+                self.active.pop(task_id, None)
+                self.capacity.notify_all()
+            self.queue.task_done()
+            self.is_processing = bool(self.active)
+            self.last_activity = time.time()
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self.active),
+            "max_active": self.max_active,
+            "reserved_gb": round(sum(self.active.values()), 2),
+            "budget_gb": self.budget_gb,
+            "pending": self.queue.qsize() + (self.admitting is not None),
+        }
 
 app = FastAPI()
 model_manager = DiffusionModelManager()
+prefix_cache = SessionPromptCache()
+context_planner = ContextPlanner()
+metrics = ServerMetrics()
 queue_mgr = DiffusionQueueManager(idle_timeout=1200)
 
 @app.on_event("startup")
@@ -199,20 +914,26 @@ async def health():
         "status": "ok",
         "ready": model_manager.is_loaded(),
         "model": "diffusiongemma-26B-A4B-it-4bit",
-        "engine": "mlx-vlm"
+        "engine": "mlx-vlm",
+        "scheduler": queue_mgr.stats(),
+        "prefix_cache": prefix_cache.stats(),
+        "context_buckets": context_planner.stats(),
+        "process_peak_gb": context_planner.peak_gb() # Pico del proceso con secuencias intercaladas
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "model": "diffusiongemma-26B-A4B-it-4bit",
+        **metrics.snapshot(),
+        "scheduler": queue_mgr.stats(),
+        "prefix_cache": prefix_cache.stats(),
     }
 
 @app.post("/chat")
 async def chat(request: DiffusionRequest):
     task_id = str(uuid.uuid4())[:8]
-    fut = asyncio.get_running_loop().create_future()
-    try:
-        await asyncio.wait_for(
-            queue_mgr.queue.put((request, task_id, fut)),
-            timeout=5.0
-        )
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=503, detail="Cola llena. Intente más tarde.")
+    fut = await queue_mgr.submit(request, task_id)
     result = await fut
     return result
 
@@ -227,6 +948,16 @@ class OpenAICompletionRequest(BaseModel):
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = 1000
     stream: Optional[bool] = False
+    session_id: Optional[str] = None # Extensión: agrupa turnos para la caché de prefijo
+
+def openai_usage(result: dict) -> dict:
+    usage = result["meta"]["usage"]
+    return {
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "total_tokens": usage["total_tokens"],
+        "prompt_tokens_details": {"cached_tokens": usage["cached_tokens"]}
+    }
 
 @app.post("/v1/chat/completions")
 async def openai_chat_completions(req: OpenAICompletionRequest):
@@ -234,58 +965,18 @@ async def openai_chat_completions(req: OpenAICompletionRequest):
     diffusion_req = DiffusionRequest(
         messages=req.messages,
         temperature=req.temperature if req.temperature is not None else 0.7,
-        max_tokens=req.max_tokens if req.max_tokens is not None else 1000
+        max_tokens=req.max_tokens if req.max_tokens is not None else 1000,
+        session_id=req.session_id
     )
     
     task_id = str(uuid.uuid4())[:8]
-    fut = asyncio.get_running_loop().create_future()
-    
-    try:
-        await asyncio.wait_for(
-            queue_mgr.queue.put((diffusion_req, task_id, fut)),
-            timeout=5.0
-        )
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=503, detail="Cola llena. Intente más tarde.")
-        
-    result = await fut
-    
-    if result.get("status") == "error":
-        raise HTTPException(status_code=500, detail=result.get("message"))
-        
-    response_text = result["response"]
-    if hasattr(response_text, "text"):
-        response_text = response_text.text
-    elif isinstance(response_text, dict):
-        response_text = response_text.get("text", "")
-    else:
-        response_text = str(response_text)
-        
+    stream = TokenStream(asyncio.get_running_loop()) if req.stream else None
+    fut = await queue_mgr.submit(diffusion_req, task_id, stream)
+
     if req.stream:
-        # Si pide streaming, simulamos una respuesta SSE
-        async def sse_generator():
-            created_time = int(time.time())
-            # Chunk 1: El texto generado
-            chunk_data_1 = {
-                "id": f"chatcmpl-{task_id}",
-                "object": "chat.completion.chunk",
-                "created": created_time,
-                "model": req.model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "role": "assistant",
-                            "content": response_text
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            yield f"data: {json.dumps(chunk_data_1)}\n\n"
-            
-            # Chunk 2: Finalización de la generación (finish_reason = stop)
-            chunk_data_2 = {
+        # Streaming real: cada bloque desenmascarado sale como un chunk SSE según se genera
+        def sse_chunk(delta: dict, finish_reason: Optional[str] = None, usage: Optional[dict] = None) -> str:
+            chunk_data = {
                 "id": f"chatcmpl-{task_id}",
                 "object": "chat.completion.chunk",
                 "created": created_time,
@@ -293,37 +984,64 @@ async def openai_chat_completions(req: OpenAICompletionRequest):
                 "choices": [
                     {
                         "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
+                        "delta": delta,
+                        "finish_reason": finish_reason
                     }
                 ]
             }
-            yield f"data: {json.dumps(chunk_data_2)}\n\n"
-            yield "data: [DONE]\n\n"
-            
+            if usage is not None:
+                chunk_data["usage"] = usage
+            return f"data: {json.dumps(chunk_data)}\n\n"
+
+        created_time = int(time.time())
+
+        async def sse_generator():
+            try:
+                yield sse_chunk({"role": "assistant", "content": ""})
+                async for delta in stream.deltas(fut):
+                    yield sse_chunk({"content": delta})
+                result = fut.result()
+                if result.get("status") == "error":
+                    yield f"data: {json.dumps({'error': {'message': result.get('message'), 'type': 'server_error'}})}\n\n"
+                else:
+                    yield sse_chunk({}, result["response"].finish_reason or "stop", openai_usage(result))
+                yield "data: [DONE]\n\n"
+            finally:
+                # Cliente desconectado (o fin normal): el hilo de inferencia deja de generar
+                stream.cancel()
+
         return StreamingResponse(sse_generator(), media_type="text/event-stream")
+
+    result = await fut
+    
+    if result.get("status") == "error":
+        raise HTTPException(status_code=500, detail=result.get("message"))
+        
+    response_text = result["response"]
+    if hasattr(response_text, "text"):
+        response_text = response_text.text
+    elif isinstance(response_text, dict):
+        response_text = response_text.get("text", "")
     else:
-        return {
-            "id": f"chatcmpl-{task_id}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": req.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": response_text
-                    },
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": -1,
-                "completion_tokens": -1,
-                "total_tokens": -1
+        response_text = str(response_text)
+
+    return {
+        "id": f"chatcmpl-{task_id}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": req.model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": response_text
+                },
+                "finish_reason": getattr(result["response"], "finish_reason", None) or "stop"
             }
-        }
+        ],
+        "usage": openai_usage(result)
+    }
 
 @app.get("/v1/models")
 async def list_models():
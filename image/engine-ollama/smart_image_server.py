@@ -7,8 +7,12 @@ import uuid
 import base64
 import urllib.request
 import urllib.error
+import urllib.parse
+import http.client
+import socket
 import signal
 import sys
+import threading
 from typing import Optional
 from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel
@@ -64,6 +68,7 @@ def apply_geometric_firewall(width: int, height: int) -> tuple[int, int]:
 OUTPUT_DIR = "/Users/crotalo/desarrollo-local/server/image/outputs"
 PROMPT_LOG = "/Users/crotalo/desarrollo-local/server/logs/image/prompts.log"
 OLLAMA_URL = "http://localhost:11434/api/generate"
+DISCONNECT_POLL_SECONDS = 0.5
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(os.path.dirname(PROMPT_LOG), exist_ok=True)
@@ -101,12 +106,64 @@ def log_inference(task_id: str, request: ImageRequest, status: str, duration: fl
     except Exception as e:
         logger.error(f"Failed to write to prompt log: {e}")
 
+# =======================
+# Cancellation
+# =======================
+
+class CancelToken:
+    """
+    Token de cancelación por tarea. cancel() ejecuta los callbacks registrados
+    (p.ej. abortar la conexión HTTP con Ollama) desde el hilo que cancela.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as e:
+                logger.warning(f"Cancel callback failed: {e}")
+
+
+def _abort_connection(conn: http.client.HTTPConnection):
+    """Corta el socket: el recv bloqueado del worker vuelve al instante y Ollama ve el cierre."""
+    sock = conn.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def cancelled_result(task_id: str) -> dict:
+    return {"status": "cancelled", "task_id": task_id}
+
 # =======================
 # Inference Engine (Raw API)
 # =======================
 
-def perform_image_inference(request: ImageRequest, task_id: str):
+def perform_image_inference(request: ImageRequest, task_id: str, cancel_token: Optional[CancelToken] = None):
     start_t = time.perf_counter()
+    cancel_token = cancel_token or CancelToken()
     logger.info(f"🎨 [RAW API] Task: {task_id} | {request.model} | {request.width}x{request.height}")
     
     try:
@@ -163,27 +220,45 @@ def perform_image_inference(request: ImageRequest, task_id: str):
         payload["keep_alive"] = "5m"
 
         data = json.dumps(payload).encode('utf-8')
-        req = urllib.request.Request(OLLAMA_URL, data=data, headers={'Content-Type': 'application/json'})
-        
+        url = urllib.parse.urlsplit(OLLAMA_URL)
+
+        # http.client en vez de urlopen: necesitamos el socket para poder abortarlo
+        # desde /cancel o al desconectarse el cliente (Ollama deja de generar al cerrarse la conexión).
         # Timeout largo pero controlado
-        with urllib.request.urlopen(req, timeout=300) as response:
-            resp_body = json.loads(response.read().decode('utf-8'))
-            
-            img_b64 = resp_body.get('image')
-            if not img_b64 and resp_body.get('images'):
-                img_b64 = resp_body['images'][0]
-            
-            file_name = f"gen_{task_id}.png"
-            file_path = os.path.join(OUTPUT_DIR, file_name)
-            
-            if img_b64:
-                if "," in img_b64: img_b64 = img_b64.split(",")[1]
-                with open(file_path, "wb") as f:
-                    f.write(base64.b64decode(img_b64))
-                status = "SUCCESS"
-            else:
-                logger.error(f"❌ No image data in Ollama response. Keys: {list(resp_body.keys())}")
-                status = "ERROR_NO_IMAGE"
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=300)
+        try:
+            # Conexión explícita antes de registrar el abort: con conn.sock aún a None
+            # una cancelación no cortaría nada y Ollama generaría hasta el final
+            conn.connect()
+            cancel_token.on_cancel(lambda: _abort_connection(conn))
+            if cancel_token.is_cancelled():
+                raise ConnectionAbortedError("cancelled before request")
+            conn.request("POST", url.path, body=data, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            raw_body = response.read()
+        finally:
+            conn.close()
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(OLLAMA_URL, response.status, response.reason, response.headers, io.BytesIO(raw_body))
+
+        resp_body = json.loads(raw_body.decode('utf-8'))
+
+        img_b64 = resp_body.get('image')
+        if not img_b64 and resp_body.get('images'):
+            img_b64 = resp_body['images'][0]
+
+        file_name = f"gen_{task_id}.png"
+        file_path = os.path.join(OUTPUT_DIR, file_name)
+
+        if img_b64:
+            if "," in img_b64: img_b64 = img_b64.split(",")[1]
+            with open(file_path, "wb") as f:
+                f.write(base64.b64decode(img_b64))
+            status = "SUCCESS"
+        else:
+            logger.error(f"❌ No image data in Ollama response. Keys: {list(resp_body.keys())}")
+            status = "ERROR_NO_IMAGE"
 
         dt = time.perf_counter() - start_t
         log_inference(task_id, request, status, dt)
@@ -200,6 +275,11 @@ def perform_image_inference(request: ImageRequest, task_id: str):
         log_inference(task_id, request, "HTTP_ERROR", time.perf_counter() - start_t, f"{e.code}: {error_body}")
         return {"status": "error", "message": f"Ollama error {e.code}: {error_body}"}
     except Exception as e:
+        if cancel_token.is_cancelled():
+            dt = time.perf_counter() - start_t
+            logger.info(f"🛑 Task {task_id} aborted in flight after {dt:.1f}s (Ollama connection closed).")
+            log_inference(task_id, request, "CANCELLED", dt)
+            return cancelled_result(task_id)
         logger.error(f"💥 Fatal error [{task_id}]: {e}")
         log_inference(task_id, request, "FATAL_ERROR", time.perf_counter() - start_t, str(e))
         return {"status": "error", "message": str(e)}
@@ -215,15 +295,40 @@ class ImageQueueManager:
         self.is_processing = False
         self.current_task_id = None
         self._loop_task = None
+        self.tasks: dict[str, tuple[asyncio.Future, CancelToken]] = {}
+
+    def register(self, task_id: str, fut: asyncio.Future) -> CancelToken:
+        token = CancelToken()
+        self.tasks[task_id] = (fut, token)
+
+        def _on_done(f: asyncio.Future):
+            if f.cancelled():
+                token.cancel()
+            self.tasks.pop(task_id, None)
+
+        fut.add_done_callback(_on_done)
+        return token
+
+    def cancel(self, task_id: str) -> bool:
+        """Cancela una tarea en cola o en curso (aborta la llamada HTTP a Ollama)."""
+        entry = self.tasks.get(task_id)
+        if entry is None:
+            return False
+        fut, token = entry
+        logger.info(f"🛑 Cancel requested for {task_id}")
+        token.cancel()
+        if not fut.done():
+            fut.set_result(cancelled_result(task_id))
+        return True
 
     async def worker(self):
         logger.info("👷 Worker started.")
         while True:
             item = await self.queue.get()
-            req, task_id, fut = item
+            req, task_id, fut, token = item
             
             # Verificar si el cliente ya se desconectó
-            if fut.cancelled():
+            if fut.done():
                 logger.info(f"⏭️ Task {task_id} cancelled before processing.")
                 self.queue.task_done()
                 continue
@@ -234,14 +339,14 @@ class ImageQueueManager:
             try:
                 # Ejecutar inferencia en el executor
                 res = await asyncio.get_running_loop().run_in_executor(
-                    self.executor, perform_image_inference, req, task_id
+                    self.executor, perform_image_inference, req, task_id, token
                 )
-                if not fut.cancelled():
+                if not fut.done():
                     fut.set_result(res)
                 else:
                     logger.info(f"🚮 Task {task_id} finished but client already disconnected.")
             except Exception as e:
-                if not fut.cancelled():
+                if not fut.done():
                     fut.set_exception(e)
             finally:
                 self.queue.task_done()
@@ -279,8 +384,17 @@ async def health():
         "queue_size": queue_mgr.queue.qsize()
     }
 
+async def wait_result(http_request: Request, fut: asyncio.Future, task_id: str):
+    """Espera el resultado; si el cliente se desconecta, cancela la tarea de verdad."""
+    while not fut.done():
+        await asyncio.wait({fut}, timeout=DISCONNECT_POLL_SECONDS)
+        if not fut.done() and await http_request.is_disconnected():
+            logger.info(f"⚠️ Client of {task_id} disconnected. Cancelling...")
+            queue_mgr.cancel(task_id)
+    return fut.result()
+
 @app.post("/generate")
-async def generate(request: ImageRequest):
+async def generate(request: ImageRequest, http_request: Request):
     if "z-image" in request.model.lower():
         w = request.width or 720
         h = request.height or 720
@@ -288,18 +402,27 @@ async def generate(request: ImageRequest):
     
     task_id = str(uuid.uuid4())[:8]
     fut = asyncio.get_running_loop().create_future()
+    token = queue_mgr.register(task_id, fut)
     
     try:
-        await asyncio.wait_for(queue_mgr.queue.put((request, task_id, fut)), timeout=5.0)
+        await asyncio.wait_for(queue_mgr.queue.put((request, task_id, fut, token)), timeout=5.0)
     except asyncio.TimeoutError:
+        fut.cancel()
         raise HTTPException(status_code=503, detail="Server busy, queue is full.")
 
     try:
-        return await fut
+        return await wait_result(http_request, fut, task_id)
     except asyncio.CancelledError:
         logger.info(f"⚠️ Request {task_id} cancelled by client.")
+        queue_mgr.cancel(task_id)
         raise
 
+@app.post("/cancel/{task_id}")
+async def cancel(task_id: str):
+    if not queue_mgr.cancel(task_id):
+        raise HTTPException(status_code=404, detail=f"Task not found or already finished: {task_id}")
+    return {"status": "cancelled", "task_id": task_id}
+
 if __name__ == "__main__":
     import uvicorn
     # Usar uvicorn con loop 'asyncio' y manejo de señales
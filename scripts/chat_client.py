@@ -5,6 +5,7 @@ import time
 import subprocess
 import os
 import re
+import uuid
 from pathlib import Path
 
 URL = "http://127.0.0.1:8011/chat"
@@ -102,6 +103,7 @@ def main():
 
     # Mantener el historial de la conversación (role, content)
     history = []
+    session_id = f"chat-{uuid.uuid4().hex[:8]}" # Caché de prefijo del servidor para esta conversación
     system_prompt = """
     Eres un asistente experto, conciso y creativo.
     You will responde Human-Like replays in a famel persona, single, warm and one to one cooperation.
@@ -205,21 +207,13 @@ Environment Configuration: Special attention must be given to environment variab
             # Agregar el mensaje del usuario al historial
             history.append({"role": "user", "content": user_input})
             
-            # Construir el prompt completo para emular el chat context
-            formatted_prompt = ""
-            for msg in history:
-                role = msg["role"]
-                content = msg["content"]
-                if role == "user":
-                    formatted_prompt += f"<|im_start|>user\n{content}<|im_end|>\n"
-                elif role == "assistant":
-                    formatted_prompt += f"<|im_start|>assistant\n{content}<|im_end|>\n"
-
             print("\n🧬 DiffusionGemma procesando (denoising steps)...")
-            
+
+            # Historial estructurado + session_id: el chat template del servidor produce cada
+            # turno como extensión del anterior y solo se prefilea lo nuevo (caché de prefijo)
             payload = {
-                "prompt": formatted_prompt,
-                "system_prompt": system_prompt,
+                "messages": [{"role": "system", "content": system_prompt}] + history,
+                "session_id": session_id,
                 "max_tokens": 1500,
                 "temperature": 0.7
             }
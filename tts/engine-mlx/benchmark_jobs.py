@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark de narración de documentos largos contra un servidor TTS en marcha
+(Kokoro, OmniVoice o Pocket TTS: mismos endpoints /generate y /jobs).
+
+Compara el realtime factor (segundos de audio / segundos de pared) de:
+
+  per-sentence  — el cliente manda cada frase a /generate y espera la respuesta
+                  (policy=fifo, una petición HTTP por frase)
+  job           — un único POST /jobs con el documento y sondeo del progreso
+
+El audio total lo reporta el job; para per-sentence se toma el mismo (mismo
+texto, misma voz), sin los silencios entre párrafos. Las frases ya cacheadas
+en el servidor se cuentan aparte: conviene usar un texto nuevo o vaciar la
+caché de audio entre ejecuciones.
+
+Uso:
+  python benchmark_jobs.py --url http://127.0.0.1:8009 --file capitulo.txt
+  python benchmark_jobs.py --url http://127.0.0.1:8013 --paragraphs 10
+"""
+
+import argparse
+import json
+import re
+import time
+import urllib.request
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?…;:])\s+")
+PARAGRAPH_PAUSE_S = 0.6 # JOB_PARAGRAPH_PAUSE_S del servidor
+
+
+def post(url: str, payload: dict) -> dict:
+    req = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=600) as r:
+        return json.loads(r.read())
+
+
+def get(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=60) as r:
+        return json.loads(r.read())
+
+
+def build_text(paragraphs: int) -> str:
+    sentences = [
+        "The morning fog rolled slowly over the quiet harbour town.",
+        "Fishermen prepared their nets while the gulls circled overhead.",
+        "Nobody noticed the small boat drifting in from the open sea.",
+        "It carried no flag, no crew, and a single sealed letter.",
+        "By noon the whole town had gathered on the old stone pier.",
+    ]
+    # Cada frase lleva el número de párrafo: ninguna se repite (ni sale de la caché de audio)
+    return "\n\n".join(" ".join(f"{s[:-1]}, day {p + 1}." for s in sentences) for p in range(paragraphs))
+
+
+def run_per_sentence(url: str, text: str, voice) -> dict:
+    sentences = [s for p in re.split(r"\n\s*\n", text) for s in SENTENCE_END_RE.split(" ".join(p.split())) if s]
+    cached = 0
+    t0 = time.perf_counter()
+    for s in sentences:
+        res = post(f"{url}/generate", {"text": s, "voice": voice, "policy": "fifo"})
+        cached += bool(res.get("cached"))
+    return {"requests": len(sentences), "cached": cached, "wall_s": time.perf_counter() - t0}
+
+
+def run_job(url: str, text: str, voice, poll_s: float) -> dict:
+    t0 = time.perf_counter()
+    job = post(f"{url}/jobs", {"text": text, "voice": voice})
+    while job["status"] in ("queued", "running"):
+        time.sleep(poll_s)
+        job = get(f"{url}/jobs/{job['job_id']}")
+    job["wall_s"] = time.perf_counter() - t0
+    return job
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8009")
+    parser.add_argument("--file", help="Texto a narrar (por defecto, uno sintético)")
+    parser.add_argument("--paragraphs", type=int, default=6, help="Párrafos del texto sintético")
+    parser.add_argument("--voice", default=None)
+    parser.add_argument("--poll", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = build_text(args.paragraphs)
+    url = args.url.rstrip("/")
+
+    job = run_job(url, text, args.voice, args.poll)
+    if job["status"] != "done":
+        raise SystemExit(f"Job {job['job_id']} terminó en estado {job['status']}: {job.get('error')}")
+    n_paragraphs = len([p for p in re.split(r"\n\s*\n", text) if p.strip()])
+    speech_s = job["audio_seconds"] - n_paragraphs * PARAGRAPH_PAUSE_S
+    single = run_per_sentence(url, text, args.voice)
+
+    print(f"Texto: {len(text)} chars, {n_paragraphs} párrafos, ~{speech_s:.1f}s de voz")
+    print(f"  per-sentence  {single['requests']:4d} peticiones  {single['wall_s']:7.2f}s  RTF {speech_s / single['wall_s']:5.2f}"
+          f"  ({single['cached']} desde caché)")
+    print(f"  job           {job['total']:4d} segmentos    {job['wall_s']:7.2f}s  RTF {speech_s / job['wall_s']:5.2f}"
+          f"  (servidor: RTF {job['rtf']:.2f}, {job['preemptions']} desalojos)")
+    print(f"  speedup: {single['wall_s'] / job['wall_s']:.2f}x   salida: {job['output']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import time
-import os
 import threading
 import json
 import gc
@@ -8,18 +7,20 @@ import subprocess
 import logging
 import asyncio
 import re
-import wave
 import librosa
+from functools import partial
 from typing import Optional, List
-from concurrent.futures import ThreadPoolExecutor
 
 import mlx.core as mx
 import numpy as np
-import langid
+from langid.langid import LanguageIdentifier, model as LANGID_MODEL
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from mlx_audio.tts.utils import load_model
 
+from tts_common import (AudioHandler, AudioCache, LanguageRouter, AudioBuffer, QueueManager,
+                        NarrationJobManager)
+
 # =======================
 # Logging & Configuration
 # =======================
@@ -31,10 +32,25 @@ CONFIG_PATH = "/Users/crotalo/desarrollo-local/server/tts/engine-mlx/server_conf
 with open(CONFIG_PATH, "r") as f:
     GLOBAL_CONFIG = json.load(f)
 
+# Síntesis por segmentos
+EST_SECONDS_PER_CHAR = 0.08 # Estimación para preasignar el buffer de audio
+
+# Planificación de la cola (el resto de parámetros de cola, caché, reproducción y jobs: tts_common.py)
+DEFAULT_POLICY = GLOBAL_CONFIG.get("global_settings", {}).get("scheduling_policy", "interrupt")
+
 class InferenceRequest(BaseModel):
     text: str
     voice: Optional[str] = None
     lang: Optional[str] = None
+    session: Optional[str] = None # Conversación: el idioma se mantiene en textos ambiguos
+    policy: Optional[str] = None # interrupt (latest-wins) | fifo | coalesce
+
+class NarrationJobRequest(BaseModel):
+    text: Optional[str] = None
+    file: Optional[str] = None # Ruta local a un .txt/.md (alternativa a text)
+    voice: Optional[str] = None
+    lang: Optional[str] = None
+    output: Optional[str] = None # WAV de salida dentro de JOBS_DIR (por defecto <id>.wav)
 
 # =======================
 # Model Manager (Pre-Caching)
@@ -46,7 +62,6 @@ class ModelManager:
         self.model_id = GLOBAL_CONFIG[model_type]["model_id"]
         self.model = None
         self.lock = threading.Lock()
-        self.active_task_id = 0  # 🧠 ID de la tarea activa para interrupción radical
 
     def load(self):
         with self.lock:
@@ -61,72 +76,98 @@ class ModelManager:
         return self.model
 
 # =======================
-# Audio Handler (Atomic)
+# Language Router
 # =======================
 
-class AudioHandler:
-    def __init__(self):
-        self.current_process = None
-        self.lock = threading.Lock()
-
-    def play(self, audio_data: np.ndarray, sample_rate: int):
-        threading.Thread(target=self._play_sync, args=(audio_data, sample_rate), daemon=True).start()
-
-    def _play_sync(self, audio_data: np.ndarray, sample_rate: int):
-        with self.lock:
-            try:
-                if self.current_process and self.current_process.poll() is None:
-                    self.current_process.terminate()
-                path = f"/tmp/tts_master_{time.time_ns()}.wav"
-                data = (np.clip(audio_data, -1.0, 1.0) * 32767).astype(np.int16)
-                with wave.open(path, 'wb') as wf:
-                    wf.setnchannels(1); wf.setsampwidth(2); wf.setframerate(sample_rate)
-                    wf.writeframes(data.tobytes())
-                speed = str(GLOBAL_CONFIG.get("global_settings", {}).get("speed", 1.0))
-                self.current_process = subprocess.Popen(["afplay", "-r", speed, path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            except Exception as e: logger.error(f"Audio Error: {e}")
+# Idiomas con voz configurada (las variantes tipo "it-male" comparten idioma base)
+KOKORO_LANGUAGES = [k for k in GLOBAL_CONFIG.get("kokoro", {}).get("language_mapping", {}) if "-" not in k]
+_langid = LanguageIdentifier.from_modelstring(LANGID_MODEL, norm_probs=True)
+_langid.set_languages(KOKORO_LANGUAGES)
+language_router = LanguageRouter(KOKORO_LANGUAGES, "en", _langid.classify)
 
 # =======================
 # Inference Logic (Kokoro Only)
 # =======================
 
-def perform_inference(request: InferenceRequest, task_id: int):
-    start_t = time.perf_counter()
-    text = request.text.strip()
-    
+def resolve_voice(request: InferenceRequest) -> tuple:
+    """(idioma, voz, lang_code) de la petición."""
     # 🕵️ Detección de Idioma
     if request.lang:
         lang = request.lang
     else:
-        lang, _ = langid.classify(text)
-    
-    logger.info(f"🎙️ Task: KOKORO | TaskID: {task_id} | Language: {lang.upper()}")
+        lang = language_router.resolve(request.text.strip(), request.session)
 
     mappings = GLOBAL_CONFIG.get("kokoro", {}).get("language_mapping", {})
     cfg = mappings.get(lang) or mappings.get("en", {})
+    return lang, request.voice or cfg.get("voice", "af_heart"), cfg.get("lang_code", "a")
+
+def route_language(request: InferenceRequest):
+    """
+    Una detección y un commit de sesión por petición, a la entrada: el idioma
+    queda fijado en request.lang y caché, cola e inferencia ya no lo recalculan.
+    """
+    request.lang = resolve_voice(request)[0]
+    language_router.commit(request.session, request.lang)
+
+def audio_cache_key(request: InferenceRequest) -> Optional[str]:
+    lang, v, l = resolve_voice(request)
+    return AudioCache.key("kokoro", request.text, model=manager.model_id, voice=v, lang_code=l)
+
+def _as_numpy(audio) -> np.ndarray:
+    """Vista NumPy 1-D sobre el array MLX (buffer protocol, sin copia intermedia)."""
+    if audio.dtype != mx.float32:
+        audio = audio.astype(mx.float32)
+    return np.asarray(audio).reshape(-1)
+
+def synthesize_segments(model, gen_kwargs: dict):
+    """Generador: produce cada segmento de audio en cuanto el modelo lo termina."""
+    for res in model.generate(**gen_kwargs):
+        yield _as_numpy(res.audio)
+
+def coalesce_key(request: InferenceRequest) -> tuple:
+    """Solo se fusionan textos que comparten idioma y voz."""
+    return resolve_voice(request)
+
+def merge_request(request: InferenceRequest, text: str) -> InferenceRequest:
+    """Petición del texto fusionado: el idioma ya resuelto no se vuelve a detectar."""
+    return request.model_copy(update={"text": text, "lang": resolve_voice(request)[0]})
+
+def perform_inference(request: InferenceRequest, task_id: int, on_chunk=None):
+    """
+    on_chunk(segmento, índice, sr) se llama con cada segmento en cuanto existe
+    (reproducción progresiva en /generate); el audio completo se acumula en un
+    AudioBuffer preasignado.
+    """
+    start_t = time.perf_counter()
+    text = request.text.strip()
+    lang, v, l = resolve_voice(request)
+    
+    logger.info(f"🎙️ Task: KOKORO | TaskID: {task_id} | Language: {lang.upper()}")
     
     model = manager.get_model()
-    audio_chunks = []
+    buffer = AudioBuffer(int(len(text) * EST_SECONDS_PER_CHAR * model.sample_rate))
+    first_chunk_s = None
 
     try:
-        v = request.voice or cfg.get("voice", "af_heart")
-        l = cfg.get("lang_code", "a")
-        results = model.generate(text=text, voice=v, lang_code=l)
+        segments = synthesize_segments(model, {"text": text, "voice": v, "lang_code": l})
         
-        for res in results:
+        for i, segment in enumerate(segments):
             # INTERRUPCIÓN RADICAL: Si el ID activo cambió, salimos ya.
-            if manager.active_task_id != task_id:
+            if queue_mgr.active_task_id != task_id:
                 logger.info(f"🛑 Tarea {task_id} interrumpida por una más nueva.")
                 return None
-            audio_chunks.append(np.array(res.audio))
-            mx.eval(mx.array(audio_chunks[-1])) # Periodic GPU pulse
+            chunk = buffer.append(segment)
+            if first_chunk_s is None:
+                first_chunk_s = time.perf_counter() - start_t
+            if on_chunk:
+                on_chunk(chunk, i, model.sample_rate)
 
-        if not audio_chunks: return None
+        if not buffer.size: return None
 
-        final_audio = np.concatenate(audio_chunks)
+        final_audio = buffer.view()
         dt = time.perf_counter() - start_t
         rtf = round((len(final_audio)/model.sample_rate)/dt, 2)
-        logger.info(f"✅ Success (T{task_id}): {round(dt, 2)}s | RTF: {rtf}")
+        logger.info(f"✅ Success (T{task_id}): {round(dt, 2)}s | Primer segmento: {first_chunk_s:.2f}s | RTF: {rtf}")
 
         return {
             "status": "success", 
@@ -134,7 +175,8 @@ def perform_inference(request: InferenceRequest, task_id: int):
             "sr": model.sample_rate,
             "detected_lang": lang,
             "voice": v,
-            "rtf": rtf
+            "rtf": rtf,
+            "first_chunk_s": round(first_chunk_s, 3)
         }
 
     except Exception as e:
@@ -144,91 +186,98 @@ def perform_inference(request: InferenceRequest, task_id: int):
         mx.clear_cache()
 
 # =======================
-# API (Queue Managed)
+# Jobs de narración (documentos largos)
 # =======================
 
-# =======================
-# API (Queue Managed)
-# =======================
-
-class QueueManager:
-    def __init__(self, idle_timeout=1200):
-        self.queue = asyncio.Queue(maxsize=1)
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.last_activity = time.time()
-        self.idle_timeout = idle_timeout
-        self.boot_time = time.time()
-
-    async def inactivity_monitor(self):
-        logger.info(f"⏳ Monitor de inactividad iniciado (Timeout: {self.idle_timeout}s)")
-        while True:
-            await asyncio.sleep(10)
-            elapsed = time.time() - self.last_activity
-            if elapsed > self.idle_timeout:
-                logger.warning(f"😴 Inactividad detectada ({round(elapsed, 1)}s). Apagando servidor...")
-                os._exit(0)
-
-    async def worker(self):
-        while True:
-            try:
-                task = await asyncio.wait_for(self.queue.get(), timeout=1.0)
-                req, task_id, fut = task
-                try:
-                    res = await asyncio.get_running_loop().run_in_executor(
-                        self.executor, perform_inference, req, task_id
-                    )
-                    if not fut.done(): fut.set_result(res)
-                except Exception as e:
-                    if not fut.done(): fut.set_exception(e)
-                finally: 
-                    self.queue.task_done()
-                    self.last_activity = time.time()
-            except asyncio.TimeoutError: pass
-
-    async def add_task(self, req: InferenceRequest):
-        self.last_activity = time.time()
-        new_id = time.time_ns()
-        manager.active_task_id = new_id
-        
-        while not self.queue.empty():
-            try:
-                _, _, f = self.queue.get_nowait()
-                if not f.done(): f.set_result(None)
-                self.queue.task_done()
-            except: break
-        
-        fut = asyncio.get_running_loop().create_future()
-        await self.queue.put((req, new_id, fut))
-        return await fut
+def job_params(req: NarrationJobRequest, text: str) -> dict:
+    """Idioma y voz se fijan una vez para todo el documento (detección sobre el principio)."""
+    lang, voice, _ = resolve_voice(InferenceRequest(text=text[:2000], voice=req.voice, lang=req.lang))
+    return {"voice": voice, "lang": lang}
 
 app = FastAPI()
 manager = None
-audio_handler = AudioHandler()
+audio_handler = AudioHandler(speed=float(GLOBAL_CONFIG.get("global_settings", {}).get("speed", 1.0)))
 
 # ⚙️ Configuración Dinámica
 IDLE_TIMEOUT = GLOBAL_CONFIG.get("global_settings", {}).get("idle_timeout_seconds", 1200)
-queue_mgr = QueueManager(idle_timeout=IDLE_TIMEOUT)
+queue_mgr = QueueManager(perform_inference, coalesce_key, merge_request, audio_handler,
+                         default_policy=DEFAULT_POLICY, idle_timeout=IDLE_TIMEOUT)
+audio_cache = AudioCache()
+job_mgr = NarrationJobManager(partial(queue_mgr.submit, silent=True), InferenceRequest, job_params)
 
 @app.on_event("startup")
 async def start():
     logger.info(f"⏱️ Servidor FastAPI listo en {round(time.time() - queue_mgr.boot_time, 3)}s")
     asyncio.create_task(queue_mgr.worker())
     asyncio.create_task(queue_mgr.inactivity_monitor())
+    asyncio.get_running_loop().run_in_executor(None, language_router.warm)
 
 @app.get("/health")
-async def health(): return {"status": "ok", "ready": manager.model is not None}
+async def health(): return {"status": "ok", "ready": manager.model is not None, "audio_cache": audio_cache.stats(), "playback": audio_handler.status(), "language": language_router.status(), "scheduler": queue_mgr.stats()}
 
 @app.post("/generate")
 async def generate(request: InferenceRequest):
     try:
-        res = await queue_mgr.add_task(request)
+        await asyncio.to_thread(route_language, request)
+        key = await asyncio.to_thread(audio_cache_key, request)
+        hit = await asyncio.to_thread(audio_cache.get, key)
+        if hit is not None and (request.policy or DEFAULT_POLICY) == "interrupt":
+            # Acierto: sin cola ni inferencia; sigue interrumpiendo lo anterior (latest-wins)
+            queue_mgr.metrics["interrupt"]["requests"] += 1
+            queue_mgr.preempt()
+            audio_handler.play(*hit)
+            return {"status": "success", "cached": True}
+        # fifo/coalesce: un acierto también pasa por la cola para sonar en orden, sin sintetizar
+        res = await queue_mgr.add_task(request, cached=hit)
         if res is None: return {"status": "interrupted"}
+        if res.get("status") == "error" or "audio" not in res: return res
+        # Ya se reprodujo segmento a segmento (play_chunk/queue_chunk)
         audio = res.pop("audio")
         sr = res.pop("sr")
-        audio_handler.play(audio, sr)
+        if "coalesced" not in res: # El audio fusionado no corresponde a este texto solo
+            await asyncio.to_thread(audio_cache.put, key, audio, sr)
         return res
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/jobs")
+async def create_job(request: NarrationJobRequest):
+    if not request.text and not request.file:
+        raise HTTPException(status_code=400, detail="Se requiere text o file")
+    try:
+        job = await asyncio.to_thread(job_mgr.create, request)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job_mgr.start(job)
+    return job.progress()
+
+@app.get("/jobs")
+async def list_jobs():
+    return [job.progress() for job in job_mgr.jobs.values()]
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(job_mgr.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    return job.progress()
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = job_mgr.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    job_mgr.cancel(job)
+    return job.progress()
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    try:
+        job = await job_mgr.resume(job_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    return job.progress()
+
 if __name__ == "__main__":
     start_time = time.time()
     parser = argparse.ArgumentParser()
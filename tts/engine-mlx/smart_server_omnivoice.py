@@ -2,21 +2,31 @@ import time
 import os
 import threading
 import json
+import hashlib
 import argparse
 import subprocess
 import logging
 import asyncio
-import wave
+import importlib.metadata
+from functools import partial
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 import mlx.core as mx
 import numpy as np
-import langid
+from langid.langid import LanguageIdentifier, model as LANGID_MODEL
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from mlx_audio.tts.utils import load_model
 
+from tts_common import (AudioHandler, AudioCache, _file_version, LanguageRouter, AudioBuffer, QueueManager,
+                        NarrationJobManager)
+
+try:
+    from mlx_audio.tts.models.omnivoice.utils import create_voice_clone_prompt
+except ImportError:  # mlx-audio antiguo: la referencia se procesa dentro de generate()
+    create_voice_clone_prompt = None
+
 # =======================
 # Logging & Configuration
 # =======================
@@ -29,13 +39,51 @@ CONFIG_PATH = os.path.join(PROJECT_DIR, "server_config_omnivoice.json")
 with open(CONFIG_PATH, "r") as f:
     GLOBAL_CONFIG = json.load(f)
 
+# Prompts de voz precalculados (clonación)
+SPEAKER_CACHE_DIR = os.path.expanduser(os.environ.get("OMNIVOICE_SPEAKER_CACHE_DIR", "~/.cache/omnivoice-speaker-prompts"))
+SPEAKER_CACHE_MAX_ENTRIES = 64 # En memoria; en disco son unos KB por voz
+REF_AUDIO_MAX_DURATION_S = 10.0 # Mismo recorte que model.generate por defecto
+
+# Síntesis por segmentos
+EST_SECONDS_PER_CHAR = 0.08 # Estimación para preasignar el buffer de audio
+
+# Perfiles calidad/latencia: num_steps = lo que quepa en slo_s, acotado a [min_steps, max_steps]
+STEP_PROFILES = {
+    "fast": {"min_steps": 8, "max_steps": 16, "guidance_scale": 2.0, "slo_s": 1.0},
+    "balanced": {"min_steps": 16, "max_steps": 32, "guidance_scale": 2.0, "slo_s": 3.0},
+    "quality": {"min_steps": 32, "max_steps": 64, "guidance_scale": 2.0, "slo_s": 12.0},
+    **GLOBAL_CONFIG["omnivoice"].get("step_profiles", {}),
+}
+DEFAULT_STEP_PROFILE = GLOBAL_CONFIG["omnivoice"].get("default_profile", "balanced")
+JOB_STEP_PROFILE = "quality" # Narración: sin usuario esperando cada frase
+STEP_COST_PRIOR = 0.01 # s de cómputo por step y por segundo de audio (~RTF 3 a 32 steps)
+STEP_COST_EMA = 0.2
+
+# Planificación de la cola (el resto de parámetros de cola, caché, reproducción y jobs: tts_common.py)
+DEFAULT_POLICY = GLOBAL_CONFIG.get("global_settings", {}).get("scheduling_policy", "interrupt")
+
 class InferenceRequest(BaseModel):
     text: str
     voice: Optional[str] = None
     language: Optional[str] = None
     ref_audio: Optional[str] = None
-    num_steps: Optional[int] = 32
-    guidance_scale: Optional[float] = 2.0
+    num_steps: Optional[int] = None # Fija los steps (si no, los elige el perfil)
+    guidance_scale: Optional[float] = None
+    profile: Optional[str] = None # fast | balanced | quality
+    slo_s: Optional[float] = None # Objetivo de latencia propio (sustituye al del perfil)
+    session: Optional[str] = None # Conversación: el idioma se mantiene en textos ambiguos
+    policy: Optional[str] = None # interrupt (latest-wins) | fifo | coalesce
+
+class NarrationJobRequest(BaseModel):
+    text: Optional[str] = None
+    file: Optional[str] = None # Ruta local a un .txt/.md (alternativa a text)
+    voice: Optional[str] = None
+    language: Optional[str] = None
+    ref_audio: Optional[str] = None
+    num_steps: Optional[int] = None
+    guidance_scale: Optional[float] = None
+    profile: Optional[str] = None # Por defecto JOB_STEP_PROFILE
+    output: Optional[str] = None # WAV de salida dentro de JOBS_DIR (por defecto <id>.wav)
 
 # =======================
 # Model Manager (OmniVoice)
@@ -44,9 +92,9 @@ class InferenceRequest(BaseModel):
 class ModelManager:
     def __init__(self):
         self.model_path = GLOBAL_CONFIG["omnivoice"]["model_path"]
+        self.version = _model_version(self.model_path)
         self.model = None
         self.lock = threading.Lock()
-        self.active_task_id = 0
 
     def load(self):
         with self.lock:
@@ -61,35 +109,136 @@ class ModelManager:
         return self.model
 
 # =======================
-# Audio Handler (Atomic)
+# Speaker Prompt Cache (clonación)
 # =======================
 
-class AudioHandler:
-    def __init__(self):
-        self.current_process = None
-        self.lock = threading.Lock()
+def _model_version(model_path: str) -> str:
+    """Pesos + implementación del tokenizer de audio: si cambia cualquiera, los prompts se recalculan."""
+    try:
+        lib = importlib.metadata.version("mlx-audio")
+    except importlib.metadata.PackageNotFoundError:
+        lib = None
+    return json.dumps([model_path, _file_version(os.path.join(model_path, "config.json")), lib])
 
-    def play(self, audio_data: np.ndarray, sample_rate: int):
-        threading.Thread(target=self._play_sync, args=(audio_data, sample_rate), daemon=True).start()
+class SpeakerPromptCache:
+    """
+    Tokens de referencia precalculados para la clonación de voz (lo que
+    model.generate obtiene de ref_audio: lectura, remuestreo a 24 kHz,
+    normalización, recorte de silencios y tokenización). Clave = hash del
+    contenido del audio + versión del modelo; memoria (LRU) + disco (.npy).
+    """
+    def __init__(self, cache_dir: str = SPEAKER_CACHE_DIR, max_entries: int = SPEAKER_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.prompts = OrderedDict() # clave -> mx.array [T, 8]
+        self.digests = {} # (ruta, mtime_ns, tamaño) -> hash del contenido
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_s = 0.0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _digest(self, path: str) -> str:
+        st = os.stat(path)
+        sig = (path, st.st_mtime_ns, st.st_size)
+        digest = self.digests.get(sig)
+        if digest is None:
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            digest = self.digests[sig] = h.hexdigest()
+        return digest
+
+    def key(self, ref_path: str, model_version: str) -> str:
+        payload = json.dumps({"ref": self._digest(ref_path), "model": model_version, "max_duration_s": REF_AUDIO_MAX_DURATION_S})
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, ref_path: str, model=None):
+        """mx.array con los tokens de referencia, o None si el modelo no permite precalcularlos."""
+        key = self.key(ref_path, manager.version)
+        with self.lock:
+            tokens = self.prompts.get(key)
+            if tokens is not None:
+                self.prompts.move_to_end(key)
+                self.hits += 1
+                return tokens
+
+        path = os.path.join(self.cache_dir, f"{key}.npy")
+        try:
+            tokens = mx.array(np.load(path))
+            self.disk_hits += 1
+        except (OSError, ValueError):
+            tokens = self._encode(model or manager.get_model(), ref_path)
+            if tokens is None:
+                return None
+            self.misses += 1
+            tmp = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    np.save(f, np.asarray(tokens))
+                os.replace(tmp, path) # Escritura atómica
+            except OSError as e:
+                logger.error(f"Speaker Cache Error: {e}")
 
-    def _play_sync(self, audio_data: np.ndarray, sample_rate: int):
         with self.lock:
+            self.prompts[key] = tokens
+            while len(self.prompts) > self.max_entries:
+                self.prompts.popitem(last=False)
+        return tokens
+
+    def _encode(self, model, ref_path: str):
+        tokenizer = getattr(model, "audio_tokenizer", None)
+        if tokenizer is None or create_voice_clone_prompt is None:
+            return None
+        t0 = time.perf_counter()
+        tokens = create_voice_clone_prompt(ref_path, tokenizer=tokenizer, max_duration_s=REF_AUDIO_MAX_DURATION_S)
+        mx.eval(tokens)
+        dt = time.perf_counter() - t0
+        self.encode_s += dt
+        logger.info(f"🧬 Prompt de voz calculado: {os.path.basename(ref_path)} ({dt:.2f}s)")
+        return tokens
+
+    def warm(self):
+        """Precalcula los prompts de todos los voice_presets y language_mapping (en el hilo de inferencia)."""
+        cfg = GLOBAL_CONFIG["omnivoice"]
+        refs = [v.get("ref_audio") for v in cfg.get("voice_presets", {}).values()]
+        refs += [m.get("ref_audio") for m in cfg.get("language_mapping", {}).values()]
+        t0 = time.perf_counter()
+        n = 0
+        for ref in dict.fromkeys(_abs_ref_path(r) for r in refs if r):
+            if not os.path.isfile(ref):
+                continue
             try:
-                if self.current_process and self.current_process.poll() is None:
-                    self.current_process.terminate()
-                path = f"/tmp/omnivoice_tts_{time.time_ns()}.wav"
-                data = (np.clip(audio_data, -1.0, 1.0) * 32767).astype(np.int16)
-                with wave.open(path, 'wb') as wf:
-                    wf.setnchannels(1); wf.setsampwidth(2); wf.setframerate(sample_rate)
-                    wf.writeframes(data.tobytes())
-                speed = str(GLOBAL_CONFIG.get("global_settings", {}).get("speed", 1.0))
-                self.current_process = subprocess.Popen(["afplay", "-r", speed, path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            except Exception as e: logger.error(f"Audio Error: {e}")
+                if self.get(ref) is None:
+                    logger.warning("⚠️ El modelo no expone audio_tokenizer: sin prompts de voz precalculados")
+                    return
+                n += 1
+            except Exception as e:
+                logger.error(f"💥 Prompt de voz fallido ({ref}): {e}")
+        logger.info(f"🧬 Prompts de voz listos: {n} en {time.perf_counter() - t0:.2f}s")
+
+    def stats(self) -> dict:
+        return {"entries": len(self.prompts), "hits": self.hits, "disk_hits": self.disk_hits,
+                "misses": self.misses, "encode_s": round(self.encode_s, 2)}
+
+# =======================
+# Language Router
+# =======================
+
+OMNI_LANGUAGES = GLOBAL_CONFIG["omnivoice"].get("supported_languages", ["en"])
+_langid = LanguageIdentifier.from_modelstring(LANGID_MODEL, norm_probs=True)
+_langid.set_languages(OMNI_LANGUAGES)
+language_router = LanguageRouter(OMNI_LANGUAGES, GLOBAL_CONFIG["omnivoice"].get("default_language", "en"), _langid.classify)
 
 # =======================
 # Reference Audio Resolver
 # =======================
 
+def _abs_ref_path(ref_path: str) -> str:
+    return ref_path if ref_path.startswith("/") else os.path.join(PROJECT_DIR, ref_path)
+
 def resolve_ref_audio(request: InferenceRequest, lang: str) -> Optional[str]:
     """Resuelve el audio de referencia para voice cloning.
     Prioridad: request.ref_audio > voice_preset > language_mapping > None
@@ -111,8 +260,8 @@ def resolve_ref_audio(request: InferenceRequest, lang: str) -> Optional[str]:
         ref_path = mapping.get("ref_audio")
 
     # Resolver rutas relativas contra PROJECT_DIR
-    if ref_path and not ref_path.startswith("/"):
-        ref_path = os.path.join(PROJECT_DIR, ref_path)
+    if ref_path:
+        ref_path = _abs_ref_path(ref_path)
 
     # Verificar existencia
     if ref_path and os.path.isfile(ref_path):
@@ -126,22 +275,124 @@ def resolve_ref_audio(request: InferenceRequest, lang: str) -> Optional[str]:
 # Inference Logic (OmniVoice)
 # =======================
 
-def perform_inference(request: InferenceRequest, task_id: int):
-    start_t = time.perf_counter()
-    text = request.text.strip()
-
+def resolve_language(request: InferenceRequest) -> str:
     # Detección de Idioma
     if request.language:
-        lang = request.language
-    elif request.voice and request.voice in GLOBAL_CONFIG["omnivoice"].get("voice_presets", {}):
-        lang = GLOBAL_CONFIG["omnivoice"]["voice_presets"][request.voice].get("language", "en")
-    else:
-        lang, _ = langid.classify(text)
+        return request.language
+    if request.voice and request.voice in GLOBAL_CONFIG["omnivoice"].get("voice_presets", {}):
+        return GLOBAL_CONFIG["omnivoice"]["voice_presets"][request.voice].get("language", "en")
+    return language_router.resolve(request.text.strip(), request.session)
+
+def route_language(request: InferenceRequest):
+    """
+    Una detección y un commit de sesión por petición, a la entrada: el idioma
+    queda fijado en request.language y caché, cola e inferencia ya no lo recalculan.
+    """
+    request.language = resolve_language(request)
+    language_router.commit(request.session, request.language)
+
+def audio_cache_key(request: InferenceRequest) -> Optional[str]:
+    lang = resolve_language(request)
+    ref_audio_path = resolve_ref_audio(request, lang)
+    return AudioCache.key(
+        "omnivoice", request.text,
+        model=manager.model_path, language=lang,
+        ref_audio=ref_audio_path, ref_version=_file_version(ref_audio_path),
+        num_steps=request.num_steps, guidance_scale=request.guidance_scale,
+        profile=request.profile or DEFAULT_STEP_PROFILE, slo_s=request.slo_s,
+    )
+
+class StepPlanner:
+    """
+    Elige num_steps/guidance por perfil: los steps que caben en el SLO de
+    latencia según la duración estimada del audio (OmniVoice difunde toda la
+    duración a la vez: cada step cuesta proporcional a ella). El coste por
+    step y los segundos de audio por carácter se aprenden en línea (EMA) de
+    cada inferencia completada.
+    """
+    def __init__(self, profiles: dict = STEP_PROFILES):
+        self.profiles = profiles
+        self.step_cost = STEP_COST_PRIOR
+        self.seconds_per_char = EST_SECONDS_PER_CHAR
+        self.observations = 0
+        self.lock = threading.Lock()
+        self.by_profile = {}
+
+    def plan(self, text: str, request: InferenceRequest) -> dict:
+        name = request.profile or DEFAULT_STEP_PROFILE
+        profile = self.profiles[name]
+        est_audio_s = max(len(text) * self.seconds_per_char, 0.5)
+        slo_s = request.slo_s or profile["slo_s"]
+        if request.num_steps:
+            steps = request.num_steps
+        else:
+            steps = int(slo_s / (self.step_cost * est_audio_s))
+            steps = max(profile["min_steps"], min(profile["max_steps"], steps))
+        return {"profile": name, "num_steps": steps, "guidance_scale": request.guidance_scale or profile["guidance_scale"],
+                "est_audio_s": round(est_audio_s, 2), "slo_s": slo_s}
+
+    def observe(self, plan: dict, chars: int, audio_s: float, synth_s: float):
+        if audio_s <= 0 or chars <= 0:
+            return
+        with self.lock:
+            cost = synth_s / (plan["num_steps"] * audio_s)
+            self.step_cost += STEP_COST_EMA * (cost - self.step_cost)
+            self.seconds_per_char += STEP_COST_EMA * (audio_s / chars - self.seconds_per_char)
+            self.observations += 1
+            st = self.by_profile.setdefault(plan["profile"], {"requests": 0, "steps": 0, "rtf": 0.0, "slo_misses": 0})
+            st["requests"] += 1
+            st["steps"] += plan["num_steps"]
+            st["rtf"] += audio_s / synth_s
+            st["slo_misses"] += synth_s > plan["slo_s"]
+
+    def stats(self) -> dict:
+        return {
+            "step_cost": round(self.step_cost, 5),
+            "seconds_per_char": round(self.seconds_per_char, 4),
+            "observations": self.observations,
+            "profiles": {name: {"requests": st["requests"], "avg_steps": round(st["steps"] / st["requests"], 1),
+                                "avg_rtf": round(st["rtf"] / st["requests"], 2), "slo_misses": st["slo_misses"]}
+                         for name, st in self.by_profile.items()},
+        }
+
+step_planner = StepPlanner()
+
+def _as_numpy(audio) -> np.ndarray:
+    """Vista NumPy 1-D sobre el array MLX (buffer protocol, sin copia intermedia)."""
+    if audio.dtype != mx.float32:
+        audio = audio.astype(mx.float32)
+    return np.asarray(audio).reshape(-1)
+
+def synthesize_segments(model, gen_kwargs: dict):
+    """Generador: produce cada segmento de audio en cuanto el modelo lo termina."""
+    for res in model.generate(**gen_kwargs):
+        yield _as_numpy(res.audio)
+
+def coalesce_key(request: InferenceRequest) -> tuple:
+    """Solo se fusionan textos que comparten idioma, voz de referencia y parámetros de muestreo."""
+    lang = resolve_language(request)
+    return (lang, resolve_ref_audio(request, lang), request.num_steps, request.guidance_scale,
+            request.profile or DEFAULT_STEP_PROFILE, request.slo_s)
+
+def merge_request(request: InferenceRequest, text: str) -> InferenceRequest:
+    """Petición del texto fusionado: el idioma ya resuelto no se vuelve a detectar."""
+    return request.model_copy(update={"text": text, "language": resolve_language(request)})
+
+def perform_inference(request: InferenceRequest, task_id: int, on_chunk=None):
+    """
+    on_chunk(segmento, índice, sr) se llama con cada segmento en cuanto existe
+    (reproducción progresiva en /generate); el audio completo se acumula en un
+    AudioBuffer preasignado.
+    """
+    start_t = time.perf_counter()
+    text = request.text.strip()
+    lang = resolve_language(request)
 
     logger.info(f"🎙️ Task: OMNIVOICE | TaskID: {task_id} | Language: {lang.upper()}")
 
     model = manager.get_model()
-    audio_chunks = []
+    buffer = AudioBuffer(int(len(text) * step_planner.seconds_per_char * model.sample_rate))
+    first_chunk_s = None
 
     # Resolver audio de referencia para voice cloning
     ref_audio_path = resolve_ref_audio(request, lang)
@@ -154,30 +405,44 @@ def perform_inference(request: InferenceRequest, task_id: int):
         # OmniVoice generate API (from model inspection):
         # generate(text, duration_s, language, lang_code, instruct, ref_audio,
         #          ref_text, ref_audio_max_duration_s, num_steps, guidance_scale, ...)
+        plan = step_planner.plan(text, request)
+        logger.info(f"🎚️ Perfil {plan['profile']}: {plan['num_steps']} steps, guidance {plan['guidance_scale']} "
+                    f"(~{plan['est_audio_s']}s de audio, SLO {plan['slo_s']}s)")
         gen_kwargs = {
             "text": text,
             "language": lang,
-            "num_steps": request.num_steps or 32,
-            "guidance_scale": request.guidance_scale or 2.0,
+            "num_steps": plan["num_steps"],
+            "guidance_scale": plan["guidance_scale"],
         }
         if ref_audio_path:
-            gen_kwargs["ref_audio"] = ref_audio_path
-
-        results = model.generate(**gen_kwargs)
-
-        for res in results:
+            # Prompt de voz precalculado: generate() se salta decodificar y tokenizar la referencia
+            ref_tokens = speaker_cache.get(ref_audio_path, model)
+            if ref_tokens is not None:
+                gen_kwargs["ref_tokens"] = ref_tokens
+            else:
+                gen_kwargs["ref_audio"] = ref_audio_path
+
+        synth_t = time.perf_counter() # Sin carga del modelo ni prompt de voz: solo lo que cuesta por step
+        for i, segment in enumerate(synthesize_segments(model, gen_kwargs)):
             # INTERRUPCIÓN RADICAL: Si el ID activo cambió, salimos ya.
-            if manager.active_task_id != task_id:
+            if queue_mgr.active_task_id != task_id:
                 logger.info(f"🛑 Tarea {task_id} interrumpida por una más nueva.")
                 return None
-            audio_chunks.append(np.array(res.audio))
+            chunk = buffer.append(segment)
+            if first_chunk_s is None:
+                first_chunk_s = time.perf_counter() - start_t
+            if on_chunk:
+                on_chunk(chunk, i, model.sample_rate)
 
-        if not audio_chunks: return None
+        if not buffer.size: return None
 
-        final_audio = np.concatenate(audio_chunks)
+        final_audio = buffer.view()
         dt = time.perf_counter() - start_t
-        rtf = round((len(final_audio) / model.sample_rate) / dt, 2)
-        logger.info(f"✅ Success (T{task_id}): {round(dt, 2)}s | RTF: {rtf}")
+        audio_s = len(final_audio) / model.sample_rate
+        rtf = round(audio_s / dt, 2)
+        step_planner.observe(plan, len(text), audio_s, time.perf_counter() - synth_t)
+        logger.info(f"✅ Success (T{task_id}): {round(dt, 2)}s | Primer segmento: {first_chunk_s:.2f}s | RTF: {rtf} | "
+                    f"{plan['profile']}/{plan['num_steps']} steps")
 
         return {
             "status": "success",
@@ -186,7 +451,11 @@ def perform_inference(request: InferenceRequest, task_id: int):
             "detected_lang": lang,
             "voice": request.voice or "default",
             "cloned": ref_audio_path is not None,
-            "rtf": rtf
+            "profile": plan["profile"],
+            "num_steps": plan["num_steps"],
+            "guidance_scale": plan["guidance_scale"],
+            "rtf": rtf,
+            "first_chunk_s": round(first_chunk_s, 3)
         }
 
     except Exception as e:
@@ -196,74 +465,37 @@ def perform_inference(request: InferenceRequest, task_id: int):
         mx.clear_cache()
 
 # =======================
-# API (Queue Managed)
+# Jobs de narración (documentos largos)
 # =======================
 
-class QueueManager:
-    def __init__(self, idle_timeout=1200):
-        self.queue = asyncio.Queue(maxsize=1)
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.last_activity = time.time()
-        self.idle_timeout = idle_timeout
-        self.boot_time = time.time()
-
-    async def inactivity_monitor(self):
-        logger.info(f"⏳ Monitor de inactividad iniciado (Timeout: {self.idle_timeout}s)")
-        while True:
-            await asyncio.sleep(10)
-            elapsed = time.time() - self.last_activity
-            if elapsed > self.idle_timeout:
-                logger.warning(f"😴 Inactividad detectada ({round(elapsed, 1)}s). Apagando servidor...")
-                os._exit(0)
-
-    async def worker(self):
-        while True:
-            try:
-                task = await asyncio.wait_for(self.queue.get(), timeout=1.0)
-                req, task_id, fut = task
-                try:
-                    res = await asyncio.get_running_loop().run_in_executor(
-                        self.executor, perform_inference, req, task_id
-                    )
-                    if not fut.done(): fut.set_result(res)
-                except Exception as e:
-                    if not fut.done(): fut.set_exception(e)
-                finally:
-                    self.queue.task_done()
-                    self.last_activity = time.time()
-            except asyncio.TimeoutError: pass
-
-    async def add_task(self, req: InferenceRequest):
-        self.last_activity = time.time()
-        new_id = time.time_ns()
-        manager.active_task_id = new_id
-
-        while not self.queue.empty():
-            try:
-                _, _, f = self.queue.get_nowait()
-                if not f.done(): f.set_result(None)
-                self.queue.task_done()
-            except: break
-
-        fut = asyncio.get_running_loop().create_future()
-        await self.queue.put((req, new_id, fut))
-        return await fut
+def job_params(req: NarrationJobRequest, text: str) -> dict:
+    """Idioma y parámetros se fijan una vez para todo el documento (detección sobre el principio)."""
+    lang = resolve_language(InferenceRequest(text=text[:2000], voice=req.voice, language=req.language))
+    return {"voice": req.voice, "language": lang, "ref_audio": req.ref_audio,
+            "num_steps": req.num_steps, "guidance_scale": req.guidance_scale, "profile": req.profile or JOB_STEP_PROFILE}
 
 app = FastAPI()
 manager = None
-audio_handler = AudioHandler()
+audio_handler = AudioHandler(speed=float(GLOBAL_CONFIG.get("global_settings", {}).get("speed", 1.0)))
 
 IDLE_TIMEOUT = GLOBAL_CONFIG.get("global_settings", {}).get("idle_timeout_seconds", 1200)
-queue_mgr = QueueManager(idle_timeout=IDLE_TIMEOUT)
+queue_mgr = QueueManager(perform_inference, coalesce_key, merge_request, audio_handler,
+                         default_policy=DEFAULT_POLICY, idle_timeout=IDLE_TIMEOUT)
+audio_cache = AudioCache()
+speaker_cache = SpeakerPromptCache()
+job_mgr = NarrationJobManager(partial(queue_mgr.submit, silent=True), InferenceRequest, job_params)
 
 @app.on_event("startup")
 async def start():
     logger.info(f"⏱️ Servidor OmniVoice listo en {round(time.time() - queue_mgr.boot_time, 3)}s")
     asyncio.create_task(queue_mgr.worker())
     asyncio.create_task(queue_mgr.inactivity_monitor())
+    asyncio.get_running_loop().run_in_executor(None, language_router.warm)
+    # Mismo hilo que la inferencia: MLX no se comparte entre hilos
+    asyncio.get_running_loop().run_in_executor(queue_mgr.executor, speaker_cache.warm)
 
 @app.get("/health")
-async def health(): return {"status": "ok", "engine": "omnivoice", "ready": manager.model is not None}
+async def health(): return {"status": "ok", "engine": "omnivoice", "ready": manager.model is not None, "audio_cache": audio_cache.stats(), "speaker_cache": speaker_cache.stats(), "steps": step_planner.stats(), "playback": audio_handler.status(), "language": language_router.status(), "scheduler": queue_mgr.stats()}
 
 @app.get("/config")
 async def get_config():
@@ -276,16 +508,71 @@ async def get_config():
 
 @app.post("/generate")
 async def generate(request: InferenceRequest):
+    if request.profile and request.profile not in STEP_PROFILES:
+        raise HTTPException(status_code=400, detail=f"profile debe ser uno de {list(STEP_PROFILES)}")
     try:
-        res = await queue_mgr.add_task(request)
+        await asyncio.to_thread(route_language, request)
+        key = await asyncio.to_thread(audio_cache_key, request)
+        hit = await asyncio.to_thread(audio_cache.get, key)
+        if hit is not None and (request.policy or DEFAULT_POLICY) == "interrupt":
+            # Acierto: sin cola ni inferencia; sigue interrumpiendo lo anterior (latest-wins)
+            queue_mgr.metrics["interrupt"]["requests"] += 1
+            queue_mgr.preempt()
+            audio_handler.play(*hit)
+            return {"status": "success", "cached": True}
+        # fifo/coalesce: un acierto también pasa por la cola para sonar en orden, sin sintetizar
+        res = await queue_mgr.add_task(request, cached=hit)
         if res is None: return {"status": "interrupted"}
-        if res.get("status") == "error": return res
+        if res.get("status") == "error" or "audio" not in res: return res
+        # Ya se reprodujo segmento a segmento (play_chunk/queue_chunk)
         audio = res.pop("audio")
         sr = res.pop("sr")
-        audio_handler.play(audio, sr)
+        if "coalesced" not in res: # El audio fusionado no corresponde a este texto solo
+            await asyncio.to_thread(audio_cache.put, key, audio, sr)
         return res
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/jobs")
+async def create_job(request: NarrationJobRequest):
+    if not request.text and not request.file:
+        raise HTTPException(status_code=400, detail="Se requiere text o file")
+    if request.profile and request.profile not in STEP_PROFILES:
+        raise HTTPException(status_code=400, detail=f"profile debe ser uno de {list(STEP_PROFILES)}")
+    try:
+        job = await asyncio.to_thread(job_mgr.create, request)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job_mgr.start(job)
+    return job.progress()
+
+@app.get("/jobs")
+async def list_jobs():
+    return [job.progress() for job in job_mgr.jobs.values()]
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(job_mgr.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    return job.progress()
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = job_mgr.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    job_mgr.cancel(job)
+    return job.progress()
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    try:
+        job = await job_mgr.resume(job_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    return job.progress()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="OmniVoice MLX TTS Server")
     parser.add_argument("--port", type=int, default=8009)
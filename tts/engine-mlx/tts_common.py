@@ -0,0 +1,1005 @@
+"""
+Piezas comunes de los servidores TTS (Kokoro, OmniVoice y Pocket TTS):
+reproducción local, caché de audio en disco, enrutado de idioma, cola con
+políticas y jobs de narración. Cada servidor aporta solo lo propio del motor
+(inferencia, resolución de voz/idioma) y lo inyecta en QueueManager y
+NarrationJobManager.
+
+Sin dependencias de MLX: Pocket TTS lo importa desde su entorno conda.
+"""
+
+import time
+import os
+import threading
+import json
+import hashlib
+import unicodedata
+import logging
+import asyncio
+import re
+import wave
+import struct
+import uuid
+from typing import Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from fastapi import HTTPException
+
+try:
+    import sounddevice as sd  # PortAudio (binarios incluidos en la wheel de macOS): pip install sounddevice
+    SD_IMPORT_ERROR = None
+except Exception as e:  # ImportError, u OSError si falta libportaudio
+    sd = None
+    SD_IMPORT_ERROR = e
+
+logger = logging.getLogger("TTS_COMMON")
+
+# Caché de audio compartida entre motores (mismo directorio para Pocket, Kokoro y OmniVoice)
+AUDIO_CACHE_DIR = os.path.expanduser(os.environ.get("TTS_AUDIO_CACHE_DIR", "~/.cache/tts-audio-cache"))
+AUDIO_CACHE_MAX_MB = int(os.environ.get("TTS_AUDIO_CACHE_MAX_MB", "512"))
+AUDIO_CACHE_MAX_TEXT_CHARS = 500 # Textos más largos no se cachean (casi nunca se repiten)
+
+# Enrutado de idioma
+LANG_CACHE_SIZE = 2048
+LANG_MAX_SESSIONS = 256
+LANG_MIN_DETECT_CHARS = 12 # Menos letras: no se consulta el detector estadístico
+LANG_MIN_CONFIDENCE = 0.80 # Por debajo, gana el idioma pegajoso de la sesión
+
+# Reproducción local (hilo de audio + ring buffer)
+AUDIO_SINK = os.environ.get("TTS_AUDIO_SINK", "auto") # auto | null | file:/ruta/salida.wav
+PLAYBACK_BLOCK_FRAMES = 1024
+PLAYBACK_RING_SECONDS = 30
+PLAYBACK_DEVICE_IDLE_CLOSE = 30 # s sin audio -> se libera el dispositivo
+
+# Planificación de la cola
+SCHEDULING_POLICIES = ("interrupt", "fifo", "coalesce")
+QUEUE_MAX_PENDING = 64
+COALESCE_MAX_CHARS = 400 # Tope del texto fusionado en una sola síntesis
+
+# Jobs de narración (documento largo -> un único WAV)
+JOBS_DIR = os.path.expanduser(os.environ.get("TTS_JOBS_DIR", "~/.cache/tts-jobs"))
+JOB_SEGMENT_CHARS = 600 # Frases agrupadas por llamada de síntesis (y granularidad del checkpoint)
+JOB_PIPELINE_DEPTH = 2 # Segmentos encolados por delante de la escritura
+JOB_PARAGRAPH_PAUSE_S = 0.6 # Silencio entre párrafos
+JOB_MAX_FILE_MB = 20
+
+# =======================
+# Audio Handler (Playback Engine)
+# =======================
+
+class RingBuffer:
+    """Buffer circular float32 preasignado. Lo protege el lock de AudioHandler."""
+    def __init__(self, capacity: int):
+        self.buf = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.read_pos = 0
+        self.size = 0
+
+    def space(self) -> int:
+        return self.capacity - self.size
+
+    def write(self, data: np.ndarray) -> int:
+        n = min(len(data), self.space())
+        start = (self.read_pos + self.size) % self.capacity
+        first = min(n, self.capacity - start)
+        self.buf[start:start + first] = data[:first]
+        self.buf[:n - first] = data[first:n]
+        self.size += n
+        return n
+
+    def read(self, n: int) -> np.ndarray:
+        n = min(n, self.size)
+        first = min(n, self.capacity - self.read_pos)
+        out = np.concatenate((self.buf[self.read_pos:self.read_pos + first], self.buf[:n - first]))
+        self.read_pos = (self.read_pos + n) % self.capacity
+        self.size -= n
+        return out
+
+    def clear(self):
+        self.read_pos = 0
+        self.size = 0
+
+class SoundDeviceSink:
+    """Salida PortAudio. write() es bloqueante y marca el ritmo del hilo de audio."""
+    name = "sounddevice"
+
+    def __init__(self):
+        self.stream = None
+        self.sr = None
+
+    def write(self, block: np.ndarray, sr: int):
+        if self.stream is None or self.sr != sr:
+            self.idle()
+            self.stream = sd.OutputStream(samplerate=sr, channels=1, dtype="float32", blocksize=PLAYBACK_BLOCK_FRAMES)
+            self.stream.start()
+            self.sr = sr
+        self.stream.write(block.reshape(-1, 1))
+
+    def idle(self):
+        # Libera el dispositivo tras un rato sin audio
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+class NullSink:
+    """Descarta el audio al ritmo real (Linux sin tarjeta de sonido, pruebas)."""
+    name = "null"
+
+    def write(self, block: np.ndarray, sr: int):
+        time.sleep(len(block) / sr)
+
+    def idle(self):
+        pass
+
+class FileSink(NullSink):
+    """Escribe en un WAV exactamente lo que sonaría (con cortes por interrupción), al ritmo real."""
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.wf = None
+
+    def write(self, block: np.ndarray, sr: int):
+        if self.wf is None:
+            self.wf = wave.open(self.path, "wb")
+            self.wf.setnchannels(1); self.wf.setsampwidth(2); self.wf.setframerate(sr)
+        self.wf.writeframes((np.clip(block, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+        super().write(block, sr)
+
+def make_sink(spec: str):
+    """
+    auto = PortAudio: sounddevice es dependencia del servidor y, si falta, no
+    arranca (nada de quedarse mudo sin avisar). null y file: solo si se piden.
+    """
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec == "null":
+        return NullSink()
+    if spec != "auto":
+        raise ValueError(f"TTS_AUDIO_SINK desconocido: {spec!r} (auto | null | file:/ruta/salida.wav)")
+    if sd is None:
+        raise RuntimeError(f"sounddevice no disponible ({SD_IMPORT_ERROR}): pip install sounddevice. "
+                           "Para arrancar sin reproducción local: TTS_AUDIO_SINK=null")
+    return SoundDeviceSink()
+
+class AudioHandler:
+    """
+    Reproducción sin ficheros temporales ni procesos afplay: los buffers PCM
+    van a un ring buffer que vacía un hilo de audio dedicado hacia el sink
+    (PortAudio, null o WAV, según TTS_AUDIO_SINK). play() corta lo que suena
+    y reproduce; enqueue() encadena sin huecos tras lo que ya está en cola.
+    """
+    def __init__(self, sink: str = AUDIO_SINK, speed: float = 1.0):
+        self.sink = make_sink(sink)
+        self.speed = speed
+        self.ring = RingBuffer(PLAYBACK_RING_SECONDS * 48000)
+        self.pending = deque()  # (audio, sr) aún fuera del ring
+        self.sr = None
+        self.cond = threading.Condition()
+        self.stats = {"utterances": 0, "interruptions": 0, "played_s": 0.0}
+        threading.Thread(target=self._run, daemon=True, name="AudioPlayback").start()
+
+    def play(self, audio_data: np.ndarray, sample_rate: int):
+        self.interrupt()
+        self.enqueue(audio_data, sample_rate)
+
+    def enqueue(self, audio_data: np.ndarray, sample_rate: int):
+        data = self._prepare(audio_data)
+        with self.cond:
+            self.pending.append((data, sample_rate))
+            self.stats["utterances"] += 1
+            self.cond.notify()
+
+    def interrupt(self):
+        with self.cond:
+            if self.ring.size or self.pending:
+                self.stats["interruptions"] += 1
+            self.pending.clear()
+            self.ring.clear()
+
+    def status(self) -> dict:
+        with self.cond:
+            queued = self.ring.size + sum(len(d) for d, _ in self.pending)
+            return {
+                "sink": self.sink.name,
+                "queued_s": round(queued / self.sr, 2) if self.sr else 0.0,
+                **{k: round(v, 2) for k, v in self.stats.items()},
+            }
+
+    def _prepare(self, audio_data: np.ndarray) -> np.ndarray:
+        data = audio_data.squeeze()
+        data = data.astype(np.float32) / 32767 if data.dtype == np.int16 else data.astype(np.float32, copy=False)
+        if self.speed != 1.0:
+            try:
+                import librosa
+                data = librosa.effects.time_stretch(data, rate=self.speed)
+            except ImportError:
+                # Sin librosa: varispeed (cambia también el tono)
+                positions = np.arange(0, len(data), self.speed)
+                data = np.interp(positions, np.arange(len(data)), data).astype(np.float32)
+        return data
+
+    def _fill(self) -> bool:
+        """Pasa audio pendiente al ring (mismo sample rate contiguo = sin huecos)."""
+        while self.pending and self.ring.space():
+            data, sr = self.pending[0]
+            if self.ring.size and sr != self.sr:
+                break  # Cambio de sample rate: se vacía el ring antes de continuar
+            self.sr = sr
+            n = self.ring.write(data)
+            if n == len(data):
+                self.pending.popleft()
+            else:
+                self.pending[0] = (data[n:], sr)
+        return self.ring.size > 0
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self._fill():
+                    if not self.cond.wait(timeout=PLAYBACK_DEVICE_IDLE_CLOSE):
+                        self.sink.idle()
+                    continue
+                block = self.ring.read(PLAYBACK_BLOCK_FRAMES)
+                sr = self.sr
+            try:
+                self.sink.write(block, sr)
+                self.stats["played_s"] += len(block) / sr
+            except Exception as e:
+                logger.error(f"Audio Error: {e}")
+                self.interrupt()
+                time.sleep(1.0)
+
+# =======================
+# Audio Cache (disk, shared)
+# =======================
+
+class AudioCache:
+    """
+    Caché de audio sintetizado en disco, direccionada por contenido y compartida
+    entre motores (Pocket TTS, Kokoro, OmniVoice): mismo directorio, la clave
+    incluye motor, texto normalizado, voz resuelta, idioma y parámetros.
+    PCM como WAV int16 mono (<clave>.wav, para reproducir); las respuestas ya
+    codificadas (mp3, opus, ...) se guardan tal cual con una clave que incluye
+    formato y codificador (<clave>.<formato>): un acierto no vuelve a codificar.
+    LRU por mtime (válido entre procesos) con tope de tamaño común.
+    """
+    def __init__(self, cache_dir: str = AUDIO_CACHE_DIR, max_mb: int = AUDIO_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.encoded_hits = 0
+        self.encoded_misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total = sum(e.stat().st_size for e in os.scandir(cache_dir) if not e.name.endswith(".tmp"))
+
+    @staticmethod
+    def key(engine: str, text: str, **params) -> Optional[str]:
+        text = " ".join(unicodedata.normalize("NFC", text).split())
+        if not text or len(text) > AUDIO_CACHE_MAX_TEXT_CHARS:
+            return None
+        payload = json.dumps({"engine": engine, "text": text, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _path(self, key: str, ext: str = "wav") -> str:
+        return os.path.join(self.cache_dir, f"{key}.{ext}")
+
+    def _count(self, hit: bool, encoded: bool = False):
+        with self.lock:
+            if encoded:
+                self.encoded_hits += hit
+                self.encoded_misses += not hit
+            else:
+                self.hits += hit
+                self.misses += not hit
+
+    def get(self, key: Optional[str]):
+        """Devuelve (audio float32, sr) o None."""
+        if key is None:
+            return None
+        path = self._path(key)
+        try:
+            with wave.open(path, "rb") as wf:
+                sr = wf.getframerate()
+                data = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+            os.utime(path)  # mtime = último uso
+        except (FileNotFoundError, EOFError, wave.Error):
+            self._count(False)
+            return None
+        self._count(True)
+        return data.astype(np.float32) / 32767, sr
+
+    def get_encoded(self, key: Optional[str], fmt: str) -> Optional[bytes]:
+        """Bytes ya codificados en fmt, o None."""
+        if key is None:
+            return None
+        path = self._path(key, fmt)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._count(False, encoded=True)
+            return None
+        self._count(True, encoded=True)
+        return data
+
+    def put(self, key: Optional[str], audio_data: np.ndarray, sr: int):
+        if key is None:
+            return
+        data = (np.clip(audio_data.squeeze(), -1.0, 1.0) * 32767).astype(np.int16) if audio_data.dtype != np.int16 else audio_data
+
+        def write(tmp):
+            with wave.open(tmp, "wb") as wf:
+                wf.setnchannels(1); wf.setsampwidth(2); wf.setframerate(sr)
+                wf.writeframes(data.tobytes())
+        self._store(self._path(key), write)
+
+    def put_encoded(self, key: Optional[str], fmt: str, content: bytes):
+        if key is None:
+            return
+
+        def write(tmp):
+            with open(tmp, "wb") as f:
+                f.write(content)
+        self._store(self._path(key, fmt), write)
+
+    def _store(self, path: str, write):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            write(tmp)
+            os.replace(tmp, path)  # Escritura atómica: otro proceso nunca lee un fichero a medias
+        except OSError as e:
+            logger.error(f"Audio Cache Error: {e}")
+            return
+        with self.lock:
+            self.total += os.path.getsize(path)
+            if self.total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Re-escaneo del directorio: otros servidores también escriben en él
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if not e.name.endswith(".tmp"):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+        self.total = total
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            encoded_lookups = self.encoded_hits + self.encoded_misses
+            return {
+                "dir": self.cache_dir,
+                "size_mb": round(self.total / 2**20, 1),
+                "max_mb": self.max_bytes // 2**20,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "encoded_hits": self.encoded_hits,
+                "encoded_hit_rate": round(self.encoded_hits / encoded_lookups, 3) if encoded_lookups else 0.0,
+            }
+
+def _file_version(path: Optional[str]):
+    """mtime de un fichero de voz/referencia: si se reemplaza el audio, cambia la clave."""
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+# =======================
+# Language Router
+# =======================
+
+# Escrituras inequívocas: se resuelven sin detector estadístico
+SCRIPT_HINTS = [
+    ("ja", re.compile(r"[\u3040-\u30ff]")),  # hiragana / katakana
+    ("ko", re.compile(r"[\uac00-\ud7af\u1100-\u11ff]")),
+    ("zh", re.compile(r"[\u4e00-\u9fff]")),
+    ("ar", re.compile(r"[\u0600-\u06ff]")),
+    ("ru", re.compile(r"[\u0400-\u04ff]")),
+    ("hi", re.compile(r"[\u0900-\u097f]")),
+    ("es", re.compile(r"[ñ¿¡]")),
+    ("pt", re.compile(r"[ãõ]")),
+    ("de", re.compile(r"ß")),
+    ("fr", re.compile(r"œ")),
+]
+
+class LanguageRouter:
+    """
+    Decide el idioma de cada petición:
+      1. Pista de escritura (kana, hangul, cirílico, ñ/¿, ...) -> sin detector.
+      2. Caché LRU de detecciones por texto normalizado.
+      3. Detector estadístico (cargado una vez, restringido a los idiomas del motor);
+         textos cortos o con baja confianza no se fían de él.
+      4. Idioma pegajoso por sesión: lo ambiguo hereda el idioma de la conversación.
+
+    resolve() no toca el estado de las sesiones (se puede llamar las veces que
+    haga falta); commit() registra el idioma una sola vez por petición, y solo
+    si la petición trae sesión: sin sesión no hay idioma pegajoso que compartir.
+    """
+    def __init__(self, candidates, default: str, detector):
+        self.candidates = set(candidates)
+        self.default = default
+        self.detector = detector  # text -> (lang, prob)
+        self.cache = OrderedDict()
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"script": 0, "cache_hits": 0, "detector": 0, "sticky": 0}
+
+    def warm(self):
+        t0 = time.perf_counter()
+        self.detector("This sentence only warms up the language detector.")
+        logger.info(f"🔤 Detector de idioma listo en {time.perf_counter() - t0:.2f}s (idiomas: {sorted(self.candidates)})")
+
+    def resolve(self, text: str, session: Optional[str] = None) -> str:
+        key = " ".join(text.lower().split())
+        with self.lock:
+            res = self.cache.get(key)
+            if res is not None:
+                self.cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+        if res is None:
+            res = self._classify(key)
+            with self.lock:
+                self.cache[key] = res
+                while len(self.cache) > LANG_CACHE_SIZE:
+                    self.cache.popitem(last=False)
+
+        lang, confident = res
+        if session and (lang is None or not confident):
+            with self.lock:
+                sticky = self.sessions.get(session)
+                if sticky:
+                    self.stats["sticky"] += 1
+                    return sticky
+        return lang or self.default
+
+    def commit(self, session: Optional[str], lang: str):
+        """Idioma servido en la sesión: lo heredarán sus textos ambiguos siguientes."""
+        if not session:
+            return
+        with self.lock:
+            self.sessions[session] = lang
+            self.sessions.move_to_end(session)
+            while len(self.sessions) > LANG_MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+
+    def _classify(self, text: str):
+        """(idioma o None, confiable)."""
+        for lang, pattern in SCRIPT_HINTS:
+            if lang in self.candidates and pattern.search(text):
+                self.stats["script"] += 1
+                return lang, True
+        if sum(c.isalpha() for c in text) < LANG_MIN_DETECT_CHARS:
+            return None, False  # Demasiado corto: los detectores estadísticos fallan
+        self.stats["detector"] += 1
+        try:
+            lang, prob = self.detector(text)
+        except Exception:
+            return None, False
+        if lang not in self.candidates:
+            return None, False
+        return lang, prob >= LANG_MIN_CONFIDENCE
+
+    def status(self) -> dict:
+        with self.lock:
+            return {"cached": len(self.cache), "sessions": len(self.sessions), **self.stats}
+
+# =======================
+# Síntesis por segmentos
+# =======================
+
+class AudioBuffer:
+    """
+    Buffer float32 preasignado que crece x1.5 si hace falta. Cada segmento se
+    copia una sola vez (MLX -> buffer) y el audio final es una vista: sin lista
+    intermedia ni np.concatenate (pico de memoria ~1x en lugar de ~2x).
+    """
+    def __init__(self, capacity: int):
+        self.data = np.empty(max(capacity, 1), dtype=np.float32)
+        self.size = 0
+
+    def append(self, segment: np.ndarray) -> np.ndarray:
+        n = len(segment)
+        if self.size + n > len(self.data):
+            grown = np.empty(max(self.size + n, int(len(self.data) * 1.5)), dtype=np.float32)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size + n] = segment
+        self.size += n
+        return self.data[self.size - n:self.size]
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+def join_texts(texts: list) -> str:
+    """Une textos cortos asegurando una pausa de frase entre ellos."""
+    parts = []
+    for t in texts:
+        t = t.strip()
+        if t and t[-1] not in ".!?…;:":
+            t += "."
+        parts.append(t)
+    return " ".join(parts)
+
+# =======================
+# API (Queue Managed)
+# =======================
+
+class QueueManager:
+    """
+    Cola con política por petición:
+      interrupt — latest-wins: aborta la tarea en curso y descarta lo encolado
+      fifo      — se encola detrás de lo pendiente, sin interrumpir
+      coalesce  — como fifo, pero los textos cortos consecutivos compatibles
+                  que esperan en la cola se sintetizan en una sola llamada
+
+    Lo propio de cada motor llega inyectado:
+      infer(req, task_id, on_chunk) — síntesis (corre en el hilo de inferencia)
+      coalesce_key(req)             — solo se fusionan peticiones con la misma clave
+      merge(req, texto)             — petición que sintetiza el texto fusionado
+      infer_stream(req, task_id, stream) — síntesis hacia un stream del cliente (opcional)
+      housekeeping()                — tarea periódica del motor, cada 10 s en un hilo (opcional)
+    La síntesis en curso comprueba active_task_id entre segmentos y aborta si cambió.
+    Sin audio_handler la cola no reproduce: el resultado (también un acierto de
+    caché) lleva audio y sr y el endpoint decide cómo sonarlo.
+    """
+    def __init__(self, infer, coalesce_key, merge, audio_handler: Optional["AudioHandler"],
+                 default_policy: str = "interrupt", idle_timeout=1200, infer_stream=None, housekeeping=None):
+        self.infer = infer
+        self.coalesce_key = coalesce_key
+        self.merge = merge
+        self.audio_handler = audio_handler
+        self.infer_stream = infer_stream
+        self.housekeeping = housekeeping
+        self.default_policy = default_policy
+        self.active_task_id = 0  # 🧠 ID de la tarea activa para interrupción radical
+        self.queue = asyncio.Queue(maxsize=QUEUE_MAX_PENDING)
+        self.carry = deque() # Tarea sacada al buscar fusiones que no encajó
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.last_activity = time.time()
+        self.idle_timeout = idle_timeout
+        self.boot_time = time.time()
+        self.metrics = {p: {"requests": 0, "syntheses": 0, "merged": 0, "dropped": 0, "audio_s": 0.0, "busy_s": 0.0}
+                        for p in SCHEDULING_POLICIES}
+
+    async def inactivity_monitor(self):
+        logger.info(f"⏳ Monitor de inactividad iniciado (Timeout: {self.idle_timeout}s)")
+        while True:
+            await asyncio.sleep(10)
+            if self.housekeeping is not None:
+                await asyncio.to_thread(self.housekeeping)
+            elapsed = time.time() - self.last_activity
+            if elapsed > self.idle_timeout:
+                logger.warning(f"😴 Inactividad detectada ({round(elapsed, 1)}s). Apagando servidor...")
+                os._exit(0)
+
+    def play_chunk(self, segment: np.ndarray, index: int, sample_rate: int):
+        """on_chunk de interrupt: el primer segmento corta lo que suena, el resto se encadena sin huecos."""
+        if index == 0:
+            self.audio_handler.play(segment, sample_rate)
+        else:
+            self.audio_handler.enqueue(segment, sample_rate)
+
+    def queue_chunk(self, segment: np.ndarray, index: int, sample_rate: int):
+        """on_chunk de fifo/coalesce: todo se encadena detrás de lo que ya suena."""
+        self.audio_handler.enqueue(segment, sample_rate)
+
+    def _take_coalescible(self, first) -> list:
+        """Saca de la cola las peticiones coalesce consecutivas compatibles con first."""
+        taken, total, key = [], len(first.text), self.coalesce_key(first)
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            req, _, _, cached, silent, stream = item
+            if (req.policy != "coalesce" or cached is not None or silent or stream is not None
+                    or total + len(req.text) + 1 > COALESCE_MAX_CHARS or self.coalesce_key(req) != key):
+                self.carry.append(item)
+                break
+            taken.append(item)
+            total += len(req.text) + 1
+        return taken
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                task = self.carry.popleft() if self.carry else await asyncio.wait_for(self.queue.get(), timeout=1.0)
+                req, task_id, fut, cached, silent, stream = task
+                batch = [task]
+                try:
+                    if fut.cancelled():
+                        # Segmento de un job cancelado que aún esperaba turno: sale de la cola sin sintetizar
+                        self.metrics[req.policy]["dropped"] += 1
+                        continue
+                    if (req.policy == "coalesce" and cached is None and not silent and stream is None
+                            and len(req.text) < COALESCE_MAX_CHARS):
+                        batch += self._take_coalescible(req)
+                    # La tarea que corre pasa a ser la activa: fifo/coalesce no abortan a nadie al encolarse
+                    self.active_task_id = task_id
+                    on_chunk = None
+                    if self.audio_handler is not None and not silent and stream is None:
+                        on_chunk = self.play_chunk if req.policy == "interrupt" else self.queue_chunk
+                    t0 = time.perf_counter()
+                    if cached is not None:
+                        res = {"status": "success", "cached": True}
+                        if on_chunk is not None:
+                            on_chunk(cached[0], 0, cached[1])
+                        elif self.audio_handler is None:
+                            res.update(audio=cached[0], sr=cached[1])
+                    elif stream is not None:
+                        res = await loop.run_in_executor(self.executor, self.infer_stream, req, task_id, stream)
+                    else:
+                        job = req
+                        if len(batch) > 1:
+                            job = self.merge(req, join_texts([t[0].text for t in batch]))
+                            logger.info(f"🧺 Coalesce: {len(batch)} textos en una síntesis (T{task_id})")
+                        res = await loop.run_in_executor(self.executor, self.infer, job, task_id, on_chunk)
+                    self._record(req.policy, batch, res, cached is not None, time.perf_counter() - t0)
+                    if res is not None and len(batch) > 1:
+                        res["coalesced"] = len(batch)
+                    for i, (_, _, f, *_) in enumerate(batch):
+                        if f.done(): continue
+                        if i == 0 or res is None: f.set_result(res)
+                        else: f.set_result({"status": res.get("status"), "coalesced_into": task_id})
+                except Exception as e:
+                    for _, _, f, *_ in batch:
+                        if not f.done(): f.set_exception(e)
+                finally:
+                    for _ in batch: self.queue.task_done()
+                    self.last_activity = time.time()
+            except asyncio.TimeoutError: pass
+
+    def _record(self, policy: str, batch: list, res: Optional[dict], cached: bool, busy_s: float):
+        m = self.metrics[policy]
+        m["busy_s"] += busy_s
+        if res is None:
+            m["dropped"] += len(batch)
+            return
+        m["syntheses"] += not cached
+        m["merged"] += len(batch) - 1
+        if "audio" in res and not cached:
+            m["audio_s"] += len(res["audio"]) / res["sr"]
+
+    def preempt(self) -> int:
+        """Petición interrupt (latest-wins): invalida la tarea en curso y descarta todo lo encolado."""
+        self.last_activity = time.time()
+        new_id = time.time_ns()
+        self.active_task_id = new_id
+
+        pending = list(self.carry)
+        self.carry.clear()
+        while not self.queue.empty():
+            try: pending.append(self.queue.get_nowait())
+            except: break
+        for req, _, f, *_ in pending:
+            self.metrics[req.policy]["dropped"] += 1
+            if not f.done(): f.set_result(None)
+            self.queue.task_done()
+        return new_id
+
+    async def submit(self, req, cached: Optional[tuple] = None, silent: bool = False, stream=None):
+        """
+        Encola según req.policy; cached=(audio, sr) reproduce sin sintetizar
+        respetando el orden; silent=True sintetiza sin reproducir (jobs);
+        stream se pasa a infer_stream y tampoco reproduce en local.
+        """
+        req.policy = req.policy or self.default_policy
+        if req.policy not in SCHEDULING_POLICIES:
+            raise HTTPException(status_code=400, detail=f"policy debe ser una de {SCHEDULING_POLICIES}")
+        self.metrics[req.policy]["requests"] += 1
+        if req.policy == "interrupt":
+            task_id = self.preempt()
+        else:
+            self.last_activity = time.time()
+            task_id = time.time_ns()
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((req, task_id, fut, cached, silent, stream))
+        return fut
+
+    async def add_task(self, req, cached: Optional[tuple] = None):
+        fut = await self.submit(req, cached)
+        return await fut
+
+    def stats(self) -> dict:
+        out = {"default_policy": self.default_policy, "pending": self.queue.qsize() + len(self.carry)}
+        for p, m in self.metrics.items():
+            s = {k: round(v, 2) if isinstance(v, float) else v for k, v in m.items()}
+            # Peticiones servidas por síntesis y segundos de audio por segundo de trabajo
+            s["requests_per_synthesis"] = round((m["requests"] - m["dropped"]) / m["syntheses"], 2) if m["syntheses"] else None
+            s["audio_s_per_busy_s"] = round(m["audio_s"] / m["busy_s"], 2) if m["busy_s"] else None
+            out[p] = s
+        return out
+
+# =======================
+# Jobs de narración (documentos largos)
+# =======================
+
+_DOC_SENTENCE_END_RE = re.compile(r"(?<=[.!?…;:。！？])[\"'»”)\]]*\s+")
+
+def split_document(text: str, max_chars: int = JOB_SEGMENT_CHARS, split_sentences=_DOC_SENTENCE_END_RE.split) -> list:
+    """[texto, fin_de_párrafo] por segmento: párrafos troceados en grupos de frases de hasta max_chars."""
+    segments = []
+    for para in re.split(r"\n\s*\n", text):
+        para = " ".join(para.split())
+        if not para:
+            continue
+        chunk = ""
+        for sentence in split_sentences(para):
+            if chunk and len(chunk) + len(sentence) + 1 > max_chars:
+                segments.append([chunk, False])
+                chunk = sentence
+            else:
+                chunk = f"{chunk} {sentence}".strip()
+        if chunk:
+            segments.append([chunk, False])
+        segments[-1][1] = True
+    return segments
+
+class WavAppender:
+    """
+    WAV int16 mono que crece por el final. La cabecera se reescribe tras cada
+    bloque, así el fichero es reproducible en todo momento; al reanudar se
+    trunca a lo que registra el último checkpoint.
+    """
+    def __init__(self, path: str, sr: int, data_bytes: int = 0):
+        self.sr = sr
+        self.data_bytes = data_bytes
+        self.f = open(path, "r+b" if data_bytes else "wb")
+        self.f.truncate(44 + data_bytes)
+        self._write_header()
+
+    def _write_header(self):
+        self.f.seek(0)
+        self.f.write(struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + self.data_bytes, b"WAVE", b"fmt ", 16, 1, 1,
+                                 self.sr, self.sr * 2, 2, 16, b"data", self.data_bytes))
+
+    def append(self, audio: np.ndarray, pause_s: float = 0.0) -> int:
+        data = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+        if pause_s:
+            data += bytes(int(self.sr * pause_s) * 2)
+        self.f.seek(44 + self.data_bytes)
+        self.f.write(data)
+        self.data_bytes += len(data)
+        self._write_header()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.data_bytes
+
+    def close(self):
+        self.f.close()
+
+class NarrationJob:
+    """
+    Estado de un job. Los segmentos se guardan una vez en JOBS_DIR/<id>.segments.json;
+    el checkpoint (<id>.json) se reescribe tras cada segmento escrito en el WAV.
+    """
+    def __init__(self, job_id: str, segments: list, params: dict, output: str):
+        self.job_id = job_id
+        self.segments = segments
+        self.params = params
+        self.output = output
+        self.status = "queued"
+        self.error = None
+        self.cancelled = False
+        self.done = 0
+        self.data_bytes = 0
+        self.sr = None
+        self.audio_s = 0.0
+        self.run_s = 0.0 # Tiempo de pared acumulado entre reanudaciones
+        self.preemptions = 0
+        self.started = None
+        self.inflight = deque() # (índice, future) de los segmentos encolados, en orden
+
+    @staticmethod
+    def _path(job_id: str, suffix: str = "json") -> str:
+        return os.path.join(JOBS_DIR, f"{job_id}.{suffix}")
+
+    def save(self, with_segments: bool = False):
+        if with_segments:
+            with open(self._path(self.job_id, "segments.json"), "w") as f:
+                json.dump(self.segments, f, ensure_ascii=False)
+        state = {k: getattr(self, k) for k in ("job_id", "params", "output", "status", "error", "done",
+                                                "data_bytes", "sr", "audio_s", "run_s", "preemptions")}
+        tmp = f"{self._path(self.job_id)}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self._path(self.job_id)) # Escritura atómica
+
+    @classmethod
+    def load(cls, job_id: str) -> "NarrationJob":
+        with open(cls._path(job_id)) as f:
+            state = json.load(f)
+        with open(cls._path(job_id, "segments.json")) as f:
+            segments = json.load(f)
+        job = cls(job_id, segments, state["params"], state["output"])
+        for k in ("status", "error", "done", "data_bytes", "sr", "audio_s", "run_s", "preemptions"):
+            setattr(job, k, state[k])
+        if job.status in ("queued", "running"): # El proceso murió a medias
+            job.status = "paused"
+        return job
+
+    def progress(self) -> dict:
+        run_s = self.run_s + (time.time() - self.started if self.status == "running" and self.started else 0.0)
+        total = len(self.segments)
+        rtf = self.audio_s / run_s if run_s > 0 else 0.0
+        remaining = total - self.done
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "error": self.error,
+            "total": total,
+            "completed": self.done,
+            "percent": round(100 * self.done / total, 1) if total else 100.0,
+            "audio_seconds": round(self.audio_s, 2),
+            "elapsed_seconds": round(run_s, 2),
+            "rtf": round(rtf, 2),
+            "eta_seconds": round(run_s / self.done * remaining, 1) if self.done else None,
+            "preemptions": self.preemptions,
+            "output": self.output,
+        }
+
+class NarrationJobManager:
+    """
+    Un job activo a la vez. Cada segmento pasa por la cola normal como fifo y
+    sin reproducción local, con JOB_PIPELINE_DEPTH segmentos encolados por
+    delante: la síntesis del siguiente se solapa con la escritura del anterior.
+    Una petición interrupt (/generate) tiene prioridad: el segmento afectado
+    se repite cuando la cola queda libre.
+
+    Del servidor llegan submit(req) -> future (la cola sin reproducción local),
+    make_request(**kwargs) (su InferenceRequest) y params(req, texto), que fija
+    voz e idioma una vez para todo el documento.
+    """
+    def __init__(self, submit, make_request, params, split_sentences=_DOC_SENTENCE_END_RE.split):
+        self.submit = submit
+        self.make_request = make_request
+        self.params = params
+        self.split_sentences = split_sentences
+        self.jobs = {}
+        self.lock = asyncio.Lock()
+        os.makedirs(JOBS_DIR, exist_ok=True)
+
+    def create(self, req) -> NarrationJob:
+        if req.file:
+            if os.path.getsize(req.file) > JOB_MAX_FILE_MB * 1024 * 1024:
+                raise ValueError(f"Fichero mayor de {JOB_MAX_FILE_MB} MB")
+            with open(req.file, encoding="utf-8") as f:
+                text = f.read()
+        else:
+            text = req.text or ""
+        segments = split_document(text, split_sentences=self.split_sentences)
+        if not segments:
+            raise ValueError("Texto vacío")
+        job_id = str(uuid.uuid4())[:8]
+        job = NarrationJob(job_id, segments, self.params(req, text), self._output(job_id, req.output))
+        job.save(with_segments=True)
+        return job
+
+    @staticmethod
+    def _output(job_id: str, output: Optional[str]) -> str:
+        """El WAV de salida queda siempre dentro de JOBS_DIR (nombre o ruta relativa)."""
+        if not output:
+            return NarrationJob._path(job_id, "wav")
+        root = os.path.realpath(JOBS_DIR)
+        path = os.path.realpath(os.path.join(root, output))
+        if os.path.commonpath([root, path]) != root or path == root or not path.lower().endswith(".wav"):
+            raise ValueError(f"output debe ser un .wav dentro de {JOBS_DIR}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def get(self, job_id: str) -> Optional[NarrationJob]:
+        job = self.jobs.get(job_id)
+        if job is None and os.path.exists(NarrationJob._path(job_id)):
+            job = NarrationJob.load(job_id)
+        return job
+
+    def start(self, job: NarrationJob):
+        job.status = "queued"
+        job.cancelled = False
+        self.jobs[job.job_id] = job
+        asyncio.create_task(self._run(job))
+
+    def cancel(self, job: NarrationJob):
+        """
+        Los segmentos encolados salen de la cola sin sintetizarse; el que está en
+        curso termina y se descarta. El checkpoint permite reanudar.
+        """
+        job.cancelled = True
+        for _, fut in job.inflight:
+            fut.cancel()
+
+    async def _run(self, job: NarrationJob):
+        async with self.lock:
+            if job.cancelled:
+                job.status = "cancelled"
+                await asyncio.to_thread(job.save)
+                return
+            job.status = "running"
+            job.started = time.time()
+            logger.info(f"📚 Job {job.job_id}: {len(job.segments) - job.done} segmentos pendientes -> {job.output}")
+            try:
+                await self._pipeline(job)
+                job.status = "cancelled" if job.cancelled else "done"
+            except Exception as e:
+                logger.error(f"💥 Job {job.job_id} fallido: {e}")
+                job.status = "error"
+                job.error = str(e)
+            finally:
+                job.run_s += time.time() - job.started
+                await asyncio.to_thread(job.save)
+            if job.status == "done":
+                logger.info(f"✅ Job {job.job_id}: {job.audio_s:.1f}s de audio en {job.run_s:.1f}s (RTF {job.audio_s / job.run_s:.2f})")
+
+    async def _pipeline(self, job: NarrationJob):
+        writer = None
+        inflight = job.inflight = deque()
+        next_i = job.done
+        try:
+            while job.done < len(job.segments) and not job.cancelled:
+                while len(inflight) < JOB_PIPELINE_DEPTH and next_i < len(job.segments):
+                    req = self.make_request(text=job.segments[next_i][0], policy="fifo", **job.params)
+                    inflight.append((next_i, await self.submit(req)))
+                    next_i += 1
+                i, fut = inflight.popleft()
+                try:
+                    res = await fut
+                except asyncio.CancelledError:
+                    if job.cancelled: break
+                    raise
+                if res is None:
+                    # Desalojado por una petición interrupt: se repite desde este segmento
+                    for _, f in inflight:
+                        await asyncio.wait([f])
+                    inflight.clear()
+                    next_i = i
+                    job.preemptions += 1
+                    continue
+                if res.get("status") == "error":
+                    raise RuntimeError(res.get("message", "Error de síntesis"))
+                audio, sr = res["audio"], res["sr"]
+                if writer is None:
+                    writer = await asyncio.to_thread(WavAppender, job.output, sr, job.data_bytes)
+                    job.sr = sr
+                pause_s = JOB_PARAGRAPH_PAUSE_S if job.segments[i][1] else 0.0
+                job.data_bytes = await asyncio.to_thread(writer.append, audio, pause_s)
+                job.audio_s += len(audio) / sr + pause_s
+                job.done = i + 1
+                await asyncio.to_thread(job.save)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def resume(self, job_id: str) -> NarrationJob:
+        job = self.jobs.get(job_id)
+        if job is not None and job.status in ("queued", "running"):
+            raise HTTPException(status_code=409, detail=f"Job {job_id} ya está en marcha")
+        job = await asyncio.to_thread(NarrationJob.load, job_id)
+        try:
+            valid = os.path.getsize(job.output) >= 44 + job.data_bytes
+        except OSError:
+            valid = False
+        if not valid and job.done:
+            logger.warning(f"⚠️ Job {job_id}: salida ausente o más corta que el checkpoint, se empieza de cero")
+            job.done, job.data_bytes, job.audio_s = 0, 0, 0.0
+        self.start(job)
+        return job
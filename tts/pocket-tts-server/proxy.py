@@ -1,81 +1,191 @@
 #!/usr/bin/env python3
+import http.client
 import http.server
-import socketserver
-import urllib.request
-import urllib.error
+import queue
 import subprocess
+import threading
 import time
 
 PORT = 8008
 REAL_PORT = 8013
 START_SCRIPT = "/Users/crotalo/desarrollo-local/server/tts/pocket-tts-server/start_pocket_tts.sh"
 
-class ProxyHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        pass # Silenciar logs por defecto
+LIVENESS_TTL = 5.0 # s que una respuesta del backend vale como prueba de vida (sin sondear /health)
+BOOT_TIMEOUT = 20.0
+POOL_SIZE = 8 # Conexiones keep-alive reutilizadas hacia el backend
+UPSTREAM_TIMEOUT = 300 # Síntesis largas / streams
+CHUNK_SIZE = 64 * 1024
+IDEMPOTENT = {"GET", "HEAD"} # Se pueden reenviar aunque el backend ya hubiera recibido la petición
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer", "upgrade"}
+
+
+def log(msg):
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+
+
+class Backend:
+    """
+    Estado compartido del servidor Pocket TTS interno: liveness cacheada,
+    arranque único aunque lleguen varias peticiones a la vez y pool de
+    conexiones HTTP/1.1 reutilizables.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.alive_until = 0.0
+        self.lock = threading.Lock()
+        self.boot_done = None # threading.Event del arranque en curso
+        self.boot_ok = False
+        self.pool = queue.LifoQueue(maxsize=POOL_SIZE) # LIFO: la conexión más reciente es la que sigue viva
+
+    def mark_alive(self):
+        self.alive_until = time.monotonic() + LIVENESS_TTL
+
+    def mark_dead(self):
+        self.alive_until = 0.0
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def get_conn(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection("127.0.0.1", self.port, timeout=UPSTREAM_TIMEOUT)
+
+    def put_conn(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
-    def wake_server(self):
+    def probe(self, timeout):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=timeout)
         try:
-            with urllib.request.urlopen(f"http://127.0.0.1:{REAL_PORT}/health", timeout=0.1) as response:
-                if response.getcode() == 200:
-                    return True
-        except:
-            pass
-        
-        print(f"[{time.strftime('%H:%M:%S')}] Despertando servidor Pocket TTS interno en puerto {REAL_PORT}...", flush=True)
+            conn.request("GET", "/health")
+            ok = conn.getresponse().status == 200
+        except OSError:
+            ok = False
+        finally:
+            conn.close()
+        if ok:
+            self.mark_alive()
+        return ok
+
+    def ensure_up(self):
+        """True si el backend responde; si no, lo arranca (una sola vez para todas las peticiones que esperan)."""
+        if time.monotonic() < self.alive_until or self.probe(0.1):
+            return True
+        with self.lock:
+            booting = self.boot_done is not None
+            if not booting:
+                self.boot_done = threading.Event()
+            done = self.boot_done
+        if booting:
+            done.wait(BOOT_TIMEOUT + 5)
+            return self.boot_ok
+        try:
+            self.boot_ok = self._boot()
+        finally:
+            with self.lock:
+                self.boot_done = None
+            done.set()
+        return self.boot_ok
+
+    def _boot(self):
+        log(f"Despertando servidor Pocket TTS interno en puerto {self.port}...")
+        self.mark_dead()
         # Alerta Sonora de Despertar
         subprocess.run(["afplay", "/System/Library/Sounds/Glass.aiff"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         subprocess.run([START_SCRIPT], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        # Esperar hasta 20 segundos
-        for _ in range(40):
+
+        deadline = time.monotonic() + BOOT_TIMEOUT
+        while time.monotonic() < deadline:
             time.sleep(0.5)
-            try:
-                with urllib.request.urlopen(f"http://127.0.0.1:{REAL_PORT}/health", timeout=0.5) as response:
-                    if response.getcode() == 200:
-                        print(f"[{time.strftime('%H:%M:%S')}] Servidor interno listo.", flush=True)
-                        return True
-            except:
-                pass
+            if self.probe(0.5):
+                log("Servidor interno listo.")
+                return True
         return False
 
+
+backend = Backend(REAL_PORT)
+
+
+class ProxyHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive con el cliente
+
+    def log_message(self, format, *args):
+        pass # Silenciar logs por defecto
+
     def forward_request(self, method):
-        print(f"[{time.strftime('%H:%M:%S')}] Proxying {method} {self.path}...", flush=True)
-        if not self.wake_server():
+        log(f"Proxying {method} {self.path}...")
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length > 0 else None
+
+        if not backend.ensure_up():
             self.send_error(503, "Servidor interno no pudo iniciar")
             return
 
-        url = f"http://127.0.0.1:{REAL_PORT}{self.path}"
-        headers = dict(self.headers)
-        
-        if 'Host' in headers:
-            headers['Host'] = f"127.0.0.1:{REAL_PORT}"
-            
-        data = None
-        if method == "POST":
-            length = int(self.headers.get('Content-Length', 0))
-            if length > 0:
-                data = self.rfile.read(length)
-                
-        req = urllib.request.Request(url, data=data, headers=headers, method=method)
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+        headers["Host"] = f"127.0.0.1:{REAL_PORT}"
+
+        # Un reintento: conexión del pool caducada o backend apagado por inactividad entre medias.
+        # Un POST ya enviado no se repite (el backend podría sintetizarlo dos veces)
+        for attempt in range(2):
+            conn = backend.get_conn()
+            sent = False
+            try:
+                conn.request(method, self.path, body=data, headers=headers)
+                sent = True
+                response = conn.getresponse()
+                break
+            except (ConnectionError, http.client.HTTPException, OSError) as e:
+                conn.close()
+                if attempt == 1 or (sent and method not in IDEMPOTENT):
+                    log(f"Proxy error: {e}")
+                    self.send_error(502, str(e))
+                    return
+                backend.mark_dead()
+                if not backend.ensure_up():
+                    self.send_error(503, "Servidor interno no pudo iniciar")
+                    return
+        backend.mark_alive()
+        self.relay(conn, response)
+
+    def relay(self, conn, response):
+        """Copia la respuesta por bloques según llega (sin bufferizar el cuerpo entero)."""
+        no_body = response.status in (204, 304) or response.status < 200
+        chunked = response.getheader("Content-Length") is None and not no_body
+        self.send_response(response.status, response.reason)
+        for k, v in response.getheaders():
+            if k.lower() not in HOP_BY_HOP:
+                self.send_header(k, v)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
         try:
-            with urllib.request.urlopen(req) as response:
-                self.send_response(response.getcode())
-                for k, v in response.headers.items():
-                    if k.lower() not in ['transfer-encoding', 'connection']:
-                        self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(response.read())
-        except urllib.error.HTTPError as e:
-            self.send_response(e.code)
-            for k, v in e.headers.items():
-                if k.lower() not in ['transfer-encoding', 'connection']:
-                    self.send_header(k, v)
-            self.end_headers()
-            self.wfile.write(e.read())
-        except Exception as e:
-            print(f"[{time.strftime('%H:%M:%S')}] Proxy error: {e}", flush=True)
-            self.send_error(500, str(e))
+            while not no_body:
+                block = response.read1(CHUNK_SIZE)
+                if not block:
+                    break
+                if chunked:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(block), block))
+                else:
+                    self.wfile.write(block)
+                self.wfile.flush()
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+            response.read() # Con Content-Length read1() no cierra la respuesta al llegar al final
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente cortó: se cierra también la conexión con el backend (detiene el stream allí)
+            conn.close()
+            self.close_connection = True
+            return
+        if response.isclosed() and not response.will_close:
+            backend.put_conn(conn) # Solo respuestas consumidas enteras: si no, la siguiente daría ResponseNotReady
+        else:
+            conn.close()
 
     def do_GET(self):
         self.forward_request("GET")
@@ -83,6 +193,12 @@ class ProxyHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     def do_POST(self):
         self.forward_request("POST")
 
-with socketserver.TCPServer(("", PORT), ProxyHTTPRequestHandler) as httpd:
-    print(f"[{time.strftime('%H:%M:%S')}] Proxy interceptor (Pocket TTS) activo en puerto {PORT}. Consumo RAM: ~10MB.", flush=True)
+
+class ThreadingProxyServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+with ThreadingProxyServer(("", PORT), ProxyHTTPRequestHandler) as httpd:
+    log(f"Proxy interceptor (Pocket TTS) activo en puerto {PORT}. Consumo RAM: ~10MB.")
     httpd.serve_forever()
@@ -1,20 +1,49 @@
 import time
 import os
+import sys
+import gc
 import threading
 import json
 import argparse
 import subprocess
 import logging
 import asyncio
-import wave
+import re
+import io
+import shutil
+import struct
+from collections import OrderedDict, Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import numpy as np
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import FastAPI, HTTPException, Response, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from pocket_tts import TTSModel
 
+# Piezas comunes con los servidores MLX (reproducción, caché, idioma, cola, jobs): un solo módulo en
+# ../engine-mlx, que no importa MLX. Este servidor necesita el directorio hermano en el mismo checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "engine-mlx"))
+from tts_common import AudioHandler, AudioCache, _file_version, LanguageRouter, QueueManager, NarrationJobManager
+
+# Codificadores en proceso (opcionales). Sin ninguno, mp3/opus/aac/flac
+# caen a ffmpeg si está instalado y, si no, a WAV (stdlib).
+try:
+    import lameenc  # MP3 con LAME embebido: pip install lameenc
+except ImportError:
+    lameenc = None
+try:
+    import av  # PyAV (libav* embebido en la wheel): opus/aac/flac/mp3
+except ImportError:
+    av = None
+try:
+    from langdetect import DetectorFactory, detect_langs
+    DetectorFactory.seed = 0  # Resultados deterministas
+except ImportError:
+    detect_langs = None
+
 # =======================
 # Logging & Configuration
 # =======================
@@ -24,30 +53,97 @@ logger = logging.getLogger("POCKET_TTS_SERVER")
 
 IDLE_TIMEOUT = 1200 # 20 minutos
 
+# Residencia de modelos (uno por idioma) y voice states
+LANG_MODEL_MAP = {"en": "english", "es": "spanish_24l", "fr": "french_24l", "it": "italian_24l"}
+MEMORY_BUDGET_MB = int(os.environ.get("POCKET_TTS_MEMORY_BUDGET_MB", "3072"))
+MODEL_IDLE_EVICT = 600 # 10 minutos sin uso -> se descarga el modelo de ese idioma
+MAX_VOICE_STATES = 16
+FALLBACK_MODEL_MB = 600 # Si el modelo no expone parámetros torch
+
+# Streaming por frases
+MIN_SENTENCE_CHARS = 24 # Fragmentos más cortos se unen al siguiente (prosodia)
+MAX_SENTENCE_CHARS = 280 # Frases más largas se parten por comas
+
+# Codificación de audio
+ENCODER_WORKERS = 2
+MP3_BITRATE_KBPS = 128
+COMPRESSED_BITRATE = 64000 # opus / aac
+FFMPEG_BIN = shutil.which("ffmpeg") or ("/opt/homebrew/bin/ffmpeg" if os.path.exists("/opt/homebrew/bin/ffmpeg") else None)
+
+# Planificación de la cola (el resto de parámetros de cola, caché, reproducción y jobs: ../engine-mlx/tts_common.py)
+DEFAULT_POLICY = os.environ.get("POCKET_TTS_POLICY", "interrupt")
+
 class InferenceRequest(BaseModel):
     text: str
     voice: Optional[str] = None
+    lang: Optional[str] = None # Si falta se detecta (una vez, a la entrada)
+    session: Optional[str] = None # Conversación: el idioma se mantiene en textos ambiguos
+    policy: Optional[str] = None # interrupt (latest-wins) | fifo | coalesce
 
 class OpenAISpeechRequest(BaseModel):
     model: str
     input: str
     voice: Optional[str] = "alloy"
-    response_format: Optional[str] = "wav"
+    response_format: Optional[str] = "mp3" # mp3 | opus | aac | flac | wav | pcm
     speed: Optional[float] = 1.0
+    stream: Optional[bool] = False # Audio troceado por frases (chunked transfer)
+    session: Optional[str] = None
+    policy: Optional[str] = None # coalesce se trata como fifo: cada respuesta lleva su propio audio
+
+class NarrationJobRequest(BaseModel):
+    text: Optional[str] = None
+    file: Optional[str] = None # Ruta local a un .txt/.md (alternativa a text)
+    voice: Optional[str] = None
+    output: Optional[str] = None # WAV de salida dentro de JOBS_DIR (por defecto <id>.wav)
 
 # =======================
 # Model Manager
 # =======================
 
+def _tensor_bytes(obj) -> int:
+    """Bytes ocupados por los tensores contenidos en obj (dict/list/tuple anidados)."""
+    if hasattr(obj, "element_size") and hasattr(obj, "numel"):
+        return obj.element_size() * obj.numel()
+    if isinstance(obj, dict):
+        return sum(_tensor_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_tensor_bytes(v) for v in obj)
+    return 0
+
+def _model_bytes(model) -> int:
+    try:
+        tensors = list(model.parameters()) + list(model.buffers())
+        total = sum(t.element_size() * t.numel() for t in tensors)
+        if total:
+            return total
+    except Exception:
+        pass
+    return FALLBACK_MODEL_MB * 1024 * 1024
+
 class ModelManager:
+    """
+    Gestor de residencia: mantiene en memoria los modelos por idioma y los
+    voice states dentro de MEMORY_BUDGET_MB, desaloja por LRU (nunca el idioma
+    en uso) y precarga en segundo plano el idioma que se espera a continuación
+    (transiciones observadas es->en->es...), para que cambiar de idioma en una
+    conversación no bloquee la petición en una carga síncrona.
+    """
     def __init__(self):
-        self.models = {}
-        self.lock = threading.Lock()
-        self.active_task_id = 0
+        self.models = OrderedDict()        # lang_arg -> TTSModel (orden LRU)
+        self.model_bytes = {}
+        self.voice_states = OrderedDict()  # (lang_arg, voz) -> state (orden LRU)
+        self.voice_bytes = {}
+        self.last_used = {}
+        self.lock = threading.RLock()
+        self.loading = {}                  # lang_arg -> threading.Event (carga en curso)
+        self.pinned = None                 # idioma generando ahora mismo
         self.assets_dir = os.path.join(os.path.dirname(__file__), "assets")
         self.config_path = os.path.join(self.assets_dir, "voices_config.json")
         self.voices_config = {}
-        self.voice_states = {}
+        self.transitions = defaultdict(Counter)
+        self.last_lang = None
+        self.last_voice = {}               # lang -> última voz usada
+        self.stats = {"loads": 0, "preloads": 0, "preload_waits": 0, "evictions": 0, "voice_evictions": 0}
         self._load_config()
 
     def _load_config(self):
@@ -58,86 +154,316 @@ class ModelManager:
             logger.error(f"No se pudo cargar voices_config.json: {e}")
             self.voices_config = {}
 
-    def load(self, language: str):
-        lang_str_map = {"en": "english", "es": "spanish_24l", "fr": "french_24l", "it": "italian_24l"}
-        lang_arg = lang_str_map.get(language, "english")
-        
-        with self.lock:
-            if lang_arg not in self.models:
-                logger.info(f"🚀 Cargando Pocket TTS ({lang_arg})...")
+    def _used_bytes(self) -> int:
+        return sum(self.model_bytes.values()) + sum(self.voice_bytes.values())
+
+    def _evict_model(self, lang_arg: str, reason: str):
+        self.models.pop(lang_arg, None)
+        freed = self.model_bytes.pop(lang_arg, 0)
+        for key in [k for k in self.voice_states if k[0] == lang_arg]:
+            self.voice_states.pop(key)
+            freed += self.voice_bytes.pop(key, 0)
+            self.stats["voice_evictions"] += 1
+        self.stats["evictions"] += 1
+        gc.collect()
+        logger.info(f"♻️ Modelo {lang_arg} desalojado ({reason}, {freed / 2**20:.0f} MB liberados)")
+
+    def _make_room(self, needed: int, keep: str):
+        """Desaloja modelos LRU (con sus voice states) hasta que `needed` bytes quepan en el presupuesto."""
+        budget = MEMORY_BUDGET_MB * 1024 * 1024
+        for lang_arg in list(self.models):
+            if self._used_bytes() + needed <= budget:
+                return
+            if lang_arg not in (keep, self.pinned):
+                self._evict_model(lang_arg, "presupuesto")
+        if self._used_bytes() + needed > budget:
+            logger.warning(f"⚠️ Presupuesto de memoria excedido ({(self._used_bytes() + needed) / 2**20:.0f}/{MEMORY_BUDGET_MB} MB)")
+
+    def load(self, language: str, background: bool = False):
+        lang_arg = LANG_MODEL_MAP.get(language, "english")
+
+        while True:
+            with self.lock:
+                if lang_arg in self.models:
+                    self.models.move_to_end(lang_arg)
+                    self.last_used[lang_arg] = time.time()
+                    return self.models[lang_arg]
+                pending = self.loading.get(lang_arg)
+                if pending is None:
+                    pending = self.loading[lang_arg] = threading.Event()
+                    break
+            # Otra hebra (normalmente la precarga) ya lo está cargando: esperar a que termine
+            if not background:
+                self.stats["preload_waits"] += 1
+                logger.info(f"⏳ Esperando precarga en curso de {lang_arg}...")
+            pending.wait()
+            if background:
+                return None
+
+        try:
+            logger.info(f"🚀 Cargando Pocket TTS ({lang_arg}){' en segundo plano' if background else ''}...")
+            if not background:
                 subprocess.run(["afplay", "/System/Library/Sounds/Ping.aiff"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                self.models[lang_arg] = TTSModel.load_model(language=lang_arg)
-                logger.info(f"✨ Sistema Pocket TTS ({lang_arg}) Listo.")
-            return self.models[lang_arg]
+            model = TTSModel.load_model(language=lang_arg)
+            size = _model_bytes(model)
+            with self.lock:
+                self._make_room(size, keep=lang_arg)
+                self.models[lang_arg] = model
+                self.model_bytes[lang_arg] = size
+                self.last_used[lang_arg] = time.time()
+                self.stats["preloads" if background else "loads"] += 1
+            logger.info(f"✨ Sistema Pocket TTS ({lang_arg}) Listo. ({size / 2**20:.0f} MB, residentes: {list(self.models)})")
+            return model
+        finally:
+            with self.lock:
+                self.loading.pop(lang_arg).set()
 
     def get_service(self, language: str):
-        lang_str_map = {"en": "english", "es": "spanish_24l", "fr": "french_24l", "it": "italian_24l"}
-        lang_arg = lang_str_map.get(language, "english")
-        
-        if lang_arg not in self.models:
-            self.load(language)
-        return self.models[lang_arg]
+        return self.load(language)
 
     def get_voice_state(self, voice_name_or_path: str, language: str):
-        cache_key = f"{language}_{voice_name_or_path}"
-        if cache_key in self.voice_states:
-            return self.voice_states[cache_key]
-        
+        lang_arg = LANG_MODEL_MAP.get(language, "english")
+        cache_key = (lang_arg, voice_name_or_path)
+        with self.lock:
+            if cache_key in self.voice_states:
+                self.voice_states.move_to_end(cache_key)
+                return self.voice_states[cache_key]
+
         tts = self.get_service(language)
         state = tts.get_state_for_audio_prompt(voice_name_or_path)
-        self.voice_states[cache_key] = state
+        size = _tensor_bytes(state)
+        with self.lock:
+            self._make_room(size, keep=lang_arg)
+            self.voice_states[cache_key] = state
+            self.voice_bytes[cache_key] = size
+            while len(self.voice_states) > MAX_VOICE_STATES:
+                old, _ = self.voice_states.popitem(last=False)
+                self.voice_bytes.pop(old, None)
+                self.stats["voice_evictions"] += 1
         return state
 
+    def record_request(self, language: str, voice: str):
+        """Registra la transición de idioma y precarga el idioma previsto para la siguiente petición."""
+        with self.lock:
+            if self.last_lang is not None:
+                self.transitions[self.last_lang][language] += 1
+            self.last_lang = language
+            self.last_voice[language] = voice
+        predicted = self.predict_next(language)
+        if predicted and LANG_MODEL_MAP.get(predicted, "english") not in self.models:
+            threading.Thread(target=self._preload, args=(predicted,), daemon=True, name="PocketPreload").start()
+
+    def predict_next(self, language: str) -> Optional[str]:
+        """Idioma más probable tras `language` según las transiciones vistas (None si es el mismo)."""
+        successors = self.transitions.get(language)
+        if not successors:
+            return None
+        predicted, _ = successors.most_common(1)[0]
+        return predicted if predicted != language else None
+
+    def _preload(self, language: str):
+        try:
+            if self.load(language, background=True) is None:
+                return
+            voice = self.last_voice.get(language)
+            if voice:
+                self.get_voice_state(voice, language)
+        except Exception as e:
+            logger.error(f"⚠️ Precarga de {language} fallida: {e}")
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            for lang_arg in list(self.models):
+                if lang_arg != self.pinned and now - self.last_used.get(lang_arg, now) > MODEL_IDLE_EVICT:
+                    self._evict_model(lang_arg, "inactivo")
+
+    def residency(self) -> dict:
+        with self.lock:
+            return {
+                "budget_mb": MEMORY_BUDGET_MB,
+                "used_mb": round(self._used_bytes() / 2**20, 1),
+                "models": list(self.models),
+                "loading": list(self.loading),
+                "voice_states": len(self.voice_states),
+                **self.stats,
+            }
+
 # =======================
-# Audio Handler (Atomic)
+# Audio Encoders (in-process)
 # =======================
 
-class AudioHandler:
-    def __init__(self):
-        self.current_process = None
-        self.lock = threading.Lock()
+AUDIO_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+    "pcm": "audio/pcm",
+}
+# formato -> (formato de contenedor PyAV / ffmpeg, códec)
+AV_FORMATS = {"mp3": ("mp3", "libmp3lame"), "opus": ("ogg", "libopus"), "aac": ("adts", "aac"), "flac": ("flac", "flac")}
+
+def _av_supports(codec: str) -> bool:
+    try:
+        av.codec.Codec(codec, "w")
+        return True
+    except Exception:
+        return False
+
+def _resolve_backends() -> dict:
+    """Backend por formato, resuelto una vez al arrancar (en proceso > ffmpeg > wav)."""
+    backends = {"wav": "wave", "pcm": "raw"}
+    for fmt, (_, codec) in AV_FORMATS.items():
+        if fmt == "mp3" and lameenc is not None:
+            backends[fmt] = "lameenc"
+        elif av is not None and _av_supports(codec):
+            backends[fmt] = "av"
+        elif FFMPEG_BIN:
+            backends[fmt] = "ffmpeg"
+        else:
+            backends[fmt] = None
+    return backends
+
+ENCODER_BACKENDS = _resolve_backends()
+encoder_pool = ThreadPoolExecutor(max_workers=ENCODER_WORKERS, thread_name_prefix="AudioEncoder")
+
+def _to_int16(audio_data: np.ndarray) -> np.ndarray:
+    return (np.clip(audio_data.squeeze(), -1.0, 1.0) * 32767).astype(np.int16) if audio_data.dtype != np.int16 else audio_data
+
+def _wav_header(sr: int, n_bytes: int = 0xFFFFFFFF) -> bytes:
+    # n_bytes a 0xFFFFFFFF: longitud desconocida (stream), los reproductores leen hasta EOF
+    riff = 0xFFFFFFFF if n_bytes == 0xFFFFFFFF else n_bytes + 36
+    return (b"RIFF" + struct.pack("<I", riff) + b"WAVEfmt "
+            + struct.pack("<IHHIIHH", 16, 1, 1, sr, sr * 2, 2, 16)
+            + b"data" + struct.pack("<I", n_bytes))
+
+class AudioEncoder:
+    """
+    Codificador incremental de PCM int16 mono: encode(pcm) -> bytes, flush() -> bytes.
+    Con streaming=True cada encode devuelve lo ya codificable (stream chunked);
+    si no, todo sale en flush() (respuesta completa, cabeceras con tamaño real).
+    Las llamadas de un mismo encoder deben ser secuenciales (van al encoder_pool).
+    """
+    def __init__(self, fmt: str, sr: int, streaming: bool = False):
+        self.backend = ENCODER_BACKENDS.get(fmt)
+        if self.backend is None:
+            logger.warning(f"⚠️ Sin codificador para '{fmt}' en este sistema: se entrega WAV")
+            fmt, self.backend = "wav", "wave"
+        self.fmt = fmt
+        self.sr = sr
+        self.streaming = streaming
+        self.media_type = AUDIO_MEDIA_TYPES[fmt]
+        self._pending = []
+        self._started = False
+
+        if self.backend == "lameenc":
+            self._lame = lameenc.Encoder()
+            self._lame.set_bit_rate(MP3_BITRATE_KBPS)
+            self._lame.set_in_sample_rate(sr)
+            self._lame.set_channels(1)
+            self._lame.set_quality(2)
+        elif self.backend == "av":
+            container_fmt, codec = AV_FORMATS[fmt]
+            self._buf = io.BytesIO()
+            self._sent = 0
+            self._container = av.open(self._buf, mode="w", format=container_fmt)
+            self._stream = self._container.add_stream(codec, rate=sr)
+            self._stream.layout = "mono"
+            if fmt != "flac":
+                self._stream.bit_rate = MP3_BITRATE_KBPS * 1000 if fmt == "mp3" else COMPRESSED_BITRATE
+            self._pts = 0
+
+    def encode(self, pcm: np.ndarray) -> bytes:
+        pcm = _to_int16(pcm)
+        if self.backend == "raw":
+            return pcm.tobytes()
+        if self.backend == "wave":
+            if not self.streaming:
+                self._pending.append(pcm.tobytes())
+                return b""
+            header = b"" if self._started else _wav_header(self.sr)
+            self._started = True
+            return header + pcm.tobytes()
+        if self.backend == "lameenc":
+            data = bytes(self._lame.encode(pcm.tobytes()))
+            if self.streaming:
+                return data
+            self._pending.append(data)
+            return b""
+        if self.backend == "av":
+            frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format="s16", layout="mono")
+            frame.sample_rate = self.sr
+            frame.pts = self._pts
+            self._pts += len(pcm)
+            self._container.mux(self._stream.encode(frame))
+            return self._drain() if self.streaming else b""
+        # ffmpeg: un proceso por bloque (solo como último recurso)
+        if self.streaming:
+            return self._ffmpeg(pcm.tobytes())
+        self._pending.append(pcm.tobytes())
+        return b""
+
+    def flush(self) -> bytes:
+        if self.backend == "raw":
+            return b""
+        if self.backend == "wave":
+            if self.streaming:
+                return b"" if self._started else _wav_header(self.sr)
+            data = b"".join(self._pending)
+            return _wav_header(self.sr, len(data)) + data
+        if self.backend == "lameenc":
+            tail = bytes(self._lame.flush())
+            return tail if self.streaming else b"".join(self._pending) + tail
+        if self.backend == "av":
+            self._container.mux(self._stream.encode(None))
+            self._container.close()
+            return self._drain() if self.streaming else self._buf.getvalue()
+        return b"" if self.streaming else self._ffmpeg(b"".join(self._pending))
+
+    def _drain(self) -> bytes:
+        data = self._buf.getvalue()[self._sent:]
+        self._sent += len(data)
+        return data
+
+    def _ffmpeg(self, raw: bytes) -> bytes:
+        container_fmt, codec = AV_FORMATS[self.fmt]
+        process = subprocess.Popen(
+            [FFMPEG_BIN, '-y', '-f', 's16le', '-ar', str(self.sr), '-ac', '1', '-i', 'pipe:0', '-c:a', codec, '-f', container_fmt, 'pipe:1'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        out, _ = process.communicate(input=raw)
+        return out
 
-    def play(self, audio_data: np.ndarray, sample_rate: int):
-        threading.Thread(target=self._play_sync, args=(audio_data, sample_rate), daemon=True).start()
+async def encode_audio(audio_data: np.ndarray, sr: int, fmt: str):
+    """Codifica un audio completo en el encoder_pool. Devuelve (bytes, media_type)."""
+    def run():
+        encoder = AudioEncoder(fmt, sr)
+        return encoder.encode(audio_data) + encoder.flush(), encoder.media_type
+    return await asyncio.get_running_loop().run_in_executor(encoder_pool, run)
 
-    def _play_sync(self, audio_data: np.ndarray, sample_rate: int):
-        with self.lock:
-            try:
-                if self.current_process and self.current_process.poll() is None:
-                    self.current_process.terminate()
-                path = f"/tmp/pockettts_{time.time_ns()}.wav"
-                
-                # audio_data is a numpy array from torch tensor PCM data (float32, -1 to 1).
-                # Convert to int16 before saving to wav.
-                data = (np.clip(audio_data.squeeze(), -1.0, 1.0) * 32767).astype(np.int16) if audio_data.dtype != np.int16 else audio_data
-                
-                with wave.open(path, 'wb') as wf:
-                    wf.setnchannels(1)
-                    wf.setsampwidth(2)
-                    wf.setframerate(sample_rate)
-                    wf.writeframes(data.tobytes())
-                
-                # Play audio locally
-                subprocess.run(["afplay", path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                try:
-                    os.remove(path)
-                except: pass
-            except Exception as e: logger.error(f"Audio Error: {e}")
+# =======================
+# Language Router
+# =======================
+
+def _langdetect_best(text: str):
+    if detect_langs is None:
+        return None, 0.0
+    for candidate in detect_langs(text):
+        if candidate.lang in LANG_MODEL_MAP:
+            return candidate.lang, candidate.prob
+    return None, 0.0
+
+language_router = LanguageRouter(LANG_MODEL_MAP.keys(), "en", _langdetect_best)
 
 # =======================
 # Inference Logic
 # =======================
 
-def get_voice_and_lang(text: str, voice_str: str, config: dict):
-    # Detect language basic
-    lang = "en"
-    try:
-        import langdetect
-        det = langdetect.detect(text)
-        if det in ["en", "es", "fr", "it"]:
-            lang = det
-    except:
-        pass
+def get_voice_and_lang(text: str, voice_str: str, config: dict, session: Optional[str] = None, lang: Optional[str] = None):
+    lang = lang or language_router.resolve(text, session)
         
     v_lower = voice_str.lower() if voice_str else ""
     
@@ -154,26 +480,100 @@ def get_voice_and_lang(text: str, voice_str: str, config: dict):
 
     return target, lang
 
-def perform_inference(request: InferenceRequest, task_id: int):
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…;:。！？])[\"'»”)\]]*\s+|\n+")
+_CLAUSE_END_RE = re.compile(r"(?<=[,，])\s+")
+
+def split_sentences(text: str) -> list:
+    """
+    Trocea el texto en frases para síntesis incremental. Los fragmentos muy
+    cortos se unen al siguiente y los muy largos se parten por comas, para
+    que la primera frase salga pronto sin romper la entonación.
+    """
+    pieces = []
+    for part in _SENTENCE_END_RE.split(text.strip()):
+        part = part.strip()
+        if not part:
+            continue
+        if len(part) > MAX_SENTENCE_CHARS:
+            chunk = ""
+            for clause in _CLAUSE_END_RE.split(part):
+                if chunk and len(chunk) + len(clause) > MAX_SENTENCE_CHARS:
+                    pieces.append(chunk)
+                    chunk = clause
+                else:
+                    chunk = f"{chunk} {clause}".strip()
+            if chunk:
+                pieces.append(chunk)
+        else:
+            pieces.append(part)
+
+    sentences = []
+    for piece in pieces:
+        if sentences and len(sentences[-1]) < MIN_SENTENCE_CHARS:
+            sentences[-1] = f"{sentences[-1]} {piece}"
+        else:
+            sentences.append(piece)
+    return sentences
+
+def route_language(request: InferenceRequest):
+    """
+    Una detección y un commit de sesión por petición, a la entrada: el idioma
+    queda fijado en request.lang y caché, cola e inferencia ya no lo recalculan.
+    """
+    request.lang = request.lang or language_router.resolve(request.text.strip(), request.session)
+    language_router.commit(request.session, request.lang)
+
+def audio_cache_key(request: InferenceRequest, fmt: Optional[str] = None) -> Optional[str]:
+    """Clave del PCM; con fmt, la de la respuesta ya codificada en ese formato."""
+    encoding = {}
+    if fmt is not None:
+        backend = ENCODER_BACKENDS.get(fmt)
+        if fmt not in AV_FORMATS or backend is None:
+            return None # wav/pcm cuestan poco; sin codificador se entrega WAV
+        encoding = {"format": fmt, "encoder": backend, "bitrate": MP3_BITRATE_KBPS * 1000 if fmt == "mp3" else COMPRESSED_BITRATE}
+    v_target, lang = get_voice_and_lang(request.text.strip(), request.voice, manager.voices_config, request.session, request.lang)
+    return AudioCache.key(
+        "pocket-tts", request.text,
+        model=LANG_MODEL_MAP.get(lang, "english"), voice=v_target, voice_version=_file_version(v_target), lang=lang,
+        **encoding,
+    )
+
+def coalesce_key(request: InferenceRequest) -> tuple:
+    """Solo se fusionan textos que comparten voz e idioma."""
+    return get_voice_and_lang(request.text.strip(), request.voice, manager.voices_config, request.session, request.lang)
+
+def merge_request(request: InferenceRequest, text: str) -> InferenceRequest:
+    return request.model_copy(update={"text": text})
+
+def evict_idle_models():
+    """Tarea periódica de la cola: descarga los idiomas sin uso."""
+    if manager is not None:
+        manager.evict_idle()
+
+def perform_inference(request: InferenceRequest, task_id: int, on_chunk=None):
     start_t = time.perf_counter()
     text = request.text.strip()
     
-    v_target, lang = get_voice_and_lang(text, request.voice, manager.voices_config)
+    v_target, lang = get_voice_and_lang(text, request.voice, manager.voices_config, request.session, request.lang)
     
     logger.info(f"🎙️ Task: Pocket TTS | TaskID: {task_id} | ReqVoice: {request.voice} -> Target: {v_target} | Lang: {lang}")
 
-    tts_engine = manager.get_service(lang)
-    
+    manager.pinned = LANG_MODEL_MAP.get(lang, "english")
     try:
+        tts_engine = manager.get_service(lang)
         voice_state = manager.get_voice_state(v_target, lang)
         
         # Generar audio con Pocket TTS
         audio = tts_engine.generate_audio(voice_state, text)
         audio_np = audio.numpy()
+        # Precarga del idioma previsto mientras el cliente reproduce este audio
+        manager.record_request(lang, v_target)
         
-        if manager.active_task_id != task_id:
+        if queue_mgr.active_task_id != task_id:
             logger.info(f"🛑 Tarea {task_id} interrumpida.")
             return None
+        if on_chunk is not None:
+            on_chunk(audio_np, 0, tts_engine.sample_rate)
 
         dt = time.perf_counter() - start_t
         # Estimación de RTF
@@ -192,120 +592,280 @@ def perform_inference(request: InferenceRequest, task_id: int):
     except Exception as e:
         logger.error(f"💥 Inference Fault (T{task_id}): {e}")
         return {"status": "error", "message": str(e)}
+    finally:
+        manager.pinned = None
+
+def perform_inference_stream(request: InferenceRequest, task_id: int, stream: "AudioStream"):
+    """
+    Igual que perform_inference pero frase a frase: cada frase sintetizada se
+    emite al stream mientras el bucle de eventos codifica y envía la anterior.
+    Se corta entre frases si llega una tarea nueva o el cliente se desconecta.
+    """
+    start_t = time.perf_counter()
+    text = request.text.strip()
+
+    v_target, lang = get_voice_and_lang(text, request.voice, manager.voices_config, request.session, request.lang)
+    sentences = split_sentences(text)
+
+    logger.info(f"🎙️ Task: Pocket TTS (stream) | TaskID: {task_id} | ReqVoice: {request.voice} -> Target: {v_target} | Lang: {lang} | Frases: {len(sentences)}")
+
+    manager.pinned = LANG_MODEL_MAP.get(lang, "english")
+    try:
+        tts_engine = manager.get_service(lang)
+        voice_state = manager.get_voice_state(v_target, lang)
+        stream.emit("start", tts_engine.sample_rate)
+
+        chunks = []
+        first_chunk_s = None
+        for i, sentence in enumerate(sentences):
+            if queue_mgr.active_task_id != task_id or stream.closed:
+                logger.info(f"🛑 Tarea {task_id} interrumpida en frase {i + 1}/{len(sentences)}.")
+                return None
+            audio_np = tts_engine.generate_audio(voice_state, sentence).numpy()
+            chunks.append(audio_np)
+            if first_chunk_s is None:
+                first_chunk_s = time.perf_counter() - start_t
+            stream.emit("audio", audio_np)
+
+        manager.record_request(lang, v_target)
+
+        dt = time.perf_counter() - start_t
+        duration = sum(len(c) for c in chunks) / tts_engine.sample_rate
+        rtf = round(duration/dt, 2)
+        logger.info(f"✅ Success (T{task_id}): {round(dt, 2)}s | Primer audio: {first_chunk_s:.2f}s | Gen duration: {duration:.2f}s | Speedup: {rtf}x")
+
+        return {
+            "status": "success",
+            "sr": tts_engine.sample_rate,
+            "voice": v_target,
+            "rtf": rtf,
+            "first_chunk_s": round(first_chunk_s, 3),
+            "sentences": len(sentences),
+            "audio": np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32),
+        }
+
+    except Exception as e:
+        logger.error(f"💥 Inference Fault (T{task_id}): {e}")
+        return {"status": "error", "message": str(e)}
+    finally:
+        manager.pinned = None
+
+class AudioStream:
+    """Puente hilo de inferencia -> bucle de eventos para el audio por frases."""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.events = asyncio.Queue()
+        self.closed = False
+
+    def emit(self, kind: str, data):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (kind, data))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, None)
 
 # =======================
-# API (Queue Managed)
+# Jobs de narración (documentos largos)
 # =======================
 
-class QueueManager:
-    def __init__(self, idle_timeout=1200):
-        self.queue = asyncio.Queue(maxsize=1)
-        self.last_activity = time.time()
-        self.idle_timeout = idle_timeout
-        self.boot_time = time.time()
-
-    async def inactivity_monitor(self):
-        logger.info(f"⏳ Monitor de inactividad iniciado (Timeout: {self.idle_timeout}s)")
-        while True:
-            await asyncio.sleep(10)
-            elapsed = time.time() - self.last_activity
-            if elapsed > self.idle_timeout:
-                logger.warning(f"😴 Inactividad detectada ({round(elapsed, 1)}s). Apagando servidor completamente (Zero-Residues)...")
-                import os
-                os._exit(0)
-
-    async def worker(self):
-        while True:
-            try:
-                task = await asyncio.wait_for(self.queue.get(), timeout=1.0)
-                req, task_id, fut = task
-                try:
-                    res = await asyncio.to_thread(perform_inference, req, task_id)
-                    if not fut.done(): fut.set_result(res)
-                except Exception as e:
-                    if not fut.done(): fut.set_exception(e)
-                finally: 
-                    self.queue.task_done()
-                    self.last_activity = time.time()
-            except asyncio.TimeoutError: pass
-
-    async def add_task(self, req: InferenceRequest):
-        self.last_activity = time.time()
-        new_id = time.time_ns()
-        manager.active_task_id = new_id
-        
-        while not self.queue.empty():
-            try:
-                _, _, f = self.queue.get_nowait()
-                if not f.done(): f.set_result(None)
-                self.queue.task_done()
-            except: break
-        
-        fut = asyncio.get_running_loop().create_future()
-        await self.queue.put((req, new_id, fut))
-        return await fut
+def job_params(req: NarrationJobRequest, text: str) -> dict:
+    """El idioma se fija una vez para todo el documento (detección sobre el principio)."""
+    return {"voice": req.voice, "lang": language_router.resolve(text[:2000])}
 
 app = FastAPI()
 manager = None
 audio_handler = AudioHandler()
-queue_mgr = QueueManager(idle_timeout=IDLE_TIMEOUT)
+# Sin audio_handler: la cola no reproduce, cada endpoint suena (o no) el audio que recibe
+queue_mgr = QueueManager(perform_inference, coalesce_key, merge_request, None, default_policy=DEFAULT_POLICY,
+                         idle_timeout=IDLE_TIMEOUT, infer_stream=perform_inference_stream, housekeeping=evict_idle_models)
+audio_cache = AudioCache()
+job_mgr = NarrationJobManager(queue_mgr.submit, InferenceRequest, job_params, split_sentences=split_sentences)
 
 @app.on_event("startup")
 async def start():
     logger.info(f"⏱️ Servidor Pocket TTS listo en {round(time.time() - queue_mgr.boot_time, 3)}s")
     asyncio.create_task(queue_mgr.worker())
     asyncio.create_task(queue_mgr.inactivity_monitor())
+    asyncio.get_running_loop().run_in_executor(None, language_router.warm)
 
 @app.get("/health")
-async def health(): return {"status": "ok", "ready": True}
+async def health():
+    return {"status": "ok", "ready": True, "residency": manager.residency() if manager else None, "encoders": ENCODER_BACKENDS, "audio_cache": audio_cache.stats(), "playback": audio_handler.status(), "language": language_router.status(), "scheduler": queue_mgr.stats()}
 
 @app.post("/generate")
 async def generate(request: InferenceRequest):
     try:
-        res = await queue_mgr.add_task(request)
+        await asyncio.to_thread(route_language, request)
+        key = await asyncio.to_thread(audio_cache_key, request)
+        hit = await asyncio.to_thread(audio_cache.get, key)
+        if hit is not None and (request.policy or DEFAULT_POLICY) == "interrupt":
+            # Acierto: sin cola ni inferencia; sigue interrumpiendo lo anterior (latest-wins)
+            queue_mgr.metrics["interrupt"]["requests"] += 1
+            queue_mgr.preempt()
+            audio_handler.play(*hit)
+            return {"status": "success", "cached": True}
+        # fifo/coalesce: un acierto también pasa por la cola para sonar en orden, sin sintetizar
+        res = await queue_mgr.add_task(request, cached=hit)
         if res is None: return {"status": "interrupted"}
-        if res["status"] == "error": return res
+        if res["status"] == "error" or "audio" not in res: return res
         audio = res.pop("audio")
         sr = res.pop("sr")
-        audio_handler.play(audio, sr)
+        if request.policy == "interrupt":
+            audio_handler.play(audio, sr)
+        else:
+            audio_handler.enqueue(audio, sr)
+        if not res.get("cached") and "coalesced" not in res: # El audio fusionado no corresponde a este texto solo
+            await asyncio.to_thread(audio_cache.put, key, audio, sr)
         return res
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
+async def stream_speech(http_request: Request, req: InferenceRequest, fmt: str, cache_key: Optional[str] = None):
+    """
+    Devuelve el audio por frases con transferencia chunked: un único encoder
+    incremental por petición (un solo stream mp3/ogg/adts continuo; wav con
+    cabecera de longitud abierta; pcm int16 mono crudo).
+    """
+    loop = asyncio.get_running_loop()
+    stream = AudioStream(loop)
+    fut = await queue_mgr.submit(req, stream=stream)
+    fut.add_done_callback(lambda _: stream.close())
+    # La frecuencia de muestreo llega con el evento "start"; el media type no depende de ella
+    media_type = AUDIO_MEDIA_TYPES[fmt] if ENCODER_BACKENDS.get(fmt) else AUDIO_MEDIA_TYPES["wav"]
+
+    async def chunks():
+        encoder = None
+        try:
+            while True:
+                item = await stream.events.get()
+                if item is None:
+                    break
+                kind, data = item
+                if kind == "start":
+                    encoder = AudioEncoder(fmt, data, streaming=True)
+                    continue
+                chunk = await loop.run_in_executor(encoder_pool, encoder.encode, data)
+                if chunk:
+                    yield chunk
+                if await http_request.is_disconnected():
+                    return
+            if encoder is not None:
+                tail = await loop.run_in_executor(encoder_pool, encoder.flush)
+                if tail:
+                    yield tail
+            res = fut.result() if fut.done() else None
+            if res and res["status"] == "success":
+                await asyncio.to_thread(audio_cache.put, cache_key, res["audio"], res["sr"])
+        finally:
+            # Desconexión del cliente: el hilo de inferencia se detiene antes de la siguiente frase
+            stream.closed = True
+
+    return StreamingResponse(chunks(), media_type=media_type)
+
+async def encode_cached(audio_data: np.ndarray, sr: int, fmt: str, key: Optional[str]):
+    """encode_audio con la caché de respuestas codificadas: un acierto se sirve sin volver a codificar."""
+    content = await asyncio.to_thread(audio_cache.get_encoded, key, fmt)
+    if content is not None:
+        return content, AUDIO_MEDIA_TYPES[fmt]
+    content, media_type = await encode_audio(audio_data, sr, fmt)
+    await asyncio.to_thread(audio_cache.put_encoded, key, fmt, content)
+    return content, media_type
+
 @app.post("/v1/audio/speech")
-async def openai_speech(request: OpenAISpeechRequest):
+async def openai_speech(request: OpenAISpeechRequest, http_request: Request):
+    fmt = (request.response_format or "mp3").lower()
+    if fmt not in AUDIO_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"response_format no soportado: '{fmt}'. Soportados: {list(AUDIO_MEDIA_TYPES)}")
+    # Cada respuesta necesita su propio audio: coalesce se degrada a fifo
+    policy = request.policy or DEFAULT_POLICY
+    if policy == "coalesce":
+        policy = "fifo"
+    req = InferenceRequest(text=request.input, voice=request.voice, session=request.session, policy=policy)
+    await asyncio.to_thread(route_language, req)
+    key = await asyncio.to_thread(audio_cache_key, req)
+    encoded_key = await asyncio.to_thread(audio_cache_key, req, fmt)
+    hit = await asyncio.to_thread(audio_cache.get, key)
+    # En stream el acierto no suena en local, así que no hace falta respetar el orden de la cola
+    if hit is not None and (request.stream or policy == "interrupt"):
+        if policy == "interrupt":
+            queue_mgr.metrics["interrupt"]["requests"] += 1
+            queue_mgr.preempt()
+        if not request.stream:
+            audio_handler.play(*hit)
+        content, media_type = await encode_cached(*hit, fmt, encoded_key)
+        return Response(content=content, media_type=media_type, headers={"X-Audio-Cache": "hit"})
+    if request.stream:
+        # En modo stream el audio lo reproduce el cliente: sin reproducción local
+        return await stream_speech(http_request, req, fmt, key)
     try:
-        req = InferenceRequest(text=request.input, voice=request.voice)
-        res = await queue_mgr.add_task(req)
+        res = await queue_mgr.add_task(req, cached=hit)
         if res is None: return Response(status_code=499, content="Interrupted")
         if res["status"] == "error": raise HTTPException(status_code=500, detail=res.get("message", "Error"))
         
         audio_data = res.pop("audio")
         sr = res.pop("sr")
         
-        # Reproducción local automática
-        audio_handler.play(audio_data, sr)
-        
-        # Escalar Float32 a Int16 para ffmpeg
-        data = (np.clip(audio_data.squeeze(), -1.0, 1.0) * 32767).astype(np.int16) if audio_data.dtype != np.int16 else audio_data
+        # Reproducción local automática (fifo: detrás de lo que ya suena)
+        if req.policy == "interrupt":
+            audio_handler.play(audio_data, sr)
+        else:
+            audio_handler.enqueue(audio_data, sr)
         
-        # FFmpeg para mp3 (compatible con OpenAI)
-        process = subprocess.Popen(
-            ['/opt/homebrew/bin/ffmpeg', '-y', '-f', 's16le', '-ar', str(sr), '-ac', '1', '-i', 'pipe:0', '-f', 'mp3', '-b:a', '128k', 'pipe:1'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL
-        )
-        mp3_bytes, _ = process.communicate(input=data.tobytes())
+        # Codificación en proceso según response_format (sin ffmpeg ni ficheros temporales); la
+        # respuesta codificada se cachea, así los aciertos siguientes no vuelven a codificar
+        content, media_type = await encode_cached(audio_data, sr, fmt, encoded_key)
+        if res.get("cached"):
+            return Response(content=content, media_type=media_type, headers={"X-Audio-Cache": "hit"})
+        await asyncio.to_thread(audio_cache.put, key, audio_data, sr)
             
-        return Response(content=mp3_bytes, media_type="audio/mpeg")
+        return Response(content=content, media_type=media_type)
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/jobs")
+async def create_job(request: NarrationJobRequest):
+    if not request.text and not request.file:
+        raise HTTPException(status_code=400, detail="Se requiere text o file")
+    try:
+        job = await asyncio.to_thread(job_mgr.create, request)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job_mgr.start(job)
+    return job.progress()
+
+@app.get("/jobs")
+async def list_jobs():
+    return [job.progress() for job in job_mgr.jobs.values()]
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(job_mgr.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    return job.progress()
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = job_mgr.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    job_mgr.cancel(job)
+    return job.progress()
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    try:
+        job = await job_mgr.resume(job_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: {job_id}")
+    return job.progress()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=8013)
     args = parser.parse_args()
     
     manager = ModelManager()
+    logger.info(f"🎚️ Codificadores de audio: {ENCODER_BACKENDS}")
     
     import uvicorn
     logger.info(f"⚡️ Iniciando servidor Pocket TTS en puerto {args.port}...")
@@ -14,6 +14,11 @@ if [ ! -f "$CONDA_PYTHON" ]; then
     echo "❌ Error: No se encuentra Python en $CONDA_PYTHON"
     exit 1
 fi
+# Módulo compartido con los servidores MLX (cola, caché, idioma, jobs)
+if [ ! -f "$PROJECT_DIR/../engine-mlx/tts_common.py" ]; then
+    echo "❌ Error: No se encuentra ../engine-mlx/tts_common.py (Pocket TTS lo importa)"
+    exit 1
+fi
 
 # Matar procesos anteriores del servidor TTS
 echo "🧹 Limpiando procesos anteriores de TTS en puerto $PORT..."
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark de cold start del loader de LocateAnything en CPU.
+
+Usa un modelo stand-in diminuto (Llama aleatorio) en lugar del 3B real para
+comparar las dos rutas de carga de pesos de locate_server.py:
+
+  hf_cache  — checkpoint float32 (como el de HF) convertido a float16 al cargar
+  snapshot  — snapshot safetensors ya en float16 (build_snapshot), cargado con mmap
+
+Uso:
+  python benchmark_cold_start.py [--hidden 1024] [--layers 8] [--runs 5]
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import torch
+from transformers import AutoModel, LlamaConfig
+
+from locate_server import build_snapshot, load_model_weights, snapshot_is_valid
+
+
+def make_stand_in(path: str, hidden: int, layers: int) -> int:
+    config = LlamaConfig(
+        hidden_size=hidden,
+        intermediate_size=hidden * 4,
+        num_hidden_layers=layers,
+        num_attention_heads=max(1, hidden // 64),
+        num_key_value_heads=max(1, hidden // 64),
+        vocab_size=32000,
+    )
+    model = AutoModel.from_config(config, torch_dtype=torch.float32)
+    model.save_pretrained(path, safe_serialization=True)
+    return sum(p.numel() for p in model.parameters())
+
+
+def time_loads(path: str, runs: int) -> list[dict]:
+    results = []
+    for _ in range(runs):
+        timings = {}
+        t0 = time.perf_counter()
+        model = load_model_weights(path, torch.float16, torch.device("cpu"), timings)
+        timings["total_s"] = time.perf_counter() - t0
+        assert next(model.parameters()).dtype == torch.float16
+        del model
+        results.append(timings)
+    return results
+
+
+def summarize(name: str, results: list[dict]):
+    for key in ("weights_s", "to_device_s", "total_s"):
+        values = [r[key] for r in results]
+        print(f"  {name:9s} {key:12s} median {statistics.median(values) * 1000:8.1f} ms   min {min(values) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as hf_dir, tempfile.TemporaryDirectory() as snap_dir:
+        n_params = make_stand_in(hf_dir, args.hidden, args.layers)
+        print(f"Stand-in: {n_params / 1e6:.1f}M parámetros (float32), {args.runs} runs en CPU")
+
+        t0 = time.perf_counter()
+        build_snapshot(hf_dir, snap_dir, torch.float16)
+        print(f"build_snapshot: {time.perf_counter() - t0:.2f}s")
+        assert snapshot_is_valid(snap_dir, hf_dir, torch.float16)
+
+        hf = time_loads(hf_dir, args.runs)
+        snap = time_loads(snap_dir, args.runs)
+
+    summarize("hf_cache", hf)
+    summarize("snapshot", snap)
+    speedup = statistics.median(r["total_s"] for r in hf) / statistics.median(r["total_s"] for r in snap)
+    print(f"  speedup total: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
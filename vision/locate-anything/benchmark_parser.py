@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del parser de coordenadas de LocateAnything.
+
+Compara el parser original (dos re.finditer + escalado uno a uno en Python)
+contra LocateAnythingWorkerMPS.parse_locations (una pasada + escalado NumPy)
+sobre respuestas sintéticas densas tipo task="text".
+
+Uso:
+  python benchmark_parser.py [--boxes 1000] [--points 0] [--runs 200]
+"""
+
+import argparse
+import random
+import re
+import time
+
+from locate_server import LocateAnythingWorkerMPS
+
+IMAGE_W, IMAGE_H = 3024, 4032
+
+
+def legacy_parse_boxes(answer: str, image_width: int, image_height: int) -> list[dict]:
+    boxes = []
+    for m in re.finditer(r"<box><(\d+)><(\d+)><(\d+)><(\d+)></box>", answer):
+        x1, y1, x2, y2 = [int(g) for g in m.groups()]
+        boxes.append(
+            {
+                "x1": round(x1 / 1000 * image_width),
+                "y1": round(y1 / 1000 * image_height),
+                "x2": round(x2 / 1000 * image_width),
+                "y2": round(y2 / 1000 * image_height),
+            }
+        )
+    return boxes
+
+
+def legacy_parse_points(answer: str, image_width: int, image_height: int) -> list[dict]:
+    points = []
+    for m in re.finditer(r"<box><(\d+)><(\d+)></box>", answer):
+        x, y = int(m.group(1)), int(m.group(2))
+        points.append({"x": round(x / 1000 * image_width), "y": round(y / 1000 * image_height)})
+    return points
+
+
+def build_answer(n_boxes: int, n_points: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    parts = []
+    for i in range(n_boxes):
+        x1, y1 = rng.randint(0, 900), rng.randint(0, 900)
+        x2, y2 = x1 + rng.randint(1, 99), y1 + rng.randint(1, 99)
+        parts.append(f"word{i}<box><{x1}><{y1}><{x2}><{y2}></box>")
+    for _ in range(n_points):
+        parts.append(f"<box><{rng.randint(0, 1000)}><{rng.randint(0, 1000)}></box>")
+    return " ".join(parts)
+
+
+def bench(fn, runs: int) -> float:
+    fn()  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - t0) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    answer = build_answer(args.boxes, args.points)
+
+    def legacy():
+        return (
+            legacy_parse_boxes(answer, IMAGE_W, IMAGE_H),
+            legacy_parse_points(answer, IMAGE_W, IMAGE_H),
+        )
+
+    def vectorized():
+        return LocateAnythingWorkerMPS.parse_locations(answer, IMAGE_W, IMAGE_H)
+
+    assert legacy() == vectorized(), "Los parsers no coinciden"
+
+    t_legacy = bench(legacy, args.runs)
+    t_new = bench(vectorized, args.runs)
+
+    print(f"Respuesta: {args.boxes} boxes, {args.points} points, {len(answer)} chars, {args.runs} runs")
+    print(f"  legacy (finditer x2): {t_legacy:8.3f} ms/parse")
+    print(f"  parse_locations:      {t_new:8.3f} ms/parse")
+    print(f"  speedup:              {t_legacy / t_new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,29 @@ FastAPI HTTP server (Puerto 8014) que sirve nvidia/LocateAnything-3B
 sobre Apple Silicon (MPS). Muerto por defecto, vive bajo demanda.
 
 Protocolo:
-  POST /locate  — {image_path, prompt, task, categories}
-  GET  /health  — estado del servidor y del worker
+  POST /locate  — {image_path, prompt, task, categories, deterministic, max_results}
+  POST /locate/stream — igual que /locate pero SSE: un evento por box/point según se decodifica
+  POST /cancel/{task_id} — cancela una tarea en cola o en curso (corta model.generate)
+  POST /locate/batch — job sobre una lista de rutas o un glob; decodificación en
+       pool de CPU por delante del worker GPU. Progreso en GET /locate/batch/{job_id},
+       resultados JSONL en GET /locate/batch/{job_id}/results
+  GET  /health  — estado del servidor, del worker y de la caché de resultados
   POST /shutdown — apagado limpio (usado por idle timer)
 
-Arquitectura de desactivación:
-  El servidor se apaga automáticamente tras IDLE_TIMEOUT_SECONDS de
-  inactividad. El proxy STDIO (locate_smart_client.py) lo re-despierta
-  si es necesario en la siguiente llamada.
+Arranque rápido:
+  El modelo se carga en background nada más arrancar el proceso (no en la
+  primera petición). Si existe un snapshot safetensors pre-convertido a
+  float16 (`python locate_server.py --build-snapshot`), los pesos se mapean
+  con mmap sin conversión de dtype. Los tiempos de cada fase se reportan
+  en /health → startup.
+
+Arquitectura de desactivación (dos niveles, plazos adaptativos):
+  1. Tras un periodo corto de inactividad se libera el modelo de la memoria
+     del dispositivo; el proceso y sus cachés (resultados, traducciones,
+     hashes de imagen) siguen vivos y la recarga usa el snapshot fp16.
+  2. Más tarde el proceso se apaga. El proxy STDIO (locate_smart_client.py)
+     lo re-despierta si es necesario en la siguiente llamada.
+  Ambos plazos se ajustan al intervalo observado entre peticiones.
 
 Hardware objetivo: Apple Silicon MPS (M1/M2/M3/M4).
 NO se provee fallback a CPU — un modelo 3B en CPU no es operable.
@@ -23,6 +38,7 @@ import os
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
 
 import time
+_PROCESS_T0 = time.perf_counter()
 import os
 import sys
 import json
@@ -33,18 +49,30 @@ import base64
 import signal
 import threading
 import re
+import gc
+import glob
+import hashlib
+import statistics
+from collections import OrderedDict, deque
+from functools import lru_cache
 from typing import Optional
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
+import numpy as np
 import torch
 from PIL import Image, ImageDraw, ImageFont
 import io
 
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from transformers import StoppingCriteria, StoppingCriteriaList
 import uvicorn
 
+# Tiempos de arranque por fase (segundos). Se completan al cargar el worker.
+STARTUP_TIMINGS: dict = {"imports_s": round(time.perf_counter() - _PROCESS_T0, 3)}
+
 # =============================================================================
 # Logging
 # =============================================================================
@@ -62,7 +90,27 @@ logger = logging.getLogger("LOCATE_SERVER")
 
 MODEL_ID = "nvidia/LocateAnything-3B"
 PORT = 8014
-IDLE_TIMEOUT_SECONDS = 20 * 60  # 20 minutos
+IDLE_TIMEOUT_SECONDS = 20 * 60  # 20 minutos — apagado del proceso (base)
+UNLOAD_TIMEOUT_SECONDS = 10 * 60  # 10 minutos — liberar el modelo del dispositivo (base)
+# Límites de la política adaptativa de inactividad
+MIN_UNLOAD_SECONDS = 2 * 60
+MAX_UNLOAD_SECONDS = 30 * 60
+MAX_EXIT_SECONDS = 2 * 60 * 60
+ARRIVAL_WINDOW = 20  # Llegadas recientes usadas para estimar el intervalo entre peticiones
+# Jobs batch
+BATCH_DECODE_WORKERS = 4  # Hilos de CPU decodificando por delante del worker GPU
+BATCH_PREFETCH = 4  # Imágenes decodificadas en vuelo por job
+BATCH_MAX_IMAGES = 1000
+BATCH_MAX_JOBS = 20  # Jobs terminados que se conservan para consulta
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff", ".heic"}
+# Snapshot de pesos pre-convertido a float16 (safetensors, carga con mmap)
+SNAPSHOT_DIR = os.path.expanduser("~/.cache/locate-anything/LocateAnything-3B-fp16")
+SNAPSHOT_MANIFEST = "locate_snapshot.json"
+# Presupuesto de píxeles de decodificación si el processor no declara max_pixels
+DEFAULT_MAX_PIXELS = 2560 * 1440
+MAX_NEW_TOKENS = 2048
+RESULT_CACHE_MAX_ENTRIES = 256  # Respuestas deterministas (greedy) cacheadas en memoria
+DISCONNECT_POLL_SECONDS = 0.5  # Frecuencia de comprobación de desconexión del cliente
 LOG_PATH = "/Users/crotalo/desarrollo-local/server/logs/locate/inferences.log"
 OUTPUT_DIR = "/Users/crotalo/desarrollo-local/server/vision/locate-anything/outputs"
 
@@ -96,6 +144,118 @@ def get_mps_device() -> torch.device:
         )
     return torch.device("mps")
 
+# =============================================================================
+# Snapshot de pesos (arranque rápido)
+# =============================================================================
+
+def source_revision(source: str) -> Optional[dict]:
+    """
+    Revisión resuelta del checkpoint de origen: commit del snapshot en la
+    caché de HF (o el directorio local) y tamaño/mtime de cada fichero de
+    pesos. Solo stat(), sin leer pesos. None si el origen no está en disco.
+    """
+    path = source if os.path.isdir(source) else None
+    if path is None:
+        try:
+            from huggingface_hub import snapshot_download
+
+            path = snapshot_download(source, local_files_only=True)
+        except Exception:
+            return None
+    weights = {}
+    for name in sorted(os.listdir(path)):
+        if name.endswith((".safetensors", ".bin")):
+            st = os.stat(os.path.join(path, name))  # Sigue el symlink al blob de la caché de HF
+            weights[name] = [st.st_size, int(st.st_mtime)]
+    return {"commit": os.path.basename(os.path.realpath(path)), "weights": weights}
+
+
+def snapshot_is_valid(path: str, source: str, dtype: torch.dtype) -> bool:
+    """
+    El snapshot sirve si fue generado desde `source` en `dtype` con esta
+    versión de transformers y desde la misma revisión de pesos que hay ahora
+    en disco (un checkpoint actualizado invalida el snapshot).
+    """
+    import transformers
+
+    try:
+        with open(os.path.join(path, SNAPSHOT_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not (
+        manifest.get("source") == source
+        and manifest.get("dtype") == str(dtype)
+        and manifest.get("transformers") == transformers.__version__
+    ):
+        return False
+    revision = source_revision(source)
+    if revision is None:  # Origen no disponible en disco: el snapshot es lo único que hay
+        return True
+    if manifest.get("revision") != revision:
+        logger.warning(
+            f"⚠️  Snapshot desactualizado: {source} cambió de revisión "
+            f"({(manifest.get('revision') or {}).get('commit', 'n/d')} → {revision['commit']}). "
+            "Regenéralo con --build-snapshot."
+        )
+        return False
+    return True
+
+
+def load_model_weights(path: str, dtype: torch.dtype, device: torch.device, timings: dict):
+    """
+    Carga los pesos en CPU (low_cpu_mem_usage: sin inicialización aleatoria previa)
+    y los mueve al dispositivo de una vez. Con un snapshot ya en `dtype` no hay
+    conversión: los tensores salen directamente del mmap de safetensors.
+    """
+    from transformers import AutoModel
+
+    t0 = time.perf_counter()
+    model = AutoModel.from_pretrained(
+        path,
+        torch_dtype=dtype,
+        trust_remote_code=True,
+        low_cpu_mem_usage=True,
+        use_safetensors=True if os.path.isdir(path) else None,
+    )
+    timings["weights_s"] = round(time.perf_counter() - t0, 3)
+
+    t0 = time.perf_counter()
+    model = model.to(device).eval()
+    timings["to_device_s"] = round(time.perf_counter() - t0, 3)
+    return model
+
+
+def build_snapshot(source: str = MODEL_ID, dest: str = SNAPSHOT_DIR, dtype: torch.dtype = torch.float16) -> str:
+    """
+    Convierte los pesos de `source` (HF cache) a `dtype` y los guarda como
+    safetensors en `dest`, junto con el código remoto del modelo y un manifiesto.
+    """
+    import transformers
+    from transformers import AutoModel
+
+    logger.info(f"📦 Generando snapshot {dtype} de {source} en {dest}...")
+    t0 = time.perf_counter()
+    revision = source_revision(source)  # Antes de cargar: la revisión de la que salen los pesos
+    model = AutoModel.from_pretrained(source, torch_dtype=dtype, trust_remote_code=True, low_cpu_mem_usage=True)
+    os.makedirs(dest, exist_ok=True)
+    model.save_pretrained(dest, safe_serialization=True)
+    with open(os.path.join(dest, SNAPSHOT_MANIFEST), "w") as f:
+        json.dump(
+            {
+                "source": source,
+                "dtype": str(dtype),
+                "transformers": transformers.__version__,
+                "revision": revision,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"✅ Snapshot listo en {time.perf_counter() - t0:.1f}s")
+    return dest
+
+
 # =============================================================================
 # Worker LocateAnything (adaptado para MPS)
 # =============================================================================
@@ -112,29 +272,68 @@ class LocateAnythingWorkerMPS:
       - Sin la_flash backend (CUDA-only) — usa sdpa de PyTorch
     """
 
-    def __init__(self, model_path: str = MODEL_ID):
-        from transformers import AutoModel, AutoTokenizer, AutoProcessor
+    def __init__(self, model_path: str = MODEL_ID, snapshot_dir: str = SNAPSHOT_DIR):
+        from transformers import AutoTokenizer, AutoProcessor
 
+        t_start = time.perf_counter()
         self.device = get_mps_device()
         # float16: estable en MPS. bfloat16 puede causar NaN en algunas ops de VLM.
         self.dtype = torch.float16
+        self.model_path = model_path
+        self.snapshot_dir = snapshot_dir
+        self.model = None
+        self.load_timings: dict = {}
 
         logger.info(f"🔋 Dispositivo: {self.device} (Apple Silicon MPS)")
-        logger.info(f"📦 Cargando modelo {model_path}...")
-        logger.info("⏳ Primera carga ~20-40s. Cargando en CPU primero, luego pasando a MPS...")
 
-        # Carga en CPU primero, luego movemos a MPS de una vez
-        # (evita fragmentación de memoria en MPS con modelos grandes)
+        # Tokenizer y processor siempre desde el repo original (ligeros)
+        t0 = time.perf_counter()
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        self.load_timings["tokenizer_s"] = round(time.perf_counter() - t0, 3)
+        t0 = time.perf_counter()
         self.processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
-        self.model = AutoModel.from_pretrained(
-            model_path,
-            torch_dtype=self.dtype,
-            trust_remote_code=True,
+        self.load_timings["processor_s"] = round(time.perf_counter() - t0, 3)
+
+        self.max_pixels = self._resolve_max_pixels()
+        self.load_weights()
+        self.load_timings["worker_total_s"] = round(time.perf_counter() - t_start, 3)
+
+        logger.info(
+            f"✅ Modelo listo en {self.device} (max_pixels: {self.max_pixels}) | "
+            f"Fases: {json.dumps(self.load_timings)}"
         )
-        self.model = self.model.to(self.device).eval()
 
-        logger.info(f"✅ Modelo listo en {self.device}")
+    def load_weights(self):
+        """Carga (o recarga tras unload_weights) solo los pesos; tokenizer y processor se conservan."""
+        use_snapshot = snapshot_is_valid(self.snapshot_dir, self.model_path, self.dtype)
+        weights_path = self.snapshot_dir if use_snapshot else self.model_path
+        self.load_timings["source"] = "snapshot" if use_snapshot else "hf_cache"
+        logger.info(f"📦 Cargando modelo {self.model_path} (pesos: {weights_path})...")
+        if not use_snapshot:
+            logger.info("⏳ Sin snapshot: primera carga ~20-40s. Genera uno con --build-snapshot.")
+        # Carga en CPU primero, luego movemos a MPS de una vez
+        # (evita fragmentación de memoria en MPS con modelos grandes)
+        self.model = load_model_weights(weights_path, self.dtype, self.device, self.load_timings)
+
+    def unload_weights(self):
+        self.model = None
+
+    def _resolve_max_pixels(self) -> int:
+        """
+        Lee el presupuesto de píxeles del image_processor.
+        Estilo Qwen-VL: `max_pixels` o `size["longest_edge"]` (ambos en píxeles totales).
+        Todo lo que supere este valor lo reescala el processor de todas formas,
+        así que no tiene sentido decodificarlo.
+        """
+        ip = getattr(self.processor, "image_processor", self.processor)
+        value = getattr(ip, "max_pixels", None)
+        size = getattr(ip, "size", None)
+        if not value and isinstance(size, dict):
+            value = size.get("max_pixels") or size.get("longest_edge")
+        try:
+            return int(value) if value else DEFAULT_MAX_PIXELS
+        except (TypeError, ValueError):
+            return DEFAULT_MAX_PIXELS
 
     @torch.no_grad()
     def predict(
@@ -142,9 +341,23 @@ class LocateAnythingWorkerMPS:
         image: Image.Image,
         question: str,
         generation_mode: str = "hybrid",
-        max_new_tokens: int = 2048,
+        max_new_tokens: int = MAX_NEW_TOKENS,
         temperature: float = 0.7,
+        do_sample: bool = True,
+        on_location=None,
+        max_results: Optional[int] = None,
+        stop_event: Optional[threading.Event] = None,
     ) -> dict:
+        """
+        do_sample=False → decodificación greedy determinista: misma
+        (imagen, prompt, task) produce siempre la misma respuesta, lo que
+        permite cachearla (ver LocateResultCache).
+
+        on_location / max_results / stop_event instalan un IncrementalBoxEmitter
+        en model.generate: cada <box> se emite en cuanto se decodifica su cierre
+        y la generación se corta al llegar a max_results o al activarse stop_event
+        (token de cancelación de la tarea: se comprueba en cada paso de decodificación).
+        """
         messages = [
             {
                 "role": "user",
@@ -168,6 +381,14 @@ class LocateAnythingWorkerMPS:
         input_ids = inputs["input_ids"]
         image_grid_hws = inputs.get("image_grid_hws", None)
 
+        extra = {}
+        if on_location or max_results or stop_event is not None:
+            extra["stopping_criteria"] = StoppingCriteriaList([
+                IncrementalBoxEmitter(
+                    self.tokenizer, input_ids.shape[1], on_location, max_results, stop_event
+                )
+            ])
+
         response = self.model.generate(
             pixel_values=pixel_values,
             input_ids=input_ids,
@@ -178,10 +399,11 @@ class LocateAnythingWorkerMPS:
             use_cache=True,
             generation_mode=generation_mode,
             temperature=temperature,
-            do_sample=True,
+            do_sample=do_sample,
             top_p=0.9,
             repetition_penalty=1.1,
             verbose=False,
+            **extra,
         )
 
         answer = response[0] if isinstance(response, tuple) else response
@@ -214,37 +436,101 @@ class LocateAnythingWorkerMPS:
 
     # ---- Parsers de salida ----
 
+    # Un solo patrón para boxes (4 coords) y points (2 coords): una pasada sobre
+    # la respuesta y sin que el patrón de puntos re-escanee los boxes.
+    _LOCATION_RE = re.compile(r"<box>((?:<\d+>){2}(?:<\d+><\d+>)?)</box>")
+
+    @staticmethod
+    def parse_locations(answer: str, image_width: int, image_height: int) -> tuple[list[dict], list[dict]]:
+        """
+        Extrae boxes y points en una sola pasada.
+        Formato del modelo: <box><x1><y1><x2><y2></box> o <box><x><y></box>,
+        coordenadas normalizadas [0, 1000].
+
+        Todas las tuplas se vuelcan a un único array NumPy (un solo parseo de
+        enteros) y se escalan a píxeles con operaciones vectorizadas.
+        """
+        groups = LocateAnythingWorkerMPS._LOCATION_RE.findall(answer)
+        if not groups:
+            return [], []
+
+        # "<a><b><c><d><e><f>" → "a b c d e f" → int64[]
+        flat = np.fromstring("".join(groups)[1:-1].replace("><", " "), dtype=np.int64, sep=" ")
+        arity = np.fromiter((g.count("<") for g in groups), dtype=np.int64, count=len(groups))
+        starts = np.cumsum(arity) - arity
+        is_box = arity == 4
+
+        boxes: list[dict] = []
+        points: list[dict] = []
+
+        if is_box.any():
+            raw = flat[starts[is_box, None] + np.arange(4)]
+            scale = np.array([image_width, image_height, image_width, image_height], dtype=np.float64)
+            px = np.rint(raw / 1000 * scale).astype(np.int64).tolist()
+            boxes = [{"x1": x1, "y1": y1, "x2": x2, "y2": y2} for x1, y1, x2, y2 in px]
+
+        if not is_box.all():
+            raw = flat[starts[~is_box, None] + np.arange(2)]
+            scale = np.array([image_width, image_height], dtype=np.float64)
+            px = np.rint(raw / 1000 * scale).astype(np.int64).tolist()
+            points = [{"x": x, "y": y} for x, y in px]
+
+        return boxes, points
+
     @staticmethod
     def parse_boxes(answer: str, image_width: int, image_height: int) -> list[dict]:
         """
         Convierte los tokens de coordenadas normalizadas [0, 1000] a píxeles.
         Formato del modelo: <box><x1><y1><x2><y2></box>
         """
-        boxes = []
-        for m in re.finditer(r"<box><(\d+)><(\d+)><(\d+)><(\d+)></box>", answer):
-            x1, y1, x2, y2 = [int(g) for g in m.groups()]
-            boxes.append(
-                {
-                    "x1": round(x1 / 1000 * image_width),
-                    "y1": round(y1 / 1000 * image_height),
-                    "x2": round(x2 / 1000 * image_width),
-                    "y2": round(y2 / 1000 * image_height),
-                }
-            )
-        return boxes
+        return LocateAnythingWorkerMPS.parse_locations(answer, image_width, image_height)[0]
 
     @staticmethod
     def parse_points(answer: str, image_width: int, image_height: int) -> list[dict]:
-        points = []
-        for m in re.finditer(r"<box><(\d+)><(\d+)></box>", answer):
-            x, y = int(m.group(1)), int(m.group(2))
-            points.append(
-                {
-                    "x": round(x / 1000 * image_width),
-                    "y": round(y / 1000 * image_height),
-                }
-            )
-        return points
+        return LocateAnythingWorkerMPS.parse_locations(answer, image_width, image_height)[1]
+
+
+class IncrementalBoxEmitter(StoppingCriteria):
+    """
+    Observa la generación token a token. Nunca corta por sí sola: decodifica
+    los tokens nuevos en cada paso y emite cada <box>...</box> en cuanto se
+    cierra. Corta al alcanzar max_results o cuando stop_event se activa
+    (p.ej. cliente SSE desconectado).
+
+    Solo se decodifica una ventana corta: el ancla avanza en cuanto el texto
+    pendiente no contiene un "<" que pueda ser el inicio de un box.
+    """
+
+    def __init__(self, tokenizer, prompt_len: int, on_location=None, max_results=None, stop_event=None):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.on_location = on_location
+        self.max_results = max_results
+        self.stop_event = stop_event
+        self.emitted = 0
+        self._anchor = 0  # Índice (en tokens generados) donde empieza la ventana
+        self._window_emitted = 0  # Boxes ya emitidos dentro de la ventana actual
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        ids = input_ids[0, self.prompt_len:].tolist()
+        text = self.tokenizer.decode(ids[self._anchor:], skip_special_tokens=False)
+
+        matches = list(LocateAnythingWorkerMPS._LOCATION_RE.finditer(text))
+        for m in matches[self._window_emitted:]:
+            self.emitted += 1
+            if self.on_location:
+                self.on_location(m.group(0))
+        self._window_emitted = len(matches)
+
+        tail = text[matches[-1].end():] if matches else text
+        if "<" not in tail:
+            self._anchor = len(ids)
+            self._window_emitted = 0
+
+        stop = (self.stop_event is not None and self.stop_event.is_set()) or (
+            bool(self.max_results) and self.emitted >= self.max_results
+        )
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
 
 
 # =============================================================================
@@ -253,43 +539,166 @@ class LocateAnythingWorkerMPS:
 
 _worker: Optional[LocateAnythingWorkerMPS] = None
 _worker_lock = threading.Lock()
+_worker_users = 0  # Inferencias en curso con el modelo (acquire_worker / release_worker)
 
 
-def get_worker() -> LocateAnythingWorkerMPS:
+def _loaded_worker() -> LocateAnythingWorkerMPS:
+    """Con _worker_lock tomado: crea el worker o recarga sus pesos si se liberaron."""
     global _worker
     if _worker is None:
-        with _worker_lock:
-            if _worker is None:
-                _worker = LocateAnythingWorkerMPS()
+        _worker = LocateAnythingWorkerMPS()
+        STARTUP_TIMINGS.update(_worker.load_timings)
+        STARTUP_TIMINGS["ready_since_process_start_s"] = round(time.perf_counter() - _PROCESS_T0, 3)
+    elif _worker.model is None:
+        t0 = time.perf_counter()
+        _worker.load_weights()
+        logger.info(f"♻️  Pesos recargados en {time.perf_counter() - t0:.1f}s (tokenizer y processor conservados)")
     return _worker
 
 
+def get_worker() -> LocateAnythingWorkerMPS:
+    if _worker is not None and _worker.model is not None:
+        return _worker
+    with _worker_lock:
+        return _loaded_worker()
+
+
+def acquire_worker() -> LocateAnythingWorkerMPS:
+    """Worker con el modelo cargado y protegido de unload_worker() hasta release_worker()."""
+    global _worker_users
+    with _worker_lock:
+        worker = _loaded_worker()
+        _worker_users += 1
+        return worker
+
+
+def release_worker():
+    global _worker_users
+    with _worker_lock:
+        _worker_users -= 1
+
+
+def unload_worker() -> Optional[bool]:
+    """
+    Libera los pesos del modelo de la memoria del dispositivo sin matar el
+    proceso; tokenizer, processor y cachés siguen vivos y la siguiente
+    petición recarga solo los pesos (rápido con snapshot). Devuelve None si
+    hay una inferencia usando el modelo (no se toca), False si no había nada
+    que liberar.
+    """
+    with _worker_lock:
+        if _worker_users:
+            return None
+        if _worker is None or _worker.model is None:
+            return False
+        _worker.unload_weights()
+    gc.collect()
+    if torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+    return True
+
+
+def preload_worker():
+    """Carga eager en background al arrancar: la primera petición no paga el cold start completo."""
+    try:
+        get_worker()
+    except Exception as e:
+        # No es fatal: la primera petición reintentará la carga y reportará el error
+        logger.error(f"💥 Precarga del modelo falló: {e}")
+
+
 # =============================================================================
 # Idle Shutdown Timer
 # =============================================================================
 
 class IdleShutdownTimer:
     """
-    Reinicia el countdown de inactividad en cada inferencia.
-    Al expirar, apaga el proceso limpiamente (os._exit, igual que TTS).
+    Política de inactividad en dos niveles, reiniciada tras cada inferencia:
+      1. unload: libera el modelo de la memoria del dispositivo (unload_worker).
+      2. exit:   apaga el proceso limpiamente (os._exit, igual que TTS).
+
+    Los plazos se adaptan al p90 del intervalo entre peticiones recientes:
+    si las llamadas llegan cada ~5 min, el modelo sigue cargado más de 5 min;
+    si llegan en ráfagas espaciadas, se libera antes y el proceso vive más
+    (sin modelo) para no pagar el arranque completo del proceso.
+    Con pocas muestras se usan los plazos base.
     """
 
-    def __init__(self, timeout: int = IDLE_TIMEOUT_SECONDS):
-        self.timeout = timeout
+    def __init__(self, unload_timeout: int = UNLOAD_TIMEOUT_SECONDS, exit_timeout: int = IDLE_TIMEOUT_SECONDS):
+        self.base_unload = unload_timeout
+        self.base_exit = exit_timeout
+        self.unload_after = unload_timeout
+        self.exit_after = exit_timeout
+        self.p90_interarrival: Optional[float] = None
+        self.state = "idle"
+        self._arrivals: deque = deque(maxlen=ARRIVAL_WINDOW)
         self._timer: Optional[threading.Timer] = None
         self._lock = threading.Lock()
 
+    def record_arrival(self):
+        """Registrar cada petición entrante (alimenta la estimación del intervalo)."""
+        with self._lock:
+            self._arrivals.append(time.monotonic())
+
+    def _adapt(self) -> tuple[int, int]:
+        arrivals = list(self._arrivals)
+        gaps = [b - a for a, b in zip(arrivals, arrivals[1:])]
+        if len(gaps) < 3:
+            self.p90_interarrival = None
+            return self.base_unload, self.base_exit
+        p90 = statistics.quantiles(gaps, n=10)[-1]
+        self.p90_interarrival = p90
+        unload = int(min(max(2 * p90, MIN_UNLOAD_SECONDS), MAX_UNLOAD_SECONDS))
+        exit_ = int(min(max(6 * p90, self.base_exit, unload + 5 * 60), MAX_EXIT_SECONDS))
+        return unload, exit_
+
     def reset(self):
         with self._lock:
             if self._timer:
                 self._timer.cancel()
-            self._timer = threading.Timer(self.timeout, self._shutdown)
+            self.unload_after, self.exit_after = self._adapt()
+            self._timer = threading.Timer(self.unload_after, self._unload)
+            self._timer.daemon = True
+            self._timer.start()
+            self.state = "armed"
+        p90 = f"{self.p90_interarrival:.0f}s" if self.p90_interarrival is not None else "n/d"
+        logger.info(
+            f"⏱️  Idle policy: liberar modelo en {self.unload_after / 60:.1f} min, "
+            f"apagar en {self.exit_after / 60:.1f} min (p90 entre peticiones: {p90}, "
+            f"muestras: {len(self._arrivals)})"
+        )
+
+    def _busy(self) -> bool:
+        return queue_mgr.is_processing or not queue_mgr.queue.empty()
+
+    def _rearm(self, delay: float, fn):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, fn)
             self._timer.daemon = True
             self._timer.start()
-        logger.info(f"⏱️  Idle timer reiniciado. Apagado automático en {self.timeout // 60} min de inactividad.")
+
+    def _unload(self):
+        freed = None if self._busy() else unload_worker()
+        if freed is None:
+            logger.info("⏱️  Idle policy: worker ocupado, se pospone la liberación del modelo.")
+            self._rearm(self.unload_after, self._unload)
+            return
+        if freed:
+            logger.info(
+                f"🧹 Idle policy: modelo liberado del dispositivo tras {self.unload_after / 60:.1f} min "
+                f"sin peticiones. Proceso y cachés siguen vivos."
+            )
+        self.state = "unloaded"
+        self._rearm(max(self.exit_after - self.unload_after, 0), self._shutdown)
 
     def _shutdown(self):
-        logger.info("💤 Timeout de inactividad alcanzado. Cerrando servidor...")
+        if self._busy():
+            logger.info("⏱️  Idle policy: worker ocupado, se pospone el apagado.")
+            self._rearm(self.unload_after, self._unload)
+            return
+        logger.info(f"💤 Idle policy: {self.exit_after / 60:.1f} min de inactividad. Cerrando servidor...")
         os._exit(0)
 
     def cancel(self):
@@ -297,6 +706,15 @@ class IdleShutdownTimer:
             if self._timer:
                 self._timer.cancel()
 
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "unload_after_s": self.unload_after,
+            "exit_after_s": self.exit_after,
+            "p90_interarrival_s": round(self.p90_interarrival, 1) if self.p90_interarrival is not None else None,
+            "samples": len(self._arrivals),
+        }
+
 
 idle_timer = IdleShutdownTimer()
 
@@ -313,6 +731,8 @@ class LocateRequest(BaseModel):
     task: str = "ground"
     categories: Optional[list[str]] = None  # solo para task="detect"
     generation_mode: str = "hybrid"
+    deterministic: bool = False  # greedy (do_sample=False) + caché de resultados
+    max_results: Optional[int] = None  # corta la generación tras N boxes/points
 
 
 class LocateResponse(BaseModel):
@@ -326,6 +746,8 @@ class LocateResponse(BaseModel):
     annotated_image_path: Optional[str] = None
     summary: str = ""
     duration_seconds: float = 0.0
+    decode_seconds: float = 0.0
+    cached: bool = False
     error: Optional[str] = None
 
 
@@ -340,8 +762,7 @@ def translate_to_english(text: str) -> str:
     Si falla, retorna el texto original para no bloquear la inferencia.
     """
     try:
-        from deep_translator import GoogleTranslator
-        translated = GoogleTranslator(source="auto", target="en").translate(text)
+        translated = _translate_cached(text)
         if translated and translated != text:
             logger.info(f"🌐 Prompt traducido: '{text}' → '{translated}'")
         return translated or text
@@ -350,6 +771,157 @@ def translate_to_english(text: str) -> str:
         return text
 
 
+@lru_cache(maxsize=512)
+def _translate_cached(text: str) -> str:
+    # lru_cache no memoriza excepciones: un fallo de red se reintenta en la siguiente llamada
+    from deep_translator import GoogleTranslator
+    return GoogleTranslator(source="auto", target="en").translate(text)
+
+
+# =============================================================================
+# Caché de resultados (modo determinista)
+# =============================================================================
+
+_digest_cache: dict[tuple, str] = {}
+_digest_lock = threading.Lock()
+
+
+def image_digest(path: str) -> str:
+    """
+    Hash del contenido de la imagen (blake2b). Se memoriza por
+    (ruta, tamaño, mtime) para no releer screenshots grandes sin cambios.
+    """
+    st = os.stat(path)
+    stat_key = (path, st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        cached = _digest_cache.get(stat_key)
+    if cached:
+        return cached
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "blake2b").hexdigest()
+    with _digest_lock:
+        if len(_digest_cache) >= RESULT_CACHE_MAX_ENTRIES:
+            _digest_cache.clear()
+        _digest_cache[stat_key] = digest
+    return digest
+
+
+def result_cache_key(req: LocateRequest, prompt_en: str) -> str:
+    """Clave: hash de imagen + task + prompt traducido + parámetros de generación."""
+    key = {
+        "image": image_digest(req.image_path),
+        "task": req.task,
+        "prompt_en": prompt_en,
+        "categories": req.categories,
+        "generation_mode": req.generation_mode,
+        "max_results": req.max_results,
+        "max_new_tokens": MAX_NEW_TOKENS,
+        "do_sample": False,
+    }
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class LocateResultCache:
+    """
+    LRU en memoria de respuestas deterministas (greedy).
+    Solo se cachean peticiones con deterministic=True y status "success":
+    con muestreo la misma entrada puede dar respuestas distintas.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, response: LocateResponse):
+        with self._lock:
+            self._entries[key] = response.model_dump(exclude={"task_id", "cached"})
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+result_cache = LocateResultCache()
+
+
+def lookup_cached_result(req: LocateRequest, task_id: str) -> Optional[LocateResponse]:
+    """
+    Busca una respuesta determinista ya calculada. Se ejecuta fuera de la cola
+    (en un thread) para que los aciertos no esperen detrás de inferencias en curso.
+    """
+    if not req.deterministic:
+        return None
+    start_t = time.perf_counter()
+    try:
+        prompt_en = translate_to_english(req.prompt)
+        entry = result_cache.get(result_cache_key(req, prompt_en))
+    except OSError:
+        return None  # Imagen inexistente/ilegible: run_locate reporta el error
+    if entry is None:
+        return None
+    duration = time.perf_counter() - start_t
+    logger.info(f"⚡ [{task_id}] Cache hit ({duration * 1000:.1f}ms) | Task: {req.task} | Prompt: '{prompt_en}'")
+    _log_inference(task_id, req, prompt_en, "CACHE_HIT", duration, entry["boxes"], entry["points"])
+    entry = {**entry, "duration_seconds": round(duration, 3), "decode_seconds": 0.0}
+    return LocateResponse(**entry, task_id=task_id, cached=True)
+
+
+# =============================================================================
+# Decodificación de imagen (fast path para entradas enormes)
+# =============================================================================
+
+def decode_image(path: str, max_pixels: int) -> tuple[Image.Image, tuple[int, int], tuple[float, float], float]:
+    """
+    Decodifica la imagen directamente al presupuesto de píxeles del processor.
+
+    - JPEG: usa draft mode (escalado DCT 1/2, 1/4, 1/8) para no decodificar
+      nunca los píxeles completos de fotos de móvil o screenshots 5K.
+    - Resto de formatos: resize con reducing_gap (reducción entera + bicúbico).
+
+    Retorna (imagen, (ancho, alto) originales, (scale_x, scale_y), segundos).
+    Las escalas convierten coordenadas de la imagen decodificada a la original.
+    """
+    t0 = time.perf_counter()
+    image = Image.open(path)
+    orig_w, orig_h = image.size
+
+    if orig_w * orig_h > max_pixels:
+        ratio = (max_pixels / (orig_w * orig_h)) ** 0.5
+        target = (max(1, int(orig_w * ratio)), max(1, int(orig_h * ratio)))
+        image.draft("RGB", target)  # No-op en formatos que no son JPEG
+        image = image.convert("RGB")
+        if image.size[0] * image.size[1] > max_pixels:
+            image = image.resize(target, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    else:
+        image = image.convert("RGB")
+
+    scale = (orig_w / image.size[0], orig_h / image.size[1])
+    return image, (orig_w, orig_h), scale, time.perf_counter() - t0
+
+
 # =============================================================================
 # Dibujado de recuadros sobre imagen
 # =============================================================================
@@ -360,11 +932,15 @@ def annotate_image(
     points: list[dict],
     prompt: str,
     task_id: str,
+    scale: tuple[float, float] = (1.0, 1.0),
 ) -> str:
     """
     Dibuja recuadros numerados y puntos sobre la imagen.
+    Las coordenadas vienen en el espacio de la imagen original; `scale`
+    las lleva al espacio de la imagen decodificada (posiblemente reducida).
     Guarda la imagen en disco y retorna la ruta absoluta.
     """
+    sx, sy = scale
     # Usar una copia para no modificar el original
     annotated = image.copy().convert("RGBA")
     overlay = Image.new("RGBA", annotated.size, (0, 0, 0, 0))
@@ -388,7 +964,8 @@ def annotate_image(
         color_rgba = (r, g, b, 200)
         color_solid = (r, g, b, 255)
 
-        x1, y1, x2, y2 = box["x1"], box["y1"], box["x2"], box["y2"]
+        x1, y1 = box["x1"] / sx, box["y1"] / sy
+        x2, y2 = box["x2"] / sx, box["y2"] / sy
 
         # Recuadro semi-transparente
         draw_overlay.rectangle([x1, y1, x2, y2], outline=color_solid, width=3)
@@ -411,7 +988,7 @@ def annotate_image(
         r = int(color_hex[1:3], 16)
         g = int(color_hex[3:5], 16)
         b = int(color_hex[5:7], 16)
-        x, y = pt["x"], pt["y"]
+        x, y = pt["x"] / sx, pt["y"] / sy
         radius = 8
         draw_final.ellipse(
             [x - radius, y - radius, x + radius, y + radius],
@@ -433,11 +1010,22 @@ def annotate_image(
 # Lógica de inferencia
 # =============================================================================
 
-def run_locate(req: LocateRequest, task_id: str) -> LocateResponse:
+def run_locate(
+    req: LocateRequest,
+    task_id: str,
+    cancel_token: Optional[threading.Event] = None,
+    stream: Optional["LocateStream"] = None,
+    decoded: Optional[tuple] = None,
+) -> LocateResponse:
+    """
+    `decoded` permite pasar la salida de decode_image ya calculada
+    (jobs batch: la decodificación ocurre en el pool de CPU por delante).
+    """
     start_t = time.perf_counter()
 
     # Traducción automática
     prompt_en = translate_to_english(req.prompt)
+    worker = None
 
     try:
         # Cargar imagen
@@ -446,40 +1034,63 @@ def run_locate(req: LocateRequest, task_id: str) -> LocateResponse:
         if not os.path.exists(req.image_path):
             raise FileNotFoundError(f"Imagen no encontrada: '{req.image_path}'")
 
-        image = Image.open(req.image_path).convert("RGB")
-        w, h = image.size
-        logger.info(f"🖼️  [{task_id}] Imagen: {req.image_path} ({w}x{h}) | Task: {req.task} | Prompt: '{prompt_en}'")
-
-        worker = get_worker()
         task = req.task
-
         if task not in SUPPORTED_TASKS:
             raise ValueError(f"Task desconocida: '{task}'. Soportadas: {SUPPORTED_TASKS}")
 
+        worker = acquire_worker()
+
+        if decoded is None:
+            decoded = decode_image(req.image_path, worker.max_pixels)
+        image, (w, h), scale, decode_s = decoded
+        logger.info(
+            f"🖼️  [{task_id}] Imagen: {req.image_path} ({w}x{h} → {image.size[0]}x{image.size[1]}, "
+            f"decode {decode_s * 1000:.0f}ms) | Task: {req.task} | Prompt: '{prompt_en}'"
+        )
+
+        gen_kwargs = {"generation_mode": req.generation_mode, "do_sample": not req.deterministic}
+        if req.max_results:
+            gen_kwargs["max_results"] = req.max_results
+        if stream is not None:
+            def on_location(fragment: str):
+                # Coordenadas en píxeles de la imagen original, igual que la respuesta final
+                frag_boxes, frag_points = LocateAnythingWorkerMPS.parse_locations(fragment, w, h)
+                for kind, item in [("box", b) for b in frag_boxes] + [("point", p) for p in frag_points]:
+                    stream.emit(kind, item)
+
+            gen_kwargs["on_location"] = on_location
+        if cancel_token is not None:
+            gen_kwargs["stop_event"] = cancel_token
+
         # Dispatch por tarea
         if task == "detect":
             cats = req.categories or [prompt_en]
-            result = worker.detect(image, cats, generation_mode=req.generation_mode)
+            result = worker.detect(image, cats, **gen_kwargs)
         elif task == "ground":
-            result = worker.ground_multi(image, prompt_en, generation_mode=req.generation_mode)
+            result = worker.ground_multi(image, prompt_en, **gen_kwargs)
         elif task == "ground_single":
-            result = worker.ground_single(image, prompt_en, generation_mode=req.generation_mode)
+            result = worker.ground_single(image, prompt_en, **gen_kwargs)
         elif task == "text":
-            result = worker.detect_text(image, generation_mode=req.generation_mode)
+            result = worker.detect_text(image, **gen_kwargs)
         elif task == "gui":
-            result = worker.ground_gui(image, prompt_en, generation_mode=req.generation_mode)
+            result = worker.ground_gui(image, prompt_en, **gen_kwargs)
         elif task == "point":
-            result = worker.point(image, prompt_en, generation_mode=req.generation_mode)
+            result = worker.point(image, prompt_en, **gen_kwargs)
 
         raw_answer = result.get("answer", "")
+
+        if cancel_token is not None and cancel_token.is_set():
+            duration = time.perf_counter() - start_t
+            logger.info(f"🛑 [{task_id}] Cancelada en curso — dispositivo liberado tras {duration:.1f}s")
+            _log_inference(task_id, req, prompt_en, "CANCELLED", duration, [], [], decode_s=decode_s)
+            return cancelled_response(req, task_id, prompt_en, duration)
         logger.info(f"🔍 [{task_id}] Respuesta raw: {raw_answer[:200]}...")
 
-        # Parsear coordenadas
-        boxes = LocateAnythingWorkerMPS.parse_boxes(raw_answer, w, h)
-        points = LocateAnythingWorkerMPS.parse_points(raw_answer, w, h)
+        # Parsear coordenadas (normalizadas [0, 1000] → píxeles de la imagen original)
+        boxes, points = LocateAnythingWorkerMPS.parse_locations(raw_answer, w, h)
 
         # Anotar imagen y guardarla
-        annotated_path = annotate_image(image, boxes, points, prompt_en, task_id)
+        annotated_path = annotate_image(image, boxes, points, prompt_en, task_id, scale)
 
         # Resumen legible
         if boxes:
@@ -494,9 +1105,9 @@ def run_locate(req: LocateRequest, task_id: str) -> LocateResponse:
         duration = time.perf_counter() - start_t
         logger.info(f"✅ [{task_id}] {len(boxes)} boxes, {len(points)} points — {duration:.1f}s")
 
-        _log_inference(task_id, req, prompt_en, "SUCCESS", duration, boxes, points)
+        _log_inference(task_id, req, prompt_en, "SUCCESS", duration, boxes, points, decode_s=decode_s)
 
-        return LocateResponse(
+        response = LocateResponse(
             status="success",
             task_id=task_id,
             task=task,
@@ -507,7 +1118,11 @@ def run_locate(req: LocateRequest, task_id: str) -> LocateResponse:
             annotated_image_path=annotated_path,
             summary=summary,
             duration_seconds=round(duration, 2),
+            decode_seconds=round(decode_s, 3),
         )
+        if req.deterministic:
+            result_cache.put(result_cache_key(req, prompt_en), response)
+        return response
 
     except Exception as e:
         duration = time.perf_counter() - start_t
@@ -522,9 +1137,23 @@ def run_locate(req: LocateRequest, task_id: str) -> LocateResponse:
             duration_seconds=round(duration, 2),
             error=str(e),
         )
+    finally:
+        if worker is not None:
+            release_worker()
+
+
+def cancelled_response(req: LocateRequest, task_id: str, prompt_en: str = "", duration: float = 0.0) -> LocateResponse:
+    return LocateResponse(
+        status="cancelled",
+        task_id=task_id,
+        task=req.task,
+        prompt_translated=prompt_en,
+        summary="Tarea cancelada.",
+        duration_seconds=round(duration, 2),
+    )
 
 
-def _log_inference(task_id, req, prompt_en, status, duration, boxes, points, error=""):
+def _log_inference(task_id, req, prompt_en, status, duration, boxes, points, error="", decode_s=0.0):
     entry = {
         "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
         "task_id": task_id,
@@ -536,6 +1165,7 @@ def _log_inference(task_id, req, prompt_en, status, duration, boxes, points, err
         "boxes_found": len(boxes),
         "points_found": len(points),
         "duration_s": round(duration, 2),
+        "decode_s": round(decode_s, 3),
         "error": error,
     }
     try:
@@ -556,24 +1186,55 @@ class LocateQueueManager:
         self._loop_task = None
         self.is_processing = False
         self.current_task_id = None
+        # task_id → (req, future, token). El token lo comprueba model.generate en cada paso.
+        self.tasks: dict[str, tuple[LocateRequest, asyncio.Future, threading.Event]] = {}
+
+    def register(self, req: LocateRequest, task_id: str, fut: asyncio.Future) -> threading.Event:
+        """Crea el token de cancelación de la tarea. Un futuro cancelado activa el token."""
+        token = threading.Event()
+        self.tasks[task_id] = (req, fut, token)
+
+        def _on_done(f: asyncio.Future):
+            if f.cancelled():
+                token.set()
+            self.tasks.pop(task_id, None)
+
+        fut.add_done_callback(_on_done)
+        return token
+
+    def cancel(self, task_id: str) -> bool:
+        """
+        Cancela una tarea en cola (el worker la salta) o en curso (la generación
+        se corta en el siguiente paso de decodificación). El cliente recibe
+        status="cancelled" de inmediato.
+        """
+        entry = self.tasks.get(task_id)
+        if entry is None:
+            return False
+        req, fut, token = entry
+        token.set()
+        if not fut.done():
+            fut.set_result(cancelled_response(req, task_id))
+        logger.info(f"🛑 Cancelación solicitada para {task_id}")
+        return True
 
     async def worker(self):
         logger.info("👷 Queue worker iniciado.")
         while True:
-            req, task_id, fut = await self.queue.get()
-            if fut.cancelled():
+            req, task_id, fut, token, stream, decoded = await self.queue.get()
+            if fut.done():
                 self.queue.task_done()
                 continue
             self.is_processing = True
             self.current_task_id = task_id
             try:
                 res = await asyncio.get_running_loop().run_in_executor(
-                    self.executor, run_locate, req, task_id
+                    self.executor, run_locate, req, task_id, token, stream, decoded
                 )
-                if not fut.cancelled():
+                if not fut.done():
                     fut.set_result(res)
             except Exception as e:
-                if not fut.cancelled():
+                if not fut.done():
                     fut.set_exception(e)
             finally:
                 self.queue.task_done()
@@ -592,6 +1253,231 @@ class LocateQueueManager:
 
 queue_mgr = LocateQueueManager()
 
+
+class LocateStream:
+    """
+    Puente worker-thread → respuesta SSE.
+    run_locate emite eventos desde el executor; el endpoint los consume del
+    asyncio.Queue.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.count = 0
+
+    def emit(self, kind: str, data: dict):
+        self.count += 1
+        event = {"index": self.count, **data}
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (kind, event))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, None)
+
+
+# =============================================================================
+# Jobs batch (directorio / lista de imágenes)
+# =============================================================================
+
+class LocateBatchRequest(BaseModel):
+    image_paths: Optional[list[str]] = None
+    glob: Optional[str] = None  # p.ej. "/Users/me/frames/*.png" (admite **)
+    prompt: str
+    task: str = "ground"
+    categories: Optional[list[str]] = None
+    generation_mode: str = "hybrid"
+    deterministic: bool = False
+    max_results: Optional[int] = None
+
+
+class LocateBatchJob:
+    """
+    Estado de un job batch. Los resultados se acumulan en memoria y en
+    OUTPUT_DIR/batch_{job_id}.jsonl (una LocateResponse por línea, en orden).
+    """
+
+    def __init__(self, job_id: str, req: LocateBatchRequest, paths: list[str]):
+        self.job_id = job_id
+        self.req = req
+        self.paths = paths
+        self.results: list[dict] = []
+        self.status = "queued"
+        self.cancelled = False
+        self.current_task_id: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.results_path = os.path.join(OUTPUT_DIR, f"batch_{job_id}.jsonl")
+        self._updated = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "cancelled", "error")
+
+    def add_result(self, res: LocateResponse):
+        entry = {"index": len(self.results), "image_path": self.paths[len(self.results)], **res.model_dump()}
+        self.results.append(entry)
+        with open(self.results_path, "a") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._notify()
+
+    def finish(self, status: str):
+        self.status = status
+        self.finished = time.time()
+        self._notify()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def wait_update(self):
+        await self._updated.wait()
+
+    def progress(self) -> dict:
+        elapsed = (self.finished or time.time()) - self.started if self.started else 0.0
+        completed = len(self.results)
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "total": len(self.paths),
+            "completed": completed,
+            "succeeded": sum(1 for r in self.results if r["status"] == "success"),
+            "current_task": self.current_task_id,
+            "elapsed_seconds": round(elapsed, 2),
+            "images_per_second": round(completed / elapsed, 3) if elapsed > 0 else 0.0,
+            "results_path": self.results_path,
+        }
+
+
+class LocateBatchManager:
+    """
+    Ejecuta jobs de uno en uno. Por cada job, un pool de CPU decodifica hasta
+    BATCH_PREFETCH imágenes por delante mientras el worker GPU infiere la actual.
+    Cada imagen pasa por la cola normal (queue_mgr): las peticiones interactivas
+    se intercalan y la cancelación por token funciona igual que en /locate.
+    """
+
+    def __init__(self):
+        self.jobs: OrderedDict[str, LocateBatchJob] = OrderedDict()
+        self.decode_pool = ThreadPoolExecutor(max_workers=BATCH_DECODE_WORKERS, thread_name_prefix="LocateDecode")
+        self._lock = asyncio.Lock()  # Un job activo a la vez
+
+    @staticmethod
+    def resolve_paths(req: LocateBatchRequest) -> list[str]:
+        paths = list(req.image_paths or [])
+        if req.glob:
+            if not os.path.isabs(req.glob):
+                raise ValueError(f"glob debe ser una ruta absoluta: '{req.glob}'")
+            paths += sorted(
+                p for p in glob.glob(req.glob, recursive=True)
+                if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS and os.path.isfile(p)
+            )
+        if not paths:
+            raise ValueError("El job no contiene imágenes (image_paths vacío y glob sin coincidencias)")
+        if len(paths) > BATCH_MAX_IMAGES:
+            raise ValueError(f"Demasiadas imágenes ({len(paths)}). Máximo: {BATCH_MAX_IMAGES}")
+        return paths
+
+    def submit(self, req: LocateBatchRequest, paths: list[str]) -> LocateBatchJob:
+        job = LocateBatchJob(str(uuid.uuid4())[:8], req, paths)
+        self.jobs[job.job_id] = job
+        finished = [j for j in self.jobs.values() if j.done]
+        for old in finished[: max(0, len(finished) - BATCH_MAX_JOBS)]:
+            self.jobs.pop(old.job_id, None)
+        asyncio.create_task(self._run(job))
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        job.cancelled = True
+        if job.current_task_id:
+            queue_mgr.cancel(job.current_task_id)
+        logger.info(f"🛑 Batch {job_id}: cancelación solicitada ({len(job.results)}/{len(job.paths)})")
+        return True
+
+    async def _run(self, job: LocateBatchJob):
+        async with self._lock:
+            if job.cancelled:
+                job.finish("cancelled")
+                return
+            job.status = "running"
+            job.started = time.time()
+            logger.info(f"📚 Batch {job.job_id}: {len(job.paths)} imágenes | Task: {job.req.task} | Prompt: '{job.req.prompt}'")
+            loop = asyncio.get_running_loop()
+            pending: deque = deque()
+            try:
+                worker = await asyncio.to_thread(get_worker)
+                max_pixels = worker.max_pixels
+                next_path = iter(job.paths)
+
+                def prefetch():
+                    path = next(next_path, None)
+                    if path is not None:
+                        pending.append((path, loop.run_in_executor(self.decode_pool, decode_image, path, max_pixels)))
+
+                for _ in range(BATCH_PREFETCH):
+                    prefetch()
+
+                while pending and not job.cancelled:
+                    path, decode_fut = pending.popleft()
+                    prefetch()
+                    res = await self._process(job, path, decode_fut)
+                    job.add_result(res)
+
+                job.finish("cancelled" if job.cancelled else "done")
+            except Exception as e:
+                logger.error(f"💥 Batch {job.job_id}: {e}")
+                job.finish("error")
+            finally:
+                for _, decode_fut in pending:
+                    decode_fut.cancel()
+                job.current_task_id = None
+                p = job.progress()
+                logger.info(
+                    f"📚 Batch {job.job_id} {job.status}: {p['completed']}/{p['total']} en "
+                    f"{p['elapsed_seconds']}s ({p['images_per_second']} img/s)"
+                )
+
+    async def _process(self, job: LocateBatchJob, path: str, decode_fut) -> LocateResponse:
+        index = len(job.results)
+        task_id = f"{job.job_id}-{index}"
+        fields = job.req.model_dump(exclude={"image_paths", "glob"})
+        req = LocateRequest(image_path=path, **fields)
+
+        cached = await asyncio.to_thread(lookup_cached_result, req, task_id)
+        if cached is not None:
+            return cached
+
+        try:
+            decoded = await decode_fut
+        except Exception as e:
+            return LocateResponse(
+                status="error", task_id=task_id, task=req.task, prompt_translated="",
+                summary=f"Error al decodificar imagen: {e}", error=str(e),
+            )
+
+        # Una cancelación durante la caché o la decodificación no encontró tarea en cola
+        if job.cancelled:
+            return cancelled_response(req, task_id)
+
+        fut = asyncio.get_running_loop().create_future()
+        token = queue_mgr.register(req, task_id, fut)
+        job.current_task_id = task_id
+        try:
+            await queue_mgr.queue.put((req, task_id, fut, token, None, decoded))
+            return await fut
+        finally:
+            job.current_task_id = None
+
+
+batch_mgr = LocateBatchManager()
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 # =============================================================================
 # FastAPI App
 # =============================================================================
@@ -600,7 +1486,9 @@ queue_mgr = LocateQueueManager()
 async def lifespan(app: FastAPI):
     queue_mgr.start()
     idle_timer.reset()  # Iniciar countdown desde el arranque
-    logger.info(f"🚀 LocateAnything Server v1.0 — Puerto {PORT} — MPS ready.")
+    threading.Thread(target=preload_worker, name="LocatePreload", daemon=True).start()
+    STARTUP_TIMINGS["server_up_s"] = round(time.perf_counter() - _PROCESS_T0, 3)
+    logger.info(f"🚀 LocateAnything Server v1.0 — Puerto {PORT} — MPS ready. Precargando modelo...")
     yield
     idle_timer.cancel()
     queue_mgr.stop()
@@ -621,33 +1509,186 @@ async def health():
         "status": "ok",
         "model": MODEL_ID,
         "device": "mps",
+        "worker_loaded": _worker is not None and _worker.model is not None,
+        "startup": STARTUP_TIMINGS,
         "is_processing": queue_mgr.is_processing,
         "current_task": queue_mgr.current_task_id,
         "queue_size": queue_mgr.queue.qsize(),
         "idle_timeout_min": IDLE_TIMEOUT_SECONDS // 60,
+        "idle_policy": idle_timer.stats(),
+        "result_cache": result_cache.stats(),
     }
 
 
+async def _wait_result(request: Request, fut: asyncio.Future, task_id: str):
+    """
+    Espera el resultado vigilando la conexión: si el cliente se desconecta,
+    la tarea se cancela de verdad (cola o generación en curso).
+    """
+    while not fut.done():
+        await asyncio.wait({fut}, timeout=DISCONNECT_POLL_SECONDS)
+        if not fut.done() and await request.is_disconnected():
+            logger.info(f"⚠️ Cliente de {task_id} desconectado. Cancelando...")
+            queue_mgr.cancel(task_id)
+    return fut.result()
+
+
 @app.post("/locate", response_model=LocateResponse)
-async def locate(req: LocateRequest):
+async def locate(req: LocateRequest, request: Request):
     if req.task not in SUPPORTED_TASKS:
         raise HTTPException(status_code=400, detail=f"Task inválida: '{req.task}'. Soportadas: {list(SUPPORTED_TASKS)}")
 
     task_id = str(uuid.uuid4())[:8]
+    idle_timer.record_arrival()
+
+    # Modo determinista: un acierto de caché no pasa por la cola
+    cached = await asyncio.to_thread(lookup_cached_result, req, task_id)
+    if cached is not None:
+        idle_timer.reset()
+        return cached
+
     fut = asyncio.get_running_loop().create_future()
+    token = queue_mgr.register(req, task_id, fut)
 
     try:
-        await asyncio.wait_for(queue_mgr.queue.put((req, task_id, fut)), timeout=5.0)
+        await asyncio.wait_for(queue_mgr.queue.put((req, task_id, fut, token, None, None)), timeout=5.0)
     except asyncio.TimeoutError:
+        fut.cancel()
         raise HTTPException(status_code=503, detail="Servidor ocupado, cola llena. Intenta más tarde.")
 
     try:
-        return await fut
+        return await _wait_result(request, fut, task_id)
     except asyncio.CancelledError:
         logger.info(f"⚠️ Request {task_id} cancelado por cliente.")
+        queue_mgr.cancel(task_id)
         raise
 
 
+@app.post("/locate/stream")
+async def locate_stream(req: LocateRequest):
+    """
+    Variante SSE de /locate. Eventos:
+      queued → box/point (uno por elemento, en cuanto se decodifica su </box>)
+      → result (LocateResponse completa) | error
+    Cerrar la conexión detiene la generación en el siguiente paso de decodificación.
+    """
+    if req.task not in SUPPORTED_TASKS:
+        raise HTTPException(status_code=400, detail=f"Task inválida: '{req.task}'. Soportadas: {list(SUPPORTED_TASKS)}")
+
+    task_id = str(uuid.uuid4())[:8]
+    idle_timer.record_arrival()
+
+    cached = await asyncio.to_thread(lookup_cached_result, req, task_id)
+    if cached is not None:
+        idle_timer.reset()
+
+        async def cached_source():
+            for i, b in enumerate(cached.boxes):
+                yield _sse("box", {"index": i + 1, **b})
+            for i, p in enumerate(cached.points):
+                yield _sse("point", {"index": len(cached.boxes) + i + 1, **p})
+            yield _sse("result", cached.model_dump())
+
+        return StreamingResponse(cached_source(), media_type="text/event-stream")
+
+    loop = asyncio.get_running_loop()
+    stream = LocateStream(loop)
+    fut = loop.create_future()
+    fut.add_done_callback(lambda _: stream.close())
+    token = queue_mgr.register(req, task_id, fut)
+
+    try:
+        await asyncio.wait_for(queue_mgr.queue.put((req, task_id, fut, token, stream, None)), timeout=5.0)
+    except asyncio.TimeoutError:
+        fut.cancel()
+        raise HTTPException(status_code=503, detail="Servidor ocupado, cola llena. Intenta más tarde.")
+
+    async def event_source():
+        try:
+            yield _sse("queued", {"task_id": task_id, "queue_size": queue_mgr.queue.qsize()})
+            while True:
+                item = await stream.events.get()
+                if item is None:
+                    break
+                kind, data = item
+                yield _sse(kind, data)
+            if fut.cancelled():
+                return
+            if fut.exception() is not None:
+                yield _sse("error", {"task_id": task_id, "error": str(fut.exception())})
+            else:
+                yield _sse("result", fut.result().model_dump())
+        finally:
+            if not fut.done():
+                # Cliente desconectado: cortar la generación y liberar el worker
+                logger.info(f"⚠️ Stream {task_id} cerrado por cliente. Deteniendo generación...")
+                queue_mgr.cancel(task_id)
+
+    return StreamingResponse(event_source(), media_type="text/event-stream")
+
+
+@app.post("/cancel/{task_id}")
+async def cancel(task_id: str):
+    """Cancela una tarea en cola o en curso. El task_id llega en el evento 'queued' del stream o en /health."""
+    if not queue_mgr.cancel(task_id):
+        raise HTTPException(status_code=404, detail=f"Tarea no encontrada o ya terminada: '{task_id}'")
+    return {"status": "cancelled", "task_id": task_id}
+
+
+@app.post("/locate/batch")
+async def locate_batch(req: LocateBatchRequest):
+    if req.task not in SUPPORTED_TASKS:
+        raise HTTPException(status_code=400, detail=f"Task inválida: '{req.task}'. Soportadas: {list(SUPPORTED_TASKS)}")
+    idle_timer.record_arrival()
+    try:
+        paths = await asyncio.to_thread(batch_mgr.resolve_paths, req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = batch_mgr.submit(req, paths)
+    return {
+        "job_id": job.job_id,
+        "total": len(job.paths),
+        "status_url": f"/locate/batch/{job.job_id}",
+        "results_url": f"/locate/batch/{job.job_id}/results",
+    }
+
+
+@app.get("/locate/batch/{job_id}")
+async def locate_batch_status(job_id: str):
+    job = batch_mgr.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: '{job_id}'")
+    return job.progress()
+
+
+@app.get("/locate/batch/{job_id}/results")
+async def locate_batch_results(job_id: str):
+    """JSONL: una LocateResponse por imagen, en orden, según se completan; termina con el job."""
+    job = batch_mgr.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job no encontrado: '{job_id}'")
+
+    async def lines():
+        sent = 0
+        while True:
+            while sent < len(job.results):
+                yield json.dumps(job.results[sent], ensure_ascii=False) + "\n"
+                sent += 1
+            if job.done:
+                yield json.dumps({"job": job.progress()}, ensure_ascii=False) + "\n"
+                return
+            await job.wait_update()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/locate/batch/{job_id}/cancel")
+async def locate_batch_cancel(job_id: str):
+    if not batch_mgr.cancel(job_id):
+        raise HTTPException(status_code=404, detail=f"Job no encontrado o ya terminado: '{job_id}'")
+    return {"status": "cancelling", "job_id": job_id}
+
+
 @app.post("/shutdown")
 async def shutdown():
     """Apagado limpio para uso del idle timer o scripts externos."""
@@ -666,6 +1707,20 @@ async def _delayed_exit():
 # =============================================================================
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="LocateAnything Smart Server")
+    parser.add_argument(
+        "--build-snapshot",
+        action="store_true",
+        help=f"Genera el snapshot float16 en {SNAPSHOT_DIR} y termina",
+    )
+    args = parser.parse_args()
+
+    if args.build_snapshot:
+        build_snapshot()
+        sys.exit(0)
+
     def handle_signal(sig, frame):
         logger.info(f"Señal {sig} recibida. Cerrando...")
         idle_timer.cancel()
@@ -7,7 +7,11 @@ LM Studio, Antigravity IDE, Claude Desktop, etc.
 Protocolo:
   - Entrada:  JSON-RPC 2.0 por STDIN (protocolo MCP estándar)
   - Salida:   JSON-RPC 2.0 por STDOUT
-  - Backend:  HTTP POST a http://localhost:8014/locate
+  - Backend:  HTTP POST a http://localhost:8014/locate/stream (SSE)
+
+Resultados progresivos:
+  Cada box/point se recibe en cuanto el modelo lo decodifica. Si el cliente
+  MCP envía _meta.progressToken, se reenvía como notifications/progress.
 
 Filosofía Cold Start:
   1. Verifica si el servidor HTTP está vivo (GET /health, timeout 1s)
@@ -37,6 +41,7 @@ PORT = 8014
 BASE_URL = f"http://127.0.0.1:{PORT}"
 HEALTH_URL = f"{BASE_URL}/health"
 LOCATE_URL = f"{BASE_URL}/locate"
+LOCATE_STREAM_URL = f"{BASE_URL}/locate/stream"
 
 # Ruta al servidor (relativa al directorio de este script)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -99,6 +104,22 @@ MCP_TOOLS = [
                     "default": "hybrid",
                     "description": "Inference mode: 'hybrid' (default, best overall), 'fast' (MTP parallel), 'slow' (autoregressive, most robust)",
                 },
+                "max_results": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "description": (
+                        "Stop generation after this many boxes/points. Use 1 when only the first match is needed: "
+                        "the server stops decoding as soon as it is found."
+                    ),
+                },
+                "deterministic": {
+                    "type": "boolean",
+                    "default": False,
+                    "description": (
+                        "Greedy decoding (no sampling). Identical (image, prompt, task) requests return the same "
+                        "result and repeated queries on an unchanged image are served instantly from cache."
+                    ),
+                },
             },
             "required": ["image_path", "prompt"],
         },
@@ -200,18 +221,10 @@ def handle_tools_call(req_id, params):
     if tool_name != "locate_objects":
         return _mcp_error(req_id, -32601, f"Herramienta desconocida: '{tool_name}'")
 
-    # Construir petición al servidor HTTP
-    payload = json.dumps(arguments).encode("utf-8")
-    req_http = urllib.request.Request(
-        LOCATE_URL,
-        data=payload,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
+    progress_token = (params.get("_meta") or {}).get("progressToken")
 
     try:
-        with urllib.request.urlopen(req_http, timeout=300) as response:
-            body = json.loads(response.read().decode("utf-8"))
+        body = _locate_streaming(arguments, progress_token)
     except urllib.error.HTTPError as e:
         err_body = e.read().decode("utf-8") if e.fp else "Sin cuerpo de respuesta"
         return _mcp_error(req_id, -32000, f"Error HTTP {e.code}: {err_body}")
@@ -236,6 +249,7 @@ def handle_tools_call(req_id, params):
     summary_text = body.get("summary", "Procesado sin resultados.")
     prompt_en = body.get("prompt_translated", "")
     duration = body.get("duration_seconds", 0)
+    decode = body.get("decode_seconds", 0)
     boxes = body.get("boxes", [])
     points = body.get("points", [])
 
@@ -257,7 +271,10 @@ def handle_tools_call(req_id, params):
     if prompt_en and prompt_en != arguments.get("prompt", ""):
         text_lines.append(f"\n🌐 Prompt traducido: '{prompt_en}'")
 
-    text_lines.append(f"⏱️  Tiempo de inferencia: {duration}s")
+    if body.get("cached"):
+        text_lines.append(f"⚡ Resultado desde caché (modo determinista): {duration}s")
+    else:
+        text_lines.append(f"⏱️  Tiempo de inferencia: {duration}s (decodificación: {decode}s)")
     text_lines.append(f"🤖 Modelo: nvidia/LocateAnything-3B (MPS)")
 
     # Ruta a la imagen anotada
@@ -274,6 +291,56 @@ def handle_tools_call(req_id, params):
     }
 
 
+def _locate_streaming(arguments: dict, progress_token=None) -> dict:
+    """
+    Consume el SSE de /locate/stream. Cada box/point parcial se registra en
+    stderr y, si hay progressToken, se notifica al cliente MCP en el momento.
+    Retorna el cuerpo del evento final 'result' (mismo formato que /locate).
+    """
+    payload = json.dumps(arguments).encode("utf-8")
+    req_http = urllib.request.Request(
+        LOCATE_STREAM_URL,
+        data=payload,
+        headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+        method="POST",
+    )
+
+    event, data_lines = None, []
+    with urllib.request.urlopen(req_http, timeout=300) as response:
+        for raw in response:
+            line = raw.decode("utf-8").rstrip("\r\n")
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data_lines.append(line[5:].strip())
+            elif not line and event:
+                data = json.loads("\n".join(data_lines)) if data_lines else {}
+                if event == "result":
+                    return data
+                if event == "error":
+                    raise RuntimeError(data.get("error", "Error desconocido en el stream"))
+                if event in ("box", "point"):
+                    _report_partial(event, data, progress_token)
+                event, data_lines = None, []
+
+    raise RuntimeError("El stream terminó sin evento 'result'")
+
+
+def _report_partial(kind: str, data: dict, progress_token=None) -> None:
+    if kind == "box":
+        message = f"#{data['index']}: ({data['x1']}, {data['y1']}) → ({data['x2']}, {data['y2']})"
+    else:
+        message = f"#{data['index']}: ({data['x']}, {data['y']})"
+    sys.stderr.write(f"[locate-client] {kind} {message}\n")
+    sys.stderr.flush()
+    if progress_token is not None:
+        _send({
+            "jsonrpc": "2.0",
+            "method": "notifications/progress",
+            "params": {"progressToken": progress_token, "progress": data["index"], "message": message},
+        })
+
+
 def _mcp_error(req_id, code: int, message: str) -> dict:
     return {
         "jsonrpc": "2.0",